@@ -30,6 +30,10 @@ DEBUG = True
 
 ALLOWED_HOSTS = ["*"]
 
+# the Vercel proxy terminates HTTPS and always sets X-Forwarded-Proto, the
+# absolute URLs built from a request (the "next" page links) keep https
+SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
+
 
 # Application definition
 
@@ -146,6 +150,65 @@ else:
         }
     }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "pfm",
+    },
+    # dedupe of the receipt uploads, the least recently used entries are evicted
+    "receipts": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "pfm-receipts",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# seconds a cached report/dashboard response is kept per process, a write of the
+# user (committed by any process) invalidates it earlier
+RESPONSE_CACHE_TIMEOUT = 5 * 60
+
+# delta sync: the tombstones of deleted rows are kept this many days (older
+# watermarks resync)
+SYNC_TOMBSTONE_DAYS = 90
+
+# seconds the response of an Idempotency-Key is kept for the retries, and the
+# longest a first request may hold the key while it runs
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+IDEMPOTENCY_LOCK_TIMEOUT = 5 * 60
+
+# receipt processing: "aws" (Lambda + DynamoDB) or "local" (process pool of
+# this server, tasks in the database)
+RECEIPT_BACKEND = os.environ.get("RECEIPT_BACKEND", "aws")
+RECEIPT_AWS_REGION = "us-east-1"
+RECEIPT_LAMBDA_FUNCTION = "pfm-ProcessReceiptFunction-SPRh84ot6ujL"
+RECEIPT_TASK_TABLE = "ReceiptTasks"
+RECEIPT_LOCAL_WORKERS = int(
+    os.environ.get("RECEIPT_LOCAL_WORKERS", os.cpu_count() or 1)
+)
+RECEIPT_LOCAL_EXTRACTOR = os.environ.get(
+    "RECEIPT_LOCAL_EXTRACTOR", "finance.receipt_extract.extract_invoice"
+)
+
+# a repeat upload of a receipt gets the task of the first one for this long;
+# near-duplicates are matched on a perceptual hash within DISTANCE bits of the
+# user's RECENT receipts, off by default: receipts are similar looking images
+RECEIPT_DEDUPE_TTL = 7 * 24 * 60 * 60
+RECEIPT_DEDUPE_PERCEPTUAL = os.environ.get("RECEIPT_DEDUPE_PERCEPTUAL") == "1"
+RECEIPT_DEDUPE_DISTANCE = 2
+RECEIPT_DEDUPE_RECENT = 50
+
+# longest wait of a long-poll task status request, under the 10 s function
+# duration of the Vercel deployment (returned to the client as poll_wait),
+# and seconds between two reads of the watched task statuses
+RECEIPT_LONG_POLL_TIMEOUT = float(os.environ.get("RECEIPT_LONG_POLL_TIMEOUT", 8))
+RECEIPT_WATCH_INTERVAL = 1.0
+
+# batch upload: most images per request, threads decoding them, and the
+# concurrent Lambda invokes of the fan-out
+RECEIPT_BATCH_MAX_IMAGES = 50
+RECEIPT_PREPROCESS_WORKERS = os.cpu_count() or 1
+RECEIPT_SUBMIT_CONCURRENCY = 16
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_simplejwt.authentication.JWTAuthentication",
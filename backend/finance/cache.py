@@ -0,0 +1,90 @@
+"""
+File: cache.py
+Author: Haitao Wang
+Date: 2024-10-06
+Description: Per-user versioned response cache for the read heavy views (reports, dashboard)
+
+The data version of a user is the pair of change numbers of the database
+(changes.current_numbers): every write of a transaction, budget or category
+takes the next number of its user (or the global one) in its own
+transaction, wherever it runs (views, commands, the recurring job, the
+receipt pipeline), so every process sees the new version once it commits.
+The version is read before the data, a response is never cached under a
+version newer than what it was computed from.
+"""
+
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from .changes import current_numbers, next_numbers
+
+RESPONSE_KEY = "pfm:response:{name}:{user_id}:{version}:{params}"
+STATS_KEY = "pfm:response-cache:{counter}"
+
+
+def get_data_version(user_id):
+    """
+    Return the current data version of the user, one query of the change counters.
+    """
+    return "%d.%d" % current_numbers(user_id)
+
+
+def bump_data_version(user_id):
+    """
+    Invalidate every cached response of the user, for writes of derived rows only (rollups, totals).
+
+    The writes of transactions, budgets and categories already take a change number.
+    """
+    with transaction.atomic():
+        next_numbers([user_id])
+
+
+def _count(counter):
+    key = STATS_KEY.format(counter=counter)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def cache_stats():
+    """
+    Return the hit and miss counters of the response cache.
+    """
+    hits = cache.get(STATS_KEY.format(counter="hits"), 0)
+    misses = cache.get(STATS_KEY.format(counter="misses"), 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
+
+
+def cached_response(name, user_id, params, compute):
+    """
+    Return the data of view ``name`` for the user and the query params, computing it on a miss.
+
+    The key contains the user's data version, a write changes the version and
+    the old entries are simply never read again (the backend expires them).
+    """
+    digest = hashlib.md5(
+        json.dumps(params, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    key = RESPONSE_KEY.format(
+        name=name,
+        user_id=user_id,
+        version=get_data_version(user_id),
+        params=digest,
+    )
+    data = cache.get(key)
+    if data is not None:
+        _count("hits")
+        return data
+    _count("misses")
+    data = compute()
+    cache.set(key, data, settings.RESPONSE_CACHE_TIMEOUT)
+    return data
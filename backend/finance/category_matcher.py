@@ -0,0 +1,225 @@
+"""
+File: category_matcher.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Map the category names of a receipt to the expense categories of a user
+
+The matcher of a user is built from two queries (the expense categories
+visible to the user and the aliases learnt from their corrections) and kept
+per process with the fingerprint of what it was built from: the count and
+latest updated_at of those categories and aliases. Every receipt reads the
+fingerprint (two aggregate queries on indexed columns) and rebuilds the
+matcher if a category or alias was added, edited or deleted, by any process.
+Matching a line is then dictionary lookups in memory, without a query:
+
+1. the alias of the normalized name (the category the user picked last time);
+2. the category of that name, the user's own before a global one;
+3. the best scoring category on shared words and character trigrams, if it
+   scores at least MIN_SCORE.
+"""
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+from django.db.models import Count, F, Max
+from .models import Categories, CategoryAlias
+
+# matchers kept per process, the least recently used is dropped
+MAX_MATCHERS = 256
+# names remembered per matcher
+MAX_MEMO = 4096
+MIN_SCORE = 0.5
+MIN_PREFIX = 4
+STOP_WORDS = {"and", "the", "for", "other"}
+
+_matchers = OrderedDict()
+_lock = threading.Lock()
+
+
+def normalize(name):
+    """
+    Lower case words of the name, accents and punctuation dropped: "Café & Bar" -> "cafe bar".
+    """
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+
+def trigrams(key):
+    padded = f" {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def words(key):
+    return {word for word in key.split() if len(word) > 2 and word not in STOP_WORDS}
+
+
+def prefixes(key):
+    """
+    The words of the key and their prefixes of MIN_PREFIX letters or more, "misc" finds "miscellaneous".
+    """
+    found = set()
+    for word in words(key):
+        found.update(word[:end] for end in range(MIN_PREFIX, len(word)))
+        found.add(word)
+    return found
+
+
+class CategoryMatcher:
+    """
+    In-memory index of the category names and aliases of a user.
+
+    ``categories`` are the user's expense categories, global ones first so the
+    user's own category of the same name wins; ``aliases`` are
+    (normalized name, category id) pairs.
+    """
+
+    def __init__(self, categories, aliases=()):
+        self.exact = {}
+        for category in categories:
+            self.exact[normalize(category.name)] = category
+        by_id = {category.id: category for category in self.exact.values()}
+        for name, category_id in aliases:
+            # an alias to a category no longer visible is ignored
+            if category_id in by_id:
+                self.exact[name] = by_id[category_id]
+
+        self.word_index = defaultdict(set)
+        self.trigram_index = defaultdict(set)
+        self.trigrams = {}
+        self.words = {}
+        for key in self.exact:
+            self.words[key] = prefixes(key)
+            for word in self.words[key]:
+                self.word_index[word].add(key)
+            self.trigrams[key] = trigrams(key)
+            for gram in self.trigrams[key]:
+                self.trigram_index[gram].add(key)
+        self._memo = {}
+
+    def match(self, name):
+        """
+        Return the category of the name, None if nothing scores MIN_SCORE.
+        """
+        try:
+            return self._memo[name]
+        except KeyError:
+            pass
+        key = normalize(name)
+        category = self.exact.get(key)
+        if category is None and key:
+            category = self._closest(key)
+        if len(self._memo) >= MAX_MEMO:
+            self._memo.clear()
+        self._memo[name] = category
+        return category
+
+    def _closest(self, key):
+        grams = trigrams(key)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self.trigram_index.get(gram, ()):
+                shared[candidate] += 1
+        query_words = words(key)
+        for word in query_words:
+            for candidate in self.word_index.get(word, ()):
+                shared.setdefault(candidate, 0)
+
+        best, best_score = None, 0
+        for candidate, count in shared.items():
+            # Dice coefficient of the trigrams, or the share of the words found
+            # (as a word or a word prefix of the candidate)
+            score = 2 * count / (len(grams) + len(self.trigrams[candidate]))
+            if query_words:
+                found = len(query_words & self.words[candidate]) / len(query_words)
+                score = max(score, found)
+            if score > best_score:
+                best, best_score = candidate, score
+        return self.exact[best] if best_score >= MIN_SCORE else None
+
+
+def expense_categories(user):
+    return Categories.objects.for_user(user).filter(category_type="expense")
+
+
+def fingerprint(user):
+    """
+    Return what changes whenever an expense category or an alias of the user is added, edited or deleted.
+    """
+    # deleting a category deletes its aliases (CASCADE), the counts drop
+    categories = expense_categories(user).aggregate(
+        count=Count("id"), latest=Max("updated_at")
+    )
+    aliases = CategoryAlias.objects.filter(user=user).aggregate(
+        count=Count("id"), latest=Max("updated_at")
+    )
+    return (
+        categories["count"],
+        categories["latest"],
+        aliases["count"],
+        aliases["latest"],
+    )
+
+
+def build_matcher(user):
+    aliases = CategoryAlias.objects.filter(
+        user=user, category__category_type="expense"
+    ).values_list("name", "category_id")
+    # global categories (no user) first on every database, the user's own win
+    categories = expense_categories(user).order_by(
+        F("user_id").asc(nulls_first=True), "id"
+    )
+    return CategoryMatcher(categories, aliases)
+
+
+def get_matcher(user):
+    """
+    Return the matcher of the expense categories of the user, rebuilt if a category or alias changed.
+    """
+    current = fingerprint(user)
+    with _lock:
+        entry = _matchers.get(user.id)
+        if entry is not None and entry[0] == current:
+            _matchers.move_to_end(user.id)
+            return entry[1]
+    matcher = build_matcher(user)
+    with _lock:
+        _matchers[user.id] = (current, matcher)
+        _matchers.move_to_end(user.id)
+        while len(_matchers) > MAX_MATCHERS:
+            _matchers.popitem(last=False)
+    return matcher
+
+
+def learn_aliases(user, original, edited):
+    """
+    Remember the categories the user changed on the products of a receipt.
+
+    The products of the edited Invoice are paired with the extracted ones by
+    position; a product whose category was changed to the name of one of the
+    user's expense categories aliases the extracted name to it. Return the
+    number of aliases written.
+    """
+    matcher = get_matcher(user)
+    aliases = {}
+    for before, after in zip(original["product"], edited["product"]):
+        name = normalize(before["category"])
+        category = matcher.exact.get(normalize(after["category"]))
+        if (
+            name
+            and category is not None
+            and matcher.match(before["category"]) != category
+        ):
+            aliases[name] = category
+    if not aliases:
+        return 0
+    CategoryAlias.objects.bulk_create(
+        [
+            CategoryAlias(user=user, name=name, category=category)
+            for name, category in aliases.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["user", "name"],
+        update_fields=["category", "updated_at"],
+    )
+    return len(aliases)
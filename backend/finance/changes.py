@@ -0,0 +1,75 @@
+"""
+File: changes.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Per-user change numbers of the synced rows (transactions, budgets, categories, tombstones)
+
+Every write of a synced row takes the next change number of its user in its
+transaction (next_numbers) and stamps the rows with it (change_seq). The
+counter row stays locked until the transaction commits, so the writes of a
+user commit in the order of their numbers: once a number is read
+(current_numbers), every row with that number or a lower one is committed.
+The sync reads the counters first and then the rows with a higher number than
+the previous watermark, a row committed late is never skipped.
+
+Writers take the number before they write the shared rows (rollups, budgets,
+totals), two writers of a user never wait on each other in opposite orders.
+"""
+
+from django.db import transaction
+from django.db.models import F
+from .models import ChangeCounter
+
+# the counter of the global categories (user null)
+GLOBAL = 0
+
+
+def scope_of(user_id):
+    return GLOBAL if user_id is None else user_id
+
+
+def next_numbers(user_ids):
+    """
+    Take the next change number of each user (None for the global categories), {user id: number}.
+
+    Must run in the transaction of the write, the counters stay locked until it commits.
+    """
+    scopes = sorted({scope_of(user_id) for user_id in user_ids})
+    if not scopes:
+        return {}
+    with transaction.atomic():
+        # one scope at a time in order, concurrent writers lock them in the same order
+        for scope in scopes:
+            counter = ChangeCounter.objects.filter(scope=scope)
+            if not counter.update(value=F("value") + 1):
+                # the first write of the user
+                ChangeCounter.objects.bulk_create(
+                    [ChangeCounter(scope=scope)], ignore_conflicts=True
+                )
+                counter.update(value=F("value") + 1)
+        values = dict(
+            ChangeCounter.objects.filter(scope__in=scopes).values_list("scope", "value")
+        )
+    return {user_id: values[scope_of(user_id)] for user_id in user_ids}
+
+
+def stamp(instances):
+    """
+    Set the change_seq of unsaved (or about to be saved) instances, taking the numbers of their users.
+    """
+    numbers = next_numbers([instance.user_id for instance in instances])
+    for instance in instances:
+        instance.change_seq = numbers[instance.user_id]
+    return instances
+
+
+def current_numbers(user_id):
+    """
+    Return the committed change numbers (of the user, of the global categories), without locking.
+    """
+    values = dict(
+        ChangeCounter.objects.filter(scope__in=[user_id, GLOBAL]).values_list(
+            "scope", "value"
+        )
+    )
+    return values.get(user_id, 0), values.get(GLOBAL, 0)
@@ -0,0 +1,131 @@
+"""
+File: fieldsets.py
+Author: Haitao Wang
+Date: 2024-10-16
+Description: Sparse fieldsets (?fields=) and querysets shaped to the serializer of the list endpoints
+
+The view mixin derives select_related() and only() from the fields the
+serializer will actually read, so a list page is one query (plus the page's
+keyset probe) whatever the number of rows, and asking for fewer fields also
+reads fewer columns.
+"""
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin, ``fields`` keeps only the named fields (nested objects included).
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            return
+        unknown = set(fields) - self.fields.keys()
+        if unknown:
+            raise serializers.ValidationError(
+                {"fields": f"Unknown fields: {', '.join(sorted(unknown))}."}
+            )
+        for name in self.fields.keys() - set(fields):
+            self.fields.pop(name)
+
+
+def model_field(model, name):
+    """
+    Return the concrete model field of a serializer source (name or attname), None if there is none.
+    """
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        field = next(
+            (f for f in model._meta.concrete_fields if f.attname == name), None
+        )
+    if field is None or not field.concrete:
+        return None
+    return field
+
+
+def serializer_columns(serializer, model, prefix=""):
+    """
+    Return (select_related paths, only() paths) of the readable fields, None for only() if a field is not a column.
+    """
+    related, columns = [], {prefix + model._meta.pk.name}
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == "*" or "." in field.source:
+            return related, None
+        model_fld = model_field(model, field.source)
+        if model_fld is None:
+            return related, None
+        if isinstance(field, serializers.BaseSerializer):
+            if not model_fld.many_to_one or isinstance(
+                field, serializers.ListSerializer
+            ):
+                return related, None
+            path = prefix + model_fld.name
+            nested_related, nested_columns = serializer_columns(
+                field, model_fld.related_model, path + "__"
+            )
+            related += [path, *nested_related]
+            if nested_columns is None:
+                return related, None
+            columns |= {path, *nested_columns}
+        else:
+            columns.add(prefix + model_fld.name)
+    return related, columns
+
+
+def shape_queryset(queryset, serializer, keep=(), defer=True):
+    """
+    Join the nested objects of the serializer and, if defer, load only the columns it reads (plus keep).
+    """
+    related, columns = serializer_columns(serializer, queryset.model)
+    if related:
+        queryset = queryset.select_related(*related)
+    if defer and columns is not None:
+        keep = [name for name in keep if model_field(queryset.model, name)]
+        queryset = queryset.only(*columns, *keep)
+    return queryset
+
+
+class SparseFieldsViewMixin:
+    """
+    View mixin, ``?fields=a,b`` on the reads and querysets shaped to the serializer.
+
+    Columns are only deferred for safe methods: a budget keeps a snapshot of
+    its stored period to know when spent must be recalculated, which is not
+    taken when the period fields are deferred.
+    """
+
+    fields_query_param = "fields"
+
+    def sparse_fields(self):
+        if self.request is None or self.request.method not in SAFE_METHODS:
+            return None
+        value = self.request.query_params.get(self.fields_query_param)
+        if not value:
+            return None
+        return [name.strip() for name in value.split(",") if name.strip()]
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.sparse_fields()
+        if fields is not None:
+            kwargs.setdefault("fields", fields)
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        serializer = self.get_serializer_class()(
+            fields=self.sparse_fields(), context=self.get_serializer_context()
+        )
+        keep = [name.lstrip("-") for name in getattr(self, "keyset_ordering", ())]
+        return shape_queryset(
+            queryset,
+            serializer,
+            keep=keep,
+            defer=self.request is not None and self.request.method in SAFE_METHODS,
+        )
@@ -0,0 +1,160 @@
+"""
+File: idempotency.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Idempotency-Key support for the create endpoints
+
+A retried request (same user, same Idempotency-Key) gets the stored response
+of the first one back instead of creating the rows, the budget deltas and the
+notifications again. The keys are IdempotencyKey rows, unique per user and key,
+so a retry is recognized by every process and instance:
+
+- the first request inserts the row, which is its lock until
+  IDEMPOTENCY_LOCK_TIMEOUT; a concurrent retry gets 409 Conflict, a lock left
+  by a crashed request is taken over once it times out;
+- a 2xx response is stored compactly (status, body, Location) with a digest of
+  the request for IDEMPOTENCY_KEY_TTL, a retry with another body gets 422;
+- any other outcome deletes the row, nothing was written so the client can
+  simply try again.
+
+The expired rows are deleted by the prune_idempotency_keys command.
+"""
+
+import functools
+import hashlib
+import json
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+def _json_value(value):
+    if isinstance(value, UploadedFile):
+        return [value.name, value.size]
+    return str(value)
+
+
+def request_digest(request):
+    """
+    Digest of what the request asks for: method, path and parsed body (uploads by name and size).
+    """
+    data = request.data
+    if hasattr(data, "lists"):
+        data = dict(data.lists())
+    payload = json.dumps(
+        [request.method, request.path, data], sort_keys=True, default=_json_value
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def idempotent(handler):
+    """
+    View method decorator, honour the Idempotency-Key header of the request.
+
+    Requests without the header are handled as before.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        value = request.headers.get(HEADER)
+        if not value:
+            return handler(self, request, *args, **kwargs)
+        if len(value) > MAX_KEY_LENGTH:
+            return Response(
+                {"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        key = hashlib.sha256(value.encode()).hexdigest()
+        digest = request_digest(request)
+        now = timezone.now()
+        lock_expiry = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+        if not claim(request.user, key, digest, now, lock_expiry):
+            stored = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+            if stored is not None and stored.status_code is not None:
+                return replay(stored, digest)
+            # still running (or released in between), the client retries later
+            return Response(
+                {"error": "A request with this Idempotency-Key is in progress."},
+                status=status.HTTP_409_CONFLICT,
+                headers={"Retry-After": "1"},
+            )
+
+        # the lock expiry tells our row from one that took over an expired lock
+        own = IdempotencyKey.objects.filter(
+            user=request.user, key=key, expires_at=lock_expiry
+        )
+        try:
+            response = handler(self, request, *args, **kwargs)
+        except BaseException:
+            own.delete()
+            raise
+        if status.is_success(response.status_code):
+            own.update(
+                status_code=response.status_code,
+                body=response.data,
+                location=response.get("Location") or "",
+                expires_at=timezone.now()
+                + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            )
+        else:
+            own.delete()
+        return response
+
+    return wrapper
+
+
+def claim(user, key, digest, now, lock_expiry):
+    """
+    Take the key for a new request, return whether it was free (or expired).
+    """
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                user=user, key=key, request_digest=digest, expires_at=lock_expiry
+            )
+        return True
+    except IntegrityError:
+        pass
+    # an expired response or the lock of a crashed request, only one taker wins
+    return bool(
+        IdempotencyKey.objects.filter(user=user, key=key, expires_at__lte=now).update(
+            request_digest=digest,
+            status_code=None,
+            body=None,
+            location="",
+            expires_at=lock_expiry,
+        )
+    )
+
+
+def replay(stored, digest):
+    """
+    Return the stored response of a key, or 422 if the key was used for another request.
+    """
+    if stored.request_digest != digest:
+        return Response(
+            {"error": f"{HEADER} was already used for a different request."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    headers = {REPLAY_HEADER: "true"}
+    if stored.location:
+        headers["Location"] = stored.location
+    return Response(stored.body, status=stored.status_code, headers=headers)
+
+
+def prune_keys():
+    """
+    Delete the expired keys, return the number deleted.
+    """
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lt=timezone.now()).delete()
+    return deleted
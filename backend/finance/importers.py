@@ -0,0 +1,323 @@
+"""
+File: importers.py
+Author: Haitao Wang
+Date: 2024-10-14
+Description: Streaming import of bank statements (CSV, OFX, QIF) into transactions
+
+The parsers are generators over the decoded lines of the upload. The rows
+are parsed and validated first, outside of any transaction, and staged in a
+temporary file (on disk past STAGE_MEMORY bytes), so memory stays flat
+whatever the size of the file. The staged rows are then inserted in one
+short transaction, one bulk_create per chunk, and the deltas of all the
+chunks are posted to the ledger once: the rollups, totals and budgets are
+updated and the budgets evaluated for notifications a single time. A file
+that fails part way imports nothing, so a retry never imports the first
+chunks twice.
+"""
+
+import codecs
+import csv
+import itertools
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from . import changes, ledger, search
+from .models import Categories, Transactions
+
+FORMATS = ("csv", "ofx", "qif")
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y%m%d", "%m/%d/%Y", "%m/%d/%y")
+MAX_REPORTED_ERRORS = 100
+MAX_AMOUNT = Decimal("100000000")
+# bytes of staged rows kept in memory before the staging file goes to disk
+STAGE_MEMORY = 1024 * 1024
+
+# csv header aliases of the transaction fields
+CSV_COLUMNS = {
+    "occu_date": ("occu_date", "date", "posted", "transaction date"),
+    "amount": ("amount", "value"),
+    "types": ("types", "type"),
+    "category": ("category",),
+    "notes": ("notes", "description", "memo", "payee", "name"),
+}
+
+
+class StatementError(ValueError):
+    """
+    A row of the statement can not be imported.
+    """
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    skipped: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+    errors: list = field(default_factory=list)
+
+    @property
+    def rows_per_second(self):
+        return self.imported / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "chunks": self.chunks,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+            "errors": self.errors,
+        }
+
+
+def detect_format(filename):
+    extension = (filename or "").rsplit(".", 1)[-1].lower()
+    return extension if extension in FORMATS else None
+
+
+def decoded_lines(fileobj, encoding="utf-8-sig"):
+    """
+    Iterate the lines of a binary file as text, without reading the whole file.
+    """
+    return codecs.iterdecode(iter(fileobj), encoding, errors="replace")
+
+
+def parse_date(value, date_format=None):
+    value = value.strip()
+    formats = (date_format,) if date_format else DATE_FORMATS
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise StatementError(f"invalid date {value!r}")
+
+
+def parse_amount(value):
+    try:
+        amount = Decimal(value.strip().replace(",", "").replace("$", ""))
+        amount = amount.quantize(ledger.CENT)
+    except (InvalidOperation, AttributeError):
+        raise StatementError(f"invalid amount {value!r}")
+    if not amount.is_finite():
+        raise StatementError(f"invalid amount {value!r}")
+    # Transactions.amount is max_digits=10, decimal_places=2
+    if abs(amount) >= MAX_AMOUNT:
+        raise StatementError(f"amount {value!r} is too large")
+    return amount
+
+
+def parse_csv(lines):
+    """
+    Yield the raw rows of a CSV statement, the header names the columns (see CSV_COLUMNS).
+    """
+    reader = csv.DictReader(lines)
+    try:
+        fieldnames = reader.fieldnames or ()
+    except csv.Error as e:
+        raise StatementError(f"line {reader.line_num}: {e}")
+    columns = {}
+    for name in fieldnames:
+        for target, aliases in CSV_COLUMNS.items():
+            if name.strip().lower() in aliases and target not in columns:
+                columns[target] = name
+    if "occu_date" not in columns or "amount" not in columns:
+        raise StatementError("the CSV header needs a date and an amount column")
+
+    for number in itertools.count(1):
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            raise StatementError(f"row {number}: {e}")
+        # a short row has None for the missing fields, the extra fields of a
+        # long one are under the None key and ignored
+        yield {
+            target: (row[columns[target]] or "") if target in columns else ""
+            for target in CSV_COLUMNS
+        }
+
+
+def parse_ofx(lines):
+    """
+    Yield the raw STMTTRN records of an OFX (SGML or XML) statement.
+    """
+    record = None
+    for line in lines:
+        for token in line.split("<")[1:]:
+            tag, _, value = token.partition(">")
+            tag = tag.strip().upper()
+            value = value.strip()
+            if tag == "STMTTRN":
+                record = {}
+            elif tag == "/STMTTRN" and record is not None:
+                yield {
+                    "occu_date": record.get("DTPOSTED", "")[:8],
+                    "amount": record.get("TRNAMT", ""),
+                    "types": "",
+                    "category": "",
+                    "notes": record.get("NAME") or record.get("MEMO") or "",
+                }
+                record = None
+            elif record is not None and value:
+                record[tag] = value
+
+
+def parse_qif(lines):
+    """
+    Yield the raw records of a QIF statement (D date, T amount, P payee, M memo, L category, ^ end).
+    """
+    record = {}
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line or line.startswith("!"):
+            continue
+        code, value = line[0], line[1:].strip()
+        if code != "^":
+            record[code] = value
+            continue
+        if record:
+            yield {
+                # QIF writes 12/31'24 for 2024
+                "occu_date": record.get("D", "").replace("'", "/").replace(" ", ""),
+                "amount": record.get("T") or record.get("U", ""),
+                "types": "",
+                "category": record.get("L", ""),
+                "notes": record.get("P") or record.get("M") or "",
+            }
+        record = {}
+
+
+PARSERS = {"csv": parse_csv, "ofx": parse_ofx, "qif": parse_qif}
+
+
+class CategoryMapper:
+    """
+    Map the category names of a statement onto the user's categories, loaded with one query.
+    """
+
+    DEFAULTS = {"expense": "miscellaneous", "income": "miscellaneous income"}
+
+    def __init__(self, user):
+        self.by_name = {}
+        self.fallback = {}
+        for category in Categories.objects.for_user(user).order_by("id"):
+            key = (category.category_type, category.name.strip().lower())
+            # a personal category wins over the global one of the same name
+            if key not in self.by_name or category.user_id is not None:
+                self.by_name[key] = category
+            self.fallback.setdefault(category.category_type, category)
+        for types, name in self.DEFAULTS.items():
+            if (types, name) in self.by_name:
+                self.fallback[types] = self.by_name[(types, name)]
+
+    def map(self, types, name):
+        category = self.by_name.get((types, name.strip().lower()))
+        if category is None:
+            category = self.fallback.get(types)
+        if category is None:
+            raise StatementError(f"no {types} category to import into")
+        return category
+
+
+def to_transaction(user, row, categories, date_format=None):
+    """
+    Turn a raw statement row into an unsaved Transactions, StatementError if it is invalid.
+    """
+    occu_date = parse_date(row["occu_date"], date_format)
+    amount = parse_amount(row["amount"])
+    types = row["types"].strip().lower()
+    if types in ("credit", "deposit"):
+        types = "income"
+    elif types in ("debit", "payment", "withdrawal"):
+        types = "expense"
+    elif types not in ("income", "expense"):
+        # no usable type column, the sign of the amount decides
+        types = "expense" if amount < 0 else "income"
+    return Transactions(
+        user=user,
+        types=types,
+        amount=abs(amount),
+        category=categories.map(types, row["category"]),
+        occu_date=occu_date,
+        notes=row["notes"].strip() or "imported",
+    )
+
+
+def import_statement(
+    user, fileobj, fmt, chunk_size=1000, date_format=None, encoding="utf-8-sig"
+):
+    """
+    Stream a statement into the user's transactions, chunk_size rows per insert.
+
+    Invalid rows are skipped (the first MAX_REPORTED_ERRORS are reported with
+    their row number). A CSV without date or amount column, or that can not
+    be read, raises StatementError and nothing is imported. The whole file is
+    parsed before the transaction starts, the transaction only inserts the
+    staged rows (one bulk_create per chunk) and posts them to the ledger once.
+    """
+    result = ImportResult()
+    started = time.perf_counter()
+    categories = CategoryMapper(user)
+    rows = PARSERS[fmt](decoded_lines(fileobj, encoding))
+
+    with tempfile.SpooledTemporaryFile(
+        max_size=STAGE_MEMORY, mode="w+", newline="", encoding="utf-8"
+    ) as staged:
+        writer = csv.writer(staged)
+        for number, row in enumerate(rows, 1):
+            try:
+                txn = to_transaction(user, row, categories, date_format)
+            except StatementError as e:
+                result.skipped += 1
+                if len(result.errors) < MAX_REPORTED_ERRORS:
+                    result.errors.append({"row": number, "error": str(e)})
+                continue
+            writer.writerow(
+                [
+                    txn.occu_date.isoformat(),
+                    txn.amount,
+                    txn.types,
+                    txn.category_id,
+                    txn.notes,
+                ]
+            )
+        staged.seek(0)
+        _insert_staged(user, csv.reader(staged), chunk_size, result)
+
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def _insert_staged(user, staged, chunk_size, result):
+    deltas = {}
+    with transaction.atomic():
+        # one change number for the whole import, taken before the shared rows
+        change_seq = changes.next_numbers([user.id])[user.id]
+        while True:
+            chunk = [
+                Transactions(
+                    user=user,
+                    occu_date=date.fromisoformat(occu_date),
+                    amount=Decimal(amount),
+                    types=types,
+                    category_id=int(category_id),
+                    notes=notes,
+                    change_seq=change_seq,
+                )
+                for occu_date, amount, types, category_id, notes in itertools.islice(
+                    staged, chunk_size
+                )
+            ]
+            if not chunk:
+                break
+            Transactions.objects.bulk_create(chunk)
+            search.index_transactions(chunk)
+            ledger.merge_deltas(deltas, ledger.collect_deltas(added=chunk))
+            result.imported += len(chunk)
+            result.chunks += 1
+        ledger.post_deltas(deltas)
@@ -0,0 +1,516 @@
+"""
+File: ledger.py
+Author: Haitao Wang
+Date: 2024-10-04
+Description: Keep the aggregates derived from the transactions (monthly rollups) in sync
+"""
+
+import calendar
+from collections import defaultdict
+from decimal import Decimal
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+from . import search
+from .changes import next_numbers
+from .models import Budgets, MonthlyRollup, Notification, Transactions, UserTotals
+
+CENT = Decimal("0.01")
+# user ids per IN list of the row lookups
+USERS_PER_QUERY = 500
+
+
+def to_amount(value):
+    """
+    Normalise an amount (Decimal, float, str) to the 2 decimal places stored in the database.
+    """
+    return Decimal(str(value)).quantize(CENT)
+
+
+def rollup_key(entry):
+    """
+    The (user, year, month, category, types) key of a transaction or ledger entry.
+    """
+    return (
+        entry.user_id,
+        entry.occu_date.year,
+        entry.occu_date.month,
+        entry.category_id,
+        entry.types,
+    )
+
+
+def rows_of_keys(queryset, keys, key_of_row, fields, **filters):
+    """
+    Load the rows of queryset whose key_of_row(row) is in keys, the user id being the first item of a key.
+
+    The rows are read with IN lists on the user ids and filters (a superset of
+    the keys, matched here): an OR of one condition per key is slower to build
+    than to run for big batches, and SQLite refuses more than about a thousand.
+    """
+    user_ids = sorted({key[0] for key in keys})
+    rows = []
+    for offset in range(0, len(user_ids), USERS_PER_QUERY):
+        rows += queryset.filter(
+            user_id__in=user_ids[offset : offset + USERS_PER_QUERY], **filters
+        ).only(*fields)
+    return [row for row in rows if key_of_row(row) in keys]
+
+
+def increment_rows(model, increments, columns, where=None, **values):
+    """
+    Add {pk: (delta of each column)} to the columns of the rows, and set the columns of values.
+
+    where is an optional (sql, params) condition the rows must also match.
+
+    One UPDATE ... SET column = column + CASE id WHEN ... END per batch: the
+    database does the addition, so concurrent writers never lose each other's
+    increments, and nothing is built per row like bulk_update with F() does.
+    """
+    if not increments:
+        return
+    meta = model._meta
+    quote = connection.ops.quote_name
+    pk = quote(meta.pk.column)
+    condition, condition_params = where or ("", [])
+    items = list(increments.items())
+    batch_size = len(items)
+    if connection.features.max_query_params:
+        # 2 parameters per row and column (WHEN pk THEN delta), 1 for the IN
+        batch_size = (
+            connection.features.max_query_params - len(values) - len(condition_params)
+        ) // (2 * len(columns) + 1)
+    for offset in range(0, len(items), batch_size):
+        batch = items[offset : offset + batch_size]
+        assignments, params = [], []
+        for name, value in values.items():
+            field = meta.get_field(name)
+            assignments.append(f"{quote(field.column)} = %s")
+            params.append(field.get_db_prep_save(value, connection))
+        whens = " ".join(["WHEN %s THEN %s"] * len(batch))
+        for index, name in enumerate(columns):
+            column = quote(meta.get_field(name).column)
+            assignments.append(f"{column} = {column} + CASE {pk} {whens} END")
+            for key, deltas in batch:
+                params += [key, deltas[index]]
+        params += [key for key, deltas in batch]
+        sql = (
+            f"UPDATE {quote(meta.db_table)} SET {', '.join(assignments)} "
+            f"WHERE {pk} IN ({', '.join(['%s'] * len(batch))})"
+        )
+        if condition:
+            sql += f" AND {condition}"
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + condition_params)
+
+
+def rollup_key_of_row(row):
+    return (row.user_id, row.year, row.month, row.category_id, row.types)
+
+
+def collect_deltas(added=(), removed=()):
+    """
+    Fold added and removed entries into {rollup key: [amount, count]}, dropping the keys that cancel out.
+    """
+    deltas = defaultdict(lambda: [Decimal("0"), 0])
+    for entry in added:
+        delta = deltas[rollup_key(entry)]
+        delta[0] += to_amount(entry.amount)
+        delta[1] += 1
+    for entry in removed:
+        delta = deltas[rollup_key(entry)]
+        delta[0] -= to_amount(entry.amount)
+        delta[1] -= 1
+    return {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+
+
+def apply_rollup_deltas(deltas):
+    """
+    Apply {rollup key: [amount, count]} to the rollup table.
+
+    3 queries for a usual batch: insert the missing rows, load the ids, and one
+    UPDATE adding the deltas (increment_rows) so concurrent writers never
+    overwrite each other.
+    """
+    if not deltas:
+        return
+    MonthlyRollup.objects.bulk_create(
+        [
+            MonthlyRollup(
+                user_id=user_id,
+                year=year,
+                month=month,
+                category_id=category_id,
+                types=types,
+            )
+            for user_id, year, month, category_id, types in deltas
+        ],
+        ignore_conflicts=True,
+    )
+
+    rows = rows_of_keys(
+        MonthlyRollup.objects.all(),
+        deltas,
+        rollup_key_of_row,
+        ["id", "user_id", "year", "month", "category_id", "types"],
+        year__in={key[1] for key in deltas},
+        month__in={key[2] for key in deltas},
+        category_id__in={key[3] for key in deltas},
+    )
+    increment_rows(
+        MonthlyRollup,
+        {row.id: deltas[rollup_key_of_row(row)] for row in rows},
+        ["total", "count"],
+    )
+
+
+def record(added=(), removed=()):
+    """
+    Post a batch of transaction changes to the derived aggregates.
+
+    added/removed are Transactions or LedgerEntry objects, an update is the
+    removal of the old state plus the addition of the new one (so a move
+    between categories or months leaves one budget and enters the other).
+    The monthly rollups, the user totals and the spent of the monthly and
+    yearly budgets get one delta per key, then the budgets whose spent went up are
+    evaluated once for notifications. The notes of the added Transactions
+    are written to the search index. Bulk writers (bulk_create, recurring)
+    must call this once per batch, the model save and delete already do it
+    for single rows; a writer of several batches (imports) can fold them with
+    merge_deltas and call post_deltas once. Returns the created notifications.
+    """
+    deltas = collect_deltas(added, removed)
+    with transaction.atomic():
+        search.index_transactions(
+            [txn for txn in added if isinstance(txn, Transactions)]
+        )
+        return post_deltas(deltas)
+
+
+def merge_deltas(into, deltas):
+    """
+    Add the deltas of collect_deltas to ``into`` (a dict of the same shape), to post several batches at once.
+    """
+    for key, (amount, count) in deltas.items():
+        delta = into.setdefault(key, [Decimal("0"), 0])
+        delta[0] += amount
+        delta[1] += count
+    return into
+
+
+def post_deltas(deltas):
+    """
+    Apply {rollup key: [amount, count]} to the rollups, the user totals and the budgets, then notify once.
+
+    Returns the created notifications.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+    if not deltas:
+        return []
+    with transaction.atomic():
+        apply_rollup_deltas(deltas)
+        apply_total_deltas(deltas)
+        applied = apply_budget_deltas(deltas)
+        return notify_budgets(
+            [budget_id for budget_id, amount in applied.items() if amount > 0]
+        )
+
+
+def totals_of_users(user_ids, year, month):
+    """
+    Compute the UserTotals fields of users from the rollups, {user id: fields}, one grouped aggregate per USERS_PER_QUERY users.
+    """
+    this_month = Q(year=year, month=month)
+    user_ids = sorted(user_ids)
+    result = {
+        user_id: {
+            "total_income": to_amount(0),
+            "total_expenses": to_amount(0),
+            "month_income": to_amount(0),
+            "month_expenses": to_amount(0),
+            "year": year,
+            "month": month,
+        }
+        for user_id in user_ids
+    }
+    for offset in range(0, len(user_ids), USERS_PER_QUERY):
+        rows = (
+            MonthlyRollup.objects.filter(
+                user_id__in=user_ids[offset : offset + USERS_PER_QUERY]
+            )
+            .values("user_id")
+            .annotate(
+                total_income=Sum("total", filter=Q(types="income")),
+                total_expenses=Sum("total", filter=Q(types="expense")),
+                month_income=Sum("total", filter=Q(types="income") & this_month),
+                month_expenses=Sum("total", filter=Q(types="expense") & this_month),
+            )
+            .order_by()
+        )
+        for row in rows:
+            user_id = row.pop("user_id")
+            result[user_id].update(
+                {name: to_amount(value or 0) for name, value in row.items()}
+            )
+    return result
+
+
+def totals_from_rollups(user_id, year, month):
+    """
+    Compute the UserTotals fields of a user from the rollups, with one conditional aggregate.
+    """
+    return totals_of_users([user_id], year, month)[user_id]
+
+
+def create_user_totals(user_id, today):
+    """
+    Create the missing totals of a user from the rollups, None if another transaction created them.
+    """
+    try:
+        with transaction.atomic():
+            return UserTotals.objects.create(
+                user_id=user_id, **totals_from_rollups(user_id, today.year, today.month)
+            )
+    except IntegrityError:
+        return None
+
+
+def create_users_totals(user_ids, today):
+    """
+    Create the missing totals of users from the rollups, return the ids whose totals another transaction created.
+
+    One grouped aggregate and one insert; if a row was created concurrently the
+    users are created one by one to find out which.
+    """
+    totals = totals_of_users(user_ids, today.year, today.month)
+    try:
+        with transaction.atomic():
+            UserTotals.objects.bulk_create(
+                [UserTotals(user_id=user_id, **totals[user_id]) for user_id in user_ids]
+            )
+        return []
+    except IntegrityError:
+        return [
+            user_id
+            for user_id in user_ids
+            if create_user_totals(user_id, today) is None
+        ]
+
+
+def apply_total_deltas(deltas):
+    """
+    Add the deltas to the lifetime and current month totals of the users, one UPDATE for the batch.
+
+    The month counters only move when the row is on the current month, a row
+    left on an older month is rolled over from the rollups by user_totals.
+    Users without totals yet get them computed from the rollups, which
+    already contain this batch.
+    """
+    today = timezone.localdate()
+    changes = defaultdict(lambda: defaultdict(Decimal))
+    for (user_id, year, month, category_id, types), (amount, count) in deltas.items():
+        if not amount:
+            continue
+        income = types == "income"
+        changes[user_id]["total_income" if income else "total_expenses"] += amount
+        if (year, month) == (today.year, today.month):
+            changes[user_id]["month_income" if income else "month_expenses"] += amount
+    if not changes:
+        return
+
+    user_ids = sorted(changes)
+    existing = set()
+    for offset in range(0, len(user_ids), USERS_PER_QUERY):
+        existing.update(
+            UserTotals.objects.filter(
+                user_id__in=user_ids[offset : offset + USERS_PER_QUERY]
+            ).values_list("user_id", flat=True)
+        )
+    missing = [user_id for user_id in user_ids if user_id not in existing]
+    if missing:
+        # created concurrently without this batch, they get the deltas below
+        existing.update(create_users_totals(missing, today))
+
+    increment_rows(
+        UserTotals,
+        {
+            user_id: (
+                changes[user_id]["total_income"],
+                changes[user_id]["total_expenses"],
+            )
+            for user_id in existing
+        },
+        ["total_income", "total_expenses"],
+    )
+    increment_rows(
+        UserTotals,
+        {
+            user_id: (
+                changes[user_id]["month_income"],
+                changes[user_id]["month_expenses"],
+            )
+            for user_id in existing
+            if "month_income" in changes[user_id]
+            or "month_expenses" in changes[user_id]
+        },
+        ["month_income", "month_expenses"],
+        where=(
+            f"{connection.ops.quote_name('year')} = %s AND "
+            f"{connection.ops.quote_name('month')} = %s",
+            [today.year, today.month],
+        ),
+    )
+
+
+def user_totals(user):
+    """
+    Return the UserTotals of the user, creating or rolling over the month counters if needed.
+
+    The common case is one primary key lookup, whatever the number of
+    transactions of the user.
+    """
+    today = timezone.localdate()
+    totals = UserTotals.objects.filter(user_id=user.id).first()
+    if totals is None:
+        return create_user_totals(user.id, today) or UserTotals.objects.get(
+            user_id=user.id
+        )
+    if (totals.year, totals.month) == (today.year, today.month):
+        return totals
+
+    with transaction.atomic():
+        # the lock makes concurrent writers wait, the rollups read below see their deltas
+        totals = UserTotals.objects.select_for_update().get(user_id=user.id)
+        if (totals.year, totals.month) != (today.year, today.month):
+            fields = totals_from_rollups(user.id, today.year, today.month)
+            for name in ("year", "month", "month_income", "month_expenses"):
+                setattr(totals, name, fields[name])
+            totals.save(
+                update_fields=["year", "month", "month_income", "month_expenses"]
+            )
+    return totals
+
+
+def rollups_from_transactions(transactions):
+    """
+    Recompute {rollup key: [amount, count]} from a Transactions queryset with one grouped query.
+    """
+    rows = (
+        transactions.annotate(
+            year=ExtractYear("occu_date"), month=ExtractMonth("occu_date")
+        )
+        .values("user_id", "year", "month", "category_id", "types")
+        .annotate(sum_amount=Sum("amount"), row_count=Count("id"))
+        .order_by()
+    )
+    return {
+        (
+            row["user_id"],
+            row["year"],
+            row["month"],
+            row["category_id"],
+            row["types"],
+        ): [row["sum_amount"], row["row_count"]]
+        for row in rows.iterator()
+    }
+
+
+def budget_deltas(deltas):
+    """
+    Turn rollup deltas into {(user, category, period_type, year, month): amount} for the expense budgets.
+
+    Every expense month counts for its monthly budget and for the yearly budget
+    of its year (month is None in the yearly key).
+    """
+    result = defaultdict(Decimal)
+    for (user_id, year, month, category_id, types), (amount, count) in deltas.items():
+        if types != "expense" or not amount:
+            continue
+        result[(user_id, category_id, "monthly", year, month)] += amount
+        result[(user_id, category_id, "yearly", year, None)] += amount
+    return result
+
+
+def budget_key(budget):
+    month = budget.month if budget.period_type == "monthly" else None
+    return (budget.user_id, budget.category_id, budget.period_type, budget.year, month)
+
+
+def apply_budget_deltas(deltas):
+    """
+    Add the expense deltas to the spent of the matching budgets, one delta per (budget, period).
+
+    The increment is done by the database (spent = spent + delta), so
+    concurrent writers never lose each other's updates. 2 queries for a usual
+    batch, returns {budget id: delta} of the updated budgets.
+    """
+    changes = budget_deltas(deltas)
+    if not changes:
+        return {}
+    budgets = rows_of_keys(
+        Budgets.objects.all(),
+        changes,
+        budget_key,
+        ["id", "user_id", "category_id", "period_type", "year", "month"],
+        year__in={key[3] for key in changes},
+        category_id__in={key[1] for key in changes},
+    )
+    applied = {budget.id: changes[budget_key(budget)] for budget in budgets}
+    by_user = defaultdict(dict)
+    for budget in budgets:
+        by_user[budget.user_id][budget.id] = (applied[budget.id],)
+    # a change number too, the sync endpoint must see the new spent (the
+    # writer already holds the counters, nothing waits here)
+    numbers = next_numbers(by_user)
+    now = timezone.now()
+    for user_id, increments in by_user.items():
+        increment_rows(
+            Budgets,
+            increments,
+            ["spent"],
+            updated_at=now,
+            change_seq=numbers[user_id],
+        )
+    return applied
+
+
+def budget_notification(budget):
+    """
+    Return the (unsaved) notification for a budget that is 90% or more spent, None otherwise.
+    """
+    if not budget.limits:
+        return None
+    if budget.period_type == "monthly" and budget.month:
+        period = calendar.month_name[budget.month]
+    else:
+        period = str(budget.year)
+    per = budget.spent / budget.limits
+    if per >= 1:
+        return Notification(
+            user_id=budget.user_id,
+            notify=f"{budget.category.name} budget has been overspent for {period}. ",
+            types="warning",
+        )
+    if per >= 0.9:
+        return Notification(
+            user_id=budget.user_id,
+            notify=f"{per*100}% of the {period} {budget.category.name} budget has been spent. ",
+            types="info",
+        )
+    return None
+
+
+def notify_budgets(budget_ids):
+    """
+    Evaluate the budgets once (after a whole batch) and create their notifications, 2 queries.
+    """
+    if not budget_ids:
+        return []
+    budgets = Budgets.objects.filter(id__in=budget_ids).select_related("category")
+    notifications = [
+        notification
+        for notification in map(budget_notification, budgets)
+        if notification is not None
+    ]
+    return Notification.objects.bulk_create(notifications)
@@ -0,0 +1,93 @@
+"""
+File: _benchmark.py
+Author: Haitao Wang
+Date: 2024-10-08
+Description: Shared helpers of the benchmark commands (seeding, timing), not a command itself
+"""
+
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from finance.models import Categories, Transactions
+
+User = get_user_model()
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def scratch_data():
+    """
+    Run the block in a transaction that is always rolled back, the seeded rows never persist.
+    """
+    try:
+        with transaction.atomic():
+            yield
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+
+def seed_transactions(rows, years=3, username="benchmark_user", seed=0, notes=None):
+    """
+    Create a user with ``rows`` random transactions spread over the last ``years`` years.
+
+    Rows are inserted with bulk_create, the caller decides if the derived
+    aggregates matter for what is measured. ``notes(rng, i)`` builds the notes
+    of row i (default "benchmark row i").
+    """
+    rng = random.Random(seed)
+    user = User.objects.create(username=username, email=f"{username}@example.com")
+    categories = list(Categories.objects.filter(user__isnull=True))
+    if not categories:
+        categories = [
+            Categories.objects.create(name="Food", category_type="expense"),
+            Categories.objects.create(name="Salary", category_type="income"),
+        ]
+    first_day = date.today() - timedelta(days=365 * years)
+    batch = []
+    for i in range(rows):
+        category = rng.choice(categories)
+        batch.append(
+            Transactions(
+                user=user,
+                types=category.category_type,
+                amount=Decimal(rng.randint(100, 50000)) / 100,
+                category=category,
+                occu_date=first_day + timedelta(days=rng.randint(0, 365 * years)),
+                notes=notes(rng, i) if notes else f"benchmark row {i}",
+            )
+        )
+        if len(batch) == 5000:
+            Transactions.objects.bulk_create(batch)
+            batch = []
+    Transactions.objects.bulk_create(batch)
+    analyze()
+    return user
+
+
+def analyze():
+    """
+    Refresh the planner statistics after seeding.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+
+def timed(fn, repeat=20):
+    """
+    Run ``fn`` ``repeat`` times and return (median, best) in milliseconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), min(samples)
@@ -0,0 +1,74 @@
+"""
+File: benchmark_date_filters.py
+Author: Haitao Wang
+Date: 2024-10-08
+Description: Use Django management command to compare EXTRACT based and range based date filters
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+from finance.models import Transactions
+from finance.periods import in_range, month_range
+from ._benchmark import scratch_data, seed_transactions, timed
+
+
+class Command(BaseCommand):
+    help = "Seed a dataset (rolled back afterwards) and compare the query plans and timings of the date filters"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100000)
+        parser.add_argument("--years", type=int, default=3)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with scratch_data():
+            user = seed_transactions(options["rows"], options["years"])
+            # a few other users, so the user prefix of the indexes is selective
+            for i in range(3):
+                seed_transactions(
+                    options["rows"] // 4,
+                    options["years"],
+                    username=f"benchmark_other{i}",
+                    seed=i + 1,
+                )
+            sample = Transactions.objects.filter(user=user).first()
+            year, month = sample.occu_date.year, sample.occu_date.month
+            extracted = Transactions.objects.annotate(
+                year=ExtractYear("occu_date"), month=ExtractMonth("occu_date")
+            )
+            month_filter = in_range(*month_range(year, month))
+
+            self.compare(
+                "budget spent (user, category, month)",
+                extracted.filter(
+                    user=user, category_id=sample.category_id, year=year, month=month
+                ),
+                Transactions.objects.filter(
+                    user=user, category_id=sample.category_id, **month_filter
+                ),
+                options["repeat"],
+            )
+            self.compare(
+                "monthly income (user, types, month)",
+                extracted.filter(user=user, types="income", year=year, month=month),
+                Transactions.objects.filter(user=user, types="income", **month_filter),
+                options["repeat"],
+            )
+
+    def compare(self, title, before, after, repeat):
+        """
+        Print the plan and timing of the EXTRACT filter (before) and the range filter (after).
+        """
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        results = []
+        for label, queryset in (("before, EXTRACT", before), ("after, range", after)):
+            results.append(queryset.aggregate(total=Sum("amount"))["total"])
+            median, best = timed(
+                lambda: queryset.aggregate(total=Sum("amount")), repeat
+            )
+            self.stdout.write(f"  {label}: median {median:.2f} ms, best {best:.2f} ms")
+            for line in queryset.only("amount").explain().splitlines():
+                self.stdout.write(f"    {line}")
+        if results[0] != results[1]:
+            self.stdout.write(self.style.ERROR(f"  results differ: {results}"))
@@ -0,0 +1,117 @@
+"""
+File: benchmark_receipt_images.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to compare the receipt image preprocessing before and after the single decode
+
+Every measurement runs in a fresh process, so the peak memory (VmHWM above
+the resident size at the start, Linux only) belongs to that preprocessing
+alone, not to memory the allocators kept from earlier runs. CPU time and peak
+memory are reported per megapixel of the upload.
+"""
+
+import multiprocessing
+import time
+from io import BytesIO
+from PIL import Image
+from django.core.management.base import BaseCommand
+from finance.receipt_image import prepare_receipt
+
+
+def old_prepare(data):
+    """
+    The preprocessing of process_receipt before prepare_receipt: verify, reopen, thumbnail, re-encode.
+    """
+    image = Image.open(BytesIO(data))
+    image.verify()
+    image = Image.open(BytesIO(data))
+    image.thumbnail((1024, 1024))
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+VARIANTS = [("before", old_prepare), ("single decode", prepare_receipt)]
+
+
+def photo(megapixels, format="JPEG"):
+    """
+    A 4:3 photo-like image (gradient and grain) of about ``megapixels``, encoded as an upload.
+    """
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = height * 4 // 3
+    gradient = Image.linear_gradient("L").resize((width, height))
+    grain = Image.effect_noise((width, height), 24)
+    image = Image.merge("RGB", (gradient, Image.blend(gradient, grain, 0.3), grain))
+    buffered = BytesIO()
+    image.save(buffered, format=format, quality=90)
+    return buffered.getvalue()
+
+
+def memory_kb(field):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn, data, repeat, results):
+    """
+    Child side: run fn(data) repeat times, put (CPU seconds per run, peak KB above the start).
+    """
+    try:
+        # reset the peak resident size of this process
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+    start_rss = memory_kb("VmRSS")
+    started = time.process_time()
+    for _ in range(repeat):
+        fn(data)
+    cpu = (time.process_time() - started) / repeat
+    peak = memory_kb("VmHWM")
+    results.put((cpu, None if peak is None else peak - start_rss))
+
+
+class Command(BaseCommand):
+    help = "Time the receipt image preprocessing (CPU and peak memory per megapixel), before and after the single decode"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--megapixels",
+            default="0.3,1,3,8,12,24",
+            help="comma separated sizes of the uploads",
+        )
+        parser.add_argument("--format", default="JPEG", choices=["JPEG", "PNG"])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        self.stdout.write(
+            f"{'upload':>16} {'variant':>14} {'ms':>8} {'ms/MP':>7} "
+            f"{'peak MB':>8} {'MB/MP':>6} {'out KB':>7}"
+        )
+        for megapixels in [float(m) for m in options["megapixels"].split(",")]:
+            data = photo(megapixels, options["format"])
+            for name, fn in VARIANTS:
+                results = context.Queue()
+                child = context.Process(
+                    target=measure, args=(fn, data, options["repeat"], results)
+                )
+                child.start()
+                cpu, peak = results.get()
+                child.join()
+                out = len(fn(data))
+                peak_mb = "-" if peak is None else f"{peak / 1024:.1f}"
+                per_mp = "-" if peak is None else f"{peak / 1024 / megapixels:.2f}"
+                self.stdout.write(
+                    f"{megapixels:>5} MP {options['format']:>4} "
+                    f"{len(data) // 1024:>4}K {name:>14} {cpu * 1000:>8.1f} "
+                    f"{cpu * 1000 / megapixels:>7.1f} {peak_mb:>8} {per_mp:>6} "
+                    f"{out // 1024:>7}"
+                )
@@ -0,0 +1,146 @@
+"""
+File: benchmark_receipts.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to load test the local receipt backend
+
+The receipts go through LocalReceiptBackend with the simulated extractor (a
+decode, some CPU and a wait standing for the model call), so the queue depth,
+the throughput and the tail latency of the worker pool are measured without
+AWS or OpenAI. The tasks are committed (the workers complete them from another
+thread), the benchmark user and its tasks are deleted at the end.
+"""
+
+import statistics
+import time
+from functools import partial
+from io import BytesIO
+from PIL import Image, ImageDraw
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from finance.models import ReceiptTask
+from finance.receipt_backends import LocalReceiptBackend
+from finance.receipt_extract import simulated_extract
+
+User = get_user_model()
+
+# seconds between two samples of the queue depth
+SAMPLE_INTERVAL = 0.05
+
+
+def receipt_image(width=1024, height=1400):
+    """
+    A receipt-like JPEG: lines of dark marks on white, the size process_receipt sends.
+    """
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(40, height - 40, 36):
+        draw.rectangle((40, y, 40 + (y * 7) % (width - 120), y + 14), fill="black")
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+class Command(BaseCommand):
+    help = "Push receipts through the local receipt backend and report queue depth, throughput and latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tasks", type=int, default=200)
+        parser.add_argument(
+            "--workers", type=int, default=None, help="default RECEIPT_LOCAL_WORKERS"
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="receipts submitted per second, 0 submits them all at once",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.5,
+            help="seconds of the simulated model call",
+        )
+        parser.add_argument(
+            "--cpu", type=float, default=0.05, help="CPU seconds per receipt"
+        )
+
+    def handle(self, *args, **options):
+        backend = LocalReceiptBackend(
+            extractor=partial(
+                simulated_extract, latency=options["latency"], cpu=options["cpu"]
+            ),
+            workers=options["workers"],
+        )
+        image = receipt_image()
+        user = User.objects.create(
+            username="benchmark_receipts", email="benchmark_receipts@example.com"
+        )
+        try:
+            # workers started before the clock, their spawn is not the receipts' latency
+            backend.executor().submit(int).result()
+            depths = self.run(backend, user, image, options)
+            self.report(backend, user, depths, options)
+        finally:
+            backend.shutdown()
+            user.delete()
+
+    def run(self, backend, user, image, options):
+        """
+        Submit the receipts at the rate and wait for all of them, return the sampled queue depths.
+        """
+        depths = []
+        next_sample = time.perf_counter()
+        started = time.perf_counter()
+        for i in range(options["tasks"]):
+            if options["rate"]:
+                time.sleep(max(0, started + i / options["rate"] - time.perf_counter()))
+            backend.submit(user, image)
+            if time.perf_counter() >= next_sample:
+                depths.append(backend.stats()["queue_depth"])
+                next_sample += SAMPLE_INTERVAL
+        while True:
+            stats = backend.stats()
+            depths.append(stats["queue_depth"])
+            if stats["completed"] + stats["failed"] >= options["tasks"]:
+                return depths
+            time.sleep(SAMPLE_INTERVAL)
+
+    def report(self, backend, user, depths, options):
+        stats = backend.stats()
+        tasks = list(
+            ReceiptTask.objects.filter(user=user, status="completed").values(
+                "create_time", "started_at", "finished_at"
+            )
+        )
+        latencies = [
+            (t["finished_at"] - t["create_time"]).total_seconds() for t in tasks
+        ]
+        waits = [(t["started_at"] - t["create_time"]).total_seconds() for t in tasks]
+        span = (
+            max(t["finished_at"] for t in tasks) - min(t["create_time"] for t in tasks)
+        ).total_seconds()
+
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"{options['tasks']} receipts, {stats['workers']} workers, "
+                f"{options['latency']} s wait + {options['cpu']} s CPU each"
+            )
+        )
+        self.stdout.write(
+            f"  completed {stats['completed']}, failed {stats['failed']}, "
+            f"throughput {len(tasks) / span:.1f} receipts/s"
+        )
+        self.stdout.write(
+            f"  queue depth: max {max(depths)}, mean {statistics.mean(depths):.1f}"
+        )
+        for name, values in (("latency", latencies), ("queue wait", waits)):
+            self.stdout.write(
+                f"  {name}: p50 {percentile(values, 50):.2f} s, "
+                f"p95 {percentile(values, 95):.2f} s, "
+                f"p99 {percentile(values, 99):.2f} s, max {max(values):.2f} s"
+            )
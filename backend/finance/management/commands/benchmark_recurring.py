@@ -0,0 +1,157 @@
+"""
+File: benchmark_recurring.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to time the materialization of the recurring rules
+"""
+
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.core.management.base import BaseCommand
+from finance.models import Budgets, Categories, RecurringRule, Transactions
+from finance.recurring import due_dates, materialize_due
+from ._benchmark import analyze, scratch_data
+
+User = get_user_model()
+
+# frequency, interval, weight: mostly monthly bills and salaries
+SCHEDULES = [("monthly", 1, 6), ("weekly", 1, 2), ("weekly", 2, 1), ("yearly", 1, 1)]
+
+
+class Command(BaseCommand):
+    help = "Seed recurring rules with a backlog (rolled back afterwards) and time their materialization"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rules", type=int, default=100000)
+        parser.add_argument("--rules-per-user", type=int, default=20)
+        parser.add_argument(
+            "--backlog-days",
+            type=int,
+            default=90,
+            help="days since the rules were last materialized (a downtime)",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--baseline-rules",
+            type=int,
+            default=1000,
+            help="rules materialized one Transactions.save() at a time, for comparison",
+        )
+
+    def handle(self, *args, **options):
+        with scratch_data():
+            self.stdout.write(f"seeding {options['rules']} rules ...")
+            self.seed(options)
+            analyze()
+
+            if options["baseline_rules"]:
+                self.baseline(options)
+
+            result = materialize_due(batch_size=options["batch_size"])
+            self.stdout.write(self.style.MIGRATE_HEADING("bulk, batch by batch"))
+            self.stdout.write(
+                f"  {result.rules} rules, {result.created} transactions in "
+                f"{result.batches} batches: {result.seconds:.2f} s, "
+                f"{result.created / result.seconds:.0f} transactions/s"
+            )
+
+            again = materialize_due(batch_size=options["batch_size"])
+            self.stdout.write(self.style.MIGRATE_HEADING("second run (nothing due)"))
+            self.stdout.write(
+                f"  {again.rules} rules, {again.created} transactions: "
+                f"{again.seconds * 1000:.1f} ms"
+            )
+
+    def seed(self, options):
+        rng = random.Random(0)
+        today = date.today()
+        categories = list(Categories.objects.filter(user__isnull=True))
+        if not categories:
+            categories = [
+                Categories.objects.create(name="Rent", category_type="expense"),
+                Categories.objects.create(name="Salary", category_type="income"),
+            ]
+        expenses = [c for c in categories if c.category_type == "expense"]
+        schedules = [s for s in SCHEDULES for _ in range(s[2])]
+
+        users = User.objects.bulk_create(
+            User(
+                username=f"benchmark_rules{i}", email=f"benchmark_rules{i}@example.com"
+            )
+            for i in range(-(-options["rules"] // options["rules_per_user"]))
+        )
+        rules = []
+        for i in range(options["rules"]):
+            user = users[i // options["rules_per_user"]]
+            category = rng.choice(categories)
+            frequency, interval, _ = rng.choice(schedules)
+            start = today - timedelta(days=rng.randint(365, 730))
+            rule = RecurringRule(
+                user=user,
+                category=category,
+                types=category.category_type,
+                amount=Decimal(rng.randint(500, 250000)) / 100,
+                notes=f"benchmark rule {i}",
+                frequency=frequency,
+                interval=interval,
+                start_date=start,
+            )
+            # the rules were up to date before the downtime
+            rule.next_date = start
+            _, rule.next_date = due_dates(
+                rule, today - timedelta(days=options["backlog_days"])
+            )
+            rules.append(rule)
+        RecurringRule.objects.bulk_create(rules, batch_size=5000)
+        # a budget per user, so that the spent deltas are part of the cost
+        Budgets.objects.bulk_create(
+            (
+                Budgets(
+                    user=user,
+                    category=rng.choice(expenses),
+                    limits=1000,
+                    period_type="monthly",
+                    year=today.year,
+                    month=today.month,
+                )
+                for user in users
+            ),
+            batch_size=5000,
+        )
+
+    def baseline(self, options):
+        """
+        The naive scheduler: one save per occurrence, each posting its own ledger update.
+        """
+        today = date.today()
+        rules = list(RecurringRule.objects.order_by("-id")[: options["baseline_rules"]])
+        created = 0
+        started = time.perf_counter()
+        with transaction.atomic():
+            for rule in rules:
+                dates, next_date = due_dates(rule, today)
+                for day in dates:
+                    Transactions(
+                        user_id=rule.user_id,
+                        category_id=rule.category_id,
+                        types=rule.types,
+                        amount=rule.amount,
+                        occu_date=day,
+                        notes=rule.notes,
+                        recurring_rule=rule,
+                    ).save()
+                    created += 1
+                rule.next_date = next_date
+                rule.save(update_fields=["next_date"])
+        seconds = time.perf_counter() - started
+        self.stdout.write(self.style.MIGRATE_HEADING("before: one save per occurrence"))
+        self.stdout.write(
+            f"  {len(rules)} rules, {created} transactions: {seconds:.2f} s, "
+            f"{created / seconds:.0f} transactions/s, "
+            f"{seconds * options['rules'] / len(rules):.0f} s extrapolated to "
+            f"{options['rules']} rules"
+        )
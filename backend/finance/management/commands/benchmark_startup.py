@@ -0,0 +1,148 @@
+"""
+File: benchmark_startup.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to time the cold start of the WSGI app
+
+Every run is a fresh interpreter (python -X importtime), like a cold serverless
+instance: it imports the WSGI_APPLICATION module, then serves its first and
+second request. The first request also loads the URLconf and every view, the
+second one is the warm cost. The import times of the modules are read from the
+-X importtime report of the median run.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+CHILD = """
+import importlib, io, json, sys, time
+from wsgiref.util import setup_testing_defaults
+
+started = time.perf_counter()
+module, name = sys.argv[1].rsplit(".", 1)
+app = getattr(importlib.import_module(module), name)
+imported = time.perf_counter()
+
+
+def request(path):
+    environ = {"PATH_INFO": path, "wsgi.input": io.BytesIO()}
+    setup_testing_defaults(environ)
+    status = []
+    body = app(environ, lambda code, headers, exc_info=None: status.append(code))
+    b"".join(body)
+    return status[0]
+
+
+code = request(sys.argv[2])
+first = time.perf_counter()
+request(sys.argv[2])
+second = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "first": first - imported,
+    "second": second - first,
+    "status": code,
+}))
+"""
+
+
+def parse_importtime(report):
+    """
+    Return {module: (self us, cumulative us)} of a -X importtime report.
+    """
+    modules = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "| cumulative |" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+
+class Command(BaseCommand):
+    help = "Time the import of the WSGI app, its first request and the import time per module, in fresh processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument(
+            "--path", default="/categories/", help="path of the requests"
+        )
+        parser.add_argument(
+            "--top", type=int, default=15, help="number of packages and modules listed"
+        )
+
+    def run_child(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [str(settings.BASE_DIR), env.get("PYTHONPATH")])
+        )
+        child = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                CHILD,
+                settings.WSGI_APPLICATION,
+                self.path,
+            ],
+            capture_output=True,
+            text=True,
+            cwd=settings.BASE_DIR,
+            env=env,
+            check=True,
+        )
+        return json.loads(child.stdout.splitlines()[-1]), child.stderr
+
+    def handle(self, *args, **options):
+        self.path = options["path"]
+        runs = sorted(
+            (self.run_child() for _ in range(options["runs"])),
+            key=lambda run: run[0]["import"] + run[0]["first"],
+        )
+        timings = [timing for timing, _ in runs]
+        self.stdout.write(
+            f"{settings.WSGI_APPLICATION}, {options['runs']} fresh processes, "
+            f"GET {self.path} -> {timings[0]['status']}"
+        )
+        for label, key in [
+            ("import WSGI app", "import"),
+            ("first request", "first"),
+            ("second request", "second"),
+        ]:
+            values = [timing[key] * 1000 for timing in timings]
+            self.stdout.write(
+                f"{label:>17}: median {statistics.median(values):8.1f} ms, "
+                f"min {min(values):8.1f} ms"
+            )
+        total = [(timing["import"] + timing["first"]) * 1000 for timing in timings]
+        self.stdout.write(
+            f"{'to first response':>17}: median {statistics.median(total):8.1f} ms"
+        )
+
+        # the import report of the median run
+        modules = parse_importtime(runs[len(runs) // 2][1])
+        packages = defaultdict(int)
+        for name, (own, _) in modules.items():
+            packages[name.split(".")[0]] += own
+        self.stdout.write("\nimport time per package (sum of the module self times)")
+        for name, own in sorted(packages.items(), key=lambda item: -item[1])[
+            : options["top"]
+        ]:
+            self.stdout.write(f"{own / 1000:8.1f} ms  {name}")
+        self.stdout.write("\nimport time per project module (cumulative)")
+        project = [
+            (name, cumulative)
+            for name, (_, cumulative) in modules.items()
+            if name.split(".")[0] in ("finance", "backend")
+        ]
+        for name, cumulative in sorted(project, key=lambda item: -item[1])[
+            : options["top"]
+        ]:
+            self.stdout.write(f"{cumulative / 1000:8.1f} ms  {name}")
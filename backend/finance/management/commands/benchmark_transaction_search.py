@@ -0,0 +1,93 @@
+"""
+File: benchmark_transaction_search.py
+Author: Haitao Wang
+Date: 2024-10-17
+Description: Use Django management command to time the transaction list filters and the notes search
+"""
+
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand
+from finance.search import filter_transactions, rebuild_index
+from finance.models import Transactions
+from ._benchmark import scratch_data, seed_transactions, timed
+
+WORDS = (
+    "groceries coffee rent salary fuel parking pharmacy dinner lunch taxi "
+    "cinema gym insurance electricity water internet phone books clothes gift "
+    "bakery market refund bonus transfer subscription repair ticket hotel flight"
+).split()
+PAGE = 51  # page size + 1, what the keyset pagination fetches
+
+
+def random_notes(rng, i):
+    return f"{' '.join(rng.sample(WORDS, 3))} #{i}"
+
+
+class Command(BaseCommand):
+    help = "Seed a dataset (rolled back afterwards) and time the list filters and the full-text search"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--years", type=int, default=3)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with scratch_data():
+            self.stdout.write(f"seeding {options['rows']} rows ...")
+            user = seed_transactions(
+                options["rows"], options["years"], notes=random_notes
+            )
+            # other users with the same words, the search must not pay for their rows
+            for i in range(3):
+                seed_transactions(
+                    options["rows"] // 4,
+                    options["years"],
+                    username=f"benchmark_other{i}",
+                    seed=i + 1,
+                    notes=random_notes,
+                )
+            # the seeding bulk_create skips the ledger, index the notes at once
+            rebuild_index()
+            sample = Transactions.objects.filter(user=user).first()
+            # the "#<row number>" of the notes, one row has it
+            rare = sample.notes.split()[-1]
+            today = date.today()
+            base = Transactions.objects.filter(user=user).order_by("-occu_date", "-id")
+
+            cases = [
+                ("first page, no filter", {}),
+                ("last 30 days", {"start_date": today - timedelta(days=30)}),
+                ("category", {"category": [sample.category_id]}),
+                ("type and amount range", {"types": "expense", "min_amount": 100}),
+                ("search, common word", {"search": "coffee"}),
+                ("search, prefix", {"search": "pharm"}),
+                ("search, two words", {"search": "taxi hotel"}),
+                ("search, rare (one row)", {"search": rare}),
+                (
+                    "search + date range",
+                    {"search": "rent", "start_date": today - timedelta(days=90)},
+                ),
+            ]
+            for title, filters in cases:
+                self.run_case(
+                    title, filter_transactions(base, filters, user.id), options
+                )
+
+            # before: what the search costs without the full-text index, a
+            # common word stops early, a rare one scans all the user's rows
+            for title, word in (
+                ("search, common word, icontains scan", "coffee"),
+                ("search, rare, icontains scan", rare),
+            ):
+                self.run_case(title, base.filter(notes__icontains=word), options)
+
+    def run_case(self, title, queryset, options):
+        page = queryset[:PAGE]
+        rows = len(list(page))
+        # a fresh clone per run, the sliced queryset caches its rows
+        median, best = timed(lambda: list(page.all()), options["repeat"])
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(f"  {rows} rows: median {median:.2f} ms, best {best:.2f} ms")
+        if options["verbosity"] >= 2:
+            for line in page.explain().splitlines():
+                self.stdout.write(f"    {line}")
@@ -0,0 +1,75 @@
+"""
+File: import_statement.py
+Author: Haitao Wang
+Date: 2024-10-14
+Description: Use Django management command to import a bank statement file for a user
+"""
+
+import tracemalloc
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from finance.importers import (
+    FORMATS,
+    StatementError,
+    detect_format,
+    import_statement,
+)
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Stream a CSV/OFX/QIF statement into a user's transactions and report the throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--user", type=int, required=True)
+        parser.add_argument("--format", choices=FORMATS)
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--date-format")
+        parser.add_argument("--encoding", default="utf-8-sig")
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="report the peak python memory of the import (slower)",
+        )
+
+    def handle(self, *args, **options):
+        fmt = options["format"] or detect_format(options["path"])
+        if fmt is None:
+            raise CommandError("Unknown statement format, pass --format")
+        try:
+            user = User.objects.get(pk=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user with id {options['user']}")
+
+        if options["trace_memory"]:
+            tracemalloc.start()
+        try:
+            with open(options["path"], "rb") as statement:
+                result = import_statement(
+                    user,
+                    statement,
+                    fmt,
+                    chunk_size=options["chunk_size"],
+                    date_format=options["date_format"],
+                    encoding=options["encoding"],
+                )
+        except StatementError as e:
+            raise CommandError(str(e))
+        finally:
+            if options["trace_memory"]:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        for error in result.errors:
+            self.stdout.write(f"row {error['row']}: {error['error']}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{result.imported} rows imported in {result.chunks} chunks, "
+                f"{result.skipped} skipped, {result.seconds:.2f} s, "
+                f"{result.rows_per_second:.0f} rows/s"
+            )
+        )
+        if options["trace_memory"]:
+            self.stdout.write(f"peak memory {peak / 1024 / 1024:.1f} MiB")
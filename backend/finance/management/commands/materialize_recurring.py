@@ -0,0 +1,39 @@
+"""
+File: materialize_recurring.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to create the due transactions of the recurring rules
+
+Meant to run from a scheduler (cron) once a day or more often, running it
+again or after a downtime only creates the occurrences that are missing.
+"""
+
+from datetime import date
+from django.core.management.base import BaseCommand
+from finance.recurring import materialize_due
+
+
+class Command(BaseCommand):
+    help = "Create the transactions of the recurring rules due up to a date, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--until",
+            type=date.fromisoformat,
+            help="materialize the occurrences up to this date (YYYY-MM-DD), default today",
+        )
+        parser.add_argument("--user", type=int, help="only the rules of this user")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        result = materialize_due(
+            until=options["until"],
+            batch_size=options["batch_size"],
+            user_id=options["user"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{result.rules} rules due, {result.created} transactions created "
+                f"in {result.batches} batches, {result.seconds:.2f} s"
+            )
+        )
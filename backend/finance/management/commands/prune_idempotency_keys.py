@@ -0,0 +1,19 @@
+"""
+File: prune_idempotency_keys.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to delete the expired Idempotency-Keys
+"""
+
+from django.core.management.base import BaseCommand
+from finance.idempotency import prune_keys
+
+
+class Command(BaseCommand):
+    help = "Delete the Idempotency-Keys older than IDEMPOTENCY_KEY_TTL and the timed out locks"
+
+    def handle(self, *args, **options):
+        deleted = prune_keys()
+        self.stdout.write(
+            self.style.SUCCESS(f"{deleted} expired Idempotency-Keys deleted")
+        )
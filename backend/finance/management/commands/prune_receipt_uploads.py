@@ -0,0 +1,19 @@
+"""
+File: prune_receipt_uploads.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to delete the receipt uploads past the dedupe TTL
+"""
+
+from django.core.management.base import BaseCommand
+from finance.receipt_dedupe import prune_uploads
+
+
+class Command(BaseCommand):
+    help = "Delete the receipt uploads older than RECEIPT_DEDUPE_TTL"
+
+    def handle(self, *args, **options):
+        deleted = prune_uploads()
+        self.stdout.write(
+            self.style.SUCCESS(f"{deleted} expired receipt uploads deleted")
+        )
@@ -0,0 +1,22 @@
+"""
+File: prune_tombstones.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Use Django management command to delete the expired tombstones of the delta sync
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from finance.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = "Delete the tombstones older than SYNC_TOMBSTONE_DAYS"
+
+    def handle(self, *args, **options):
+        deleted = prune_tombstones()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{deleted} tombstones older than {settings.SYNC_TOMBSTONE_DAYS} days deleted"
+            )
+        )
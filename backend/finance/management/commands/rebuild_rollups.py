@@ -0,0 +1,139 @@
+"""
+File: rebuild_rollups.py
+Author: Haitao Wang
+Date: 2024-10-04
+Description: Use Django management command to rebuild or verify the monthly rollups from the transactions
+
+The expected rollups and the stored ones are read in one snapshot, and the
+repair is applied as a delta (total = total + drift, count = count + drift)
+like the ledger writes, so transactions written while the command runs are
+not lost: their own ledger deltas land on top of the repaired value. The user
+totals are then recomputed from the repaired rollups with the totals rows
+locked, a concurrent ledger write waits and adds its delta afterwards.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from finance.cache import bump_data_version
+from finance.ledger import (
+    USERS_PER_QUERY,
+    apply_rollup_deltas,
+    rollup_key_of_row,
+    rollups_from_transactions,
+    to_amount,
+    totals_of_users,
+)
+from finance.models import MonthlyRollup, Transactions, UserTotals
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or only verify with --verify) the monthly rollups from the raw transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", type=int, help="only process the user with this id"
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="report the differences without writing anything",
+        )
+
+    def handle(self, *args, **options):
+        transactions = Transactions.objects.all()
+        rollups = MonthlyRollup.objects.all()
+        totals = UserTotals.objects.all()
+        if options["user"]:
+            transactions = transactions.filter(user_id=options["user"])
+            rollups = rollups.filter(user_id=options["user"])
+            totals = totals.filter(user_id=options["user"])
+
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                # the transactions and the rollups must be read from the same snapshot
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+                    )
+            expected = {
+                key: [to_amount(total), count]
+                for key, (total, count) in rollups_from_transactions(
+                    transactions
+                ).items()
+            }
+            stored = {
+                rollup_key_of_row(row): [row.total, row.count]
+                for row in rollups.iterator()
+                if row.total or row.count
+            }
+
+        drifts = {}
+        for key in expected.keys() | stored.keys():
+            total, count = expected.get(key, [to_amount(0), 0])
+            stored_total, stored_count = stored.get(key, [to_amount(0), 0])
+            if (total, count) != (stored_total, stored_count):
+                drifts[key] = [total - stored_total, count - stored_count]
+                self.stdout.write(
+                    f"{key}: stored {stored.get(key)}, expected {expected.get(key)}"
+                )
+
+        if options["verify"]:
+            style = self.style.SUCCESS if not drifts else self.style.ERROR
+            self.stdout.write(
+                style(f"{len(expected)} rollups checked, {len(drifts)} mismatches")
+            )
+            return
+
+        with transaction.atomic():
+            apply_rollup_deltas(drifts)
+        changed = {key[0] for key in drifts}
+        user_ids = sorted(totals.values_list("user_id", flat=True))
+        for offset in range(0, len(user_ids), USERS_PER_QUERY):
+            changed |= self.recompute_totals(
+                user_ids[offset : offset + USERS_PER_QUERY]
+            )
+        # the rollups and totals take no change number, the cached reports of
+        # these users are invalidated once the repair is committed
+        for user_id in sorted(changed):
+            bump_data_version(user_id)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{len(expected)} rollups rebuilt, {len(drifts)} were out of sync"
+            )
+        )
+
+    def recompute_totals(self, user_ids):
+        """
+        Set the totals of the users to the sums of their rollups, return the ids of the users whose totals changed.
+        """
+        today = timezone.localdate()
+        with transaction.atomic():
+            # a concurrent ledger write waits here, then adds its delta to the new totals
+            rows = list(
+                UserTotals.objects.select_for_update()
+                .filter(user_id__in=user_ids)
+                .order_by("user_id")
+            )
+            fields = totals_of_users(
+                [row.user_id for row in rows], today.year, today.month
+            )
+            changed = set()
+            for row in rows:
+                for name, value in fields[row.user_id].items():
+                    if getattr(row, name) != value:
+                        changed.add(row.user_id)
+                    setattr(row, name, value)
+            UserTotals.objects.bulk_update(
+                rows,
+                [
+                    "total_income",
+                    "total_expenses",
+                    "month_income",
+                    "month_expenses",
+                    "year",
+                    "month",
+                ],
+            )
+        return changed
@@ -0,0 +1,186 @@
+"""
+File: reconcile_budgets.py
+Author: Haitao Wang
+Date: 2024-10-15
+Description: Use Django management command to recompute the spent of the budgets from the raw transactions
+
+The expected spending of every (user, category, month) is read with one grouped
+aggregate and the budgets are streamed once, so the cost does not depend on
+the number of budgets times the number of transactions. Only the drifted
+budgets are written, with one UPDATE per batch.
+
+The reads run in one snapshot and the repair is applied as a delta
+(spent = spent + drift), so expenses written while the command runs are not
+lost: their own ledger deltas land on top of the repaired value.
+"""
+
+import time
+from collections import defaultdict
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+from finance.changes import next_numbers
+from finance.ledger import to_amount
+from finance.models import Budgets, Transactions
+from finance.periods import in_range, month_range, year_range
+
+ZERO = Decimal("0")
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Budgets.spent from the transactions and repair the drifted budgets"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", type=int, help="only process the user with this id"
+        )
+        parser.add_argument("--year", type=int, help="only process this year")
+        parser.add_argument(
+            "--month",
+            type=int,
+            choices=range(1, 13),
+            help="only process the monthly budgets of this month (needs --year)",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="report the drift without writing anything",
+        )
+
+    def handle(self, *args, **options):
+        if options["month"] and not options["year"]:
+            raise CommandError("--month needs --year")
+        started = time.perf_counter()
+
+        transactions = Transactions.objects.filter(types="expense")
+        budgets = Budgets.objects.all()
+        if options["user"]:
+            transactions = transactions.filter(user_id=options["user"])
+            budgets = budgets.filter(user_id=options["user"])
+        if options["month"]:
+            start, end = month_range(options["year"], options["month"])
+            transactions = transactions.filter(**in_range(start, end))
+            budgets = budgets.filter(
+                period_type="monthly", year=options["year"], month=options["month"]
+            )
+        elif options["year"]:
+            transactions = transactions.filter(**in_range(*year_range(options["year"])))
+            budgets = budgets.filter(year=options["year"])
+
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                # the aggregate and the budgets must be read from the same snapshot
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+                    )
+            by_month, by_year = self.expected_spent(transactions)
+            checked, drifts = self.find_drifts(budgets, by_month, by_year, options)
+
+        drift_total = sum((abs(drift) for _, _, drift in drifts), ZERO)
+        if not options["verify"] and drifts:
+            self.repair(drifts, options["batch_size"])
+
+        elapsed = time.perf_counter() - started
+        style = self.style.SUCCESS if not drifts else self.style.WARNING
+        action = "found" if options["verify"] else "repaired"
+        self.stdout.write(
+            style(
+                f"{checked} budgets checked, {len(drifts)} drifted ({action}), "
+                f"total drift {drift_total}, {elapsed:.2f} s"
+            )
+        )
+
+    def expected_spent(self, transactions):
+        """
+        Sum the expenses by (user, category, year, month) with one grouped query.
+        """
+        rows = (
+            transactions.annotate(
+                year=ExtractYear("occu_date"), month=ExtractMonth("occu_date")
+            )
+            .values_list("user_id", "category_id", "year", "month")
+            .annotate(total=Sum("amount"))
+            .order_by()
+        )
+        by_month = {}
+        by_year = defaultdict(Decimal)
+        for user_id, category_id, year, month, total in rows.iterator():
+            # SQLite sums the decimals as floats
+            total = to_amount(total)
+            by_month[(user_id, category_id, year, month)] = total
+            by_year[(user_id, category_id, year)] += total
+        return by_month, by_year
+
+    def find_drifts(self, budgets, by_month, by_year, options):
+        """
+        Stream the budgets, return the number checked and [(id, user id, drift)] of the drifted ones.
+        """
+        checked = 0
+        drifts = []
+        rows = budgets.values_list(
+            "id", "user_id", "category_id", "period_type", "year", "month", "spent"
+        ).order_by("id")
+        for (
+            budget_id,
+            user_id,
+            category_id,
+            period_type,
+            year,
+            month,
+            spent,
+        ) in rows.iterator(chunk_size=options["batch_size"]):
+            checked += 1
+            if period_type == "monthly":
+                expected = by_month.get((user_id, category_id, year, month), ZERO)
+            else:
+                expected = by_year.get((user_id, category_id, year), ZERO)
+            drift = expected - spent
+            if drift:
+                drifts.append((budget_id, user_id, drift))
+                if options["verbosity"] >= 2:
+                    self.stdout.write(
+                        f"budget {budget_id}: spent {spent}, expected {expected}"
+                    )
+        return checked, drifts
+
+    def repair(self, drifts, batch_size):
+        """
+        Add the drift to the spent of the drifted budgets, one UPDATE per batch.
+
+        The statement is written by hand: bulk_update builds and resolves a
+        Case/When expression per row, which costs more than the update itself
+        at a few hundred thousand rows.
+        """
+        max_params = connection.features.max_query_params
+        if max_params:
+            # updated_at, then 5 parameters per budget: the id and drift of the
+            # spent CASE, the id and change number of the change_seq CASE, the id of the IN
+            batch_size = min(batch_size, (max_params - 1) // 5)
+        table = connection.ops.quote_name(Budgets._meta.db_table)
+        for offset in range(0, len(drifts), batch_size):
+            batch = drifts[offset : offset + batch_size]
+            whens = " ".join(["WHEN %s THEN %s"] * len(batch))
+            placeholders = ", ".join(["%s"] * len(batch))
+            with transaction.atomic(), connection.cursor() as cursor:
+                # a change number too, so the sync endpoint sends the repaired budgets
+                numbers = next_numbers([user_id for _, user_id, _ in batch])
+                params = [connection.ops.adapt_datetimefield_value(timezone.now())]
+                for budget_id, user_id, drift in batch:
+                    params += [budget_id, drift]
+                for budget_id, user_id, drift in batch:
+                    params += [budget_id, numbers[user_id]]
+                params += [budget_id for budget_id, user_id, drift in batch]
+                cursor.execute(
+                    f"UPDATE {table} SET updated_at = %s, "
+                    f"spent = spent + CASE id {whens} END, "
+                    f"change_seq = CASE id {whens} END "
+                    f"WHERE id IN ({placeholders})",
+                    params,
+                )
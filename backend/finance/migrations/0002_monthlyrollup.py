@@ -0,0 +1,90 @@
+# Generated by Django 4.2.14 on 2026-10-18 05:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def backfill_rollups(apps, schema_editor):
+    Transactions = apps.get_model("finance", "Transactions")
+    MonthlyRollup = apps.get_model("finance", "MonthlyRollup")
+    rows = (
+        Transactions.objects.annotate(
+            year=ExtractYear("occu_date"), month=ExtractMonth("occu_date")
+        )
+        .values("user_id", "year", "month", "category_id", "types")
+        .annotate(sum_amount=Sum("amount"), row_count=Count("id"))
+        .order_by()
+    )
+    MonthlyRollup.objects.bulk_create(
+        (
+            MonthlyRollup(
+                user_id=row["user_id"],
+                year=row["year"],
+                month=row["month"],
+                category_id=row["category_id"],
+                types=row["types"],
+                total=row["sum_amount"],
+                count=row["row_count"],
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyRollup",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("year", models.PositiveIntegerField()),
+                ("month", models.PositiveIntegerField()),
+                (
+                    "types",
+                    models.CharField(
+                        choices=[("income", "income"), ("expense", "expense")],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "total",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="monthly_rollups",
+                        to="finance.categories",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="monthly_rollups",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="monthlyrollup",
+            constraint=models.UniqueConstraint(
+                fields=("user", "year", "month", "category", "types"),
+                name="unique_monthly_rollup",
+            ),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
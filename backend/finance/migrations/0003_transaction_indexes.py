@@ -0,0 +1,31 @@
+# Generated by Django 4.2.14 on 2026-10-18 05:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0002_monthlyrollup"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                fields=["user", "create_time"], name="notify_user_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                fields=["user", "types", "occu_date"], name="trans_user_type_date_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                fields=["user", "category", "occu_date"], name="trans_user_cat_date_idx"
+            ),
+        ),
+    ]
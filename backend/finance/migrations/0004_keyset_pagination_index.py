@@ -0,0 +1,19 @@
+# Generated by Django 4.2.14 on 2026-10-18 05:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0003_transaction_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                fields=["user", "occu_date", "id"], name="trans_user_date_id_idx"
+            ),
+        ),
+    ]
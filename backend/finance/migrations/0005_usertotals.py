@@ -0,0 +1,83 @@
+# Generated by Django 4.2.14 on 2026-10-18 05:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+
+def backfill_user_totals(apps, schema_editor):
+    MonthlyRollup = apps.get_model("finance", "MonthlyRollup")
+    UserTotals = apps.get_model("finance", "UserTotals")
+    today = timezone.localdate()
+    this_month = Q(year=today.year, month=today.month)
+    rows = (
+        MonthlyRollup.objects.values("user_id")
+        .annotate(
+            total_income=Sum("total", filter=Q(types="income")),
+            total_expenses=Sum("total", filter=Q(types="expense")),
+            month_income=Sum("total", filter=Q(types="income") & this_month),
+            month_expenses=Sum("total", filter=Q(types="expense") & this_month),
+        )
+        .order_by()
+    )
+    UserTotals.objects.bulk_create(
+        (
+            UserTotals(
+                user_id=row["user_id"],
+                total_income=row["total_income"] or 0,
+                total_expenses=row["total_expenses"] or 0,
+                year=today.year,
+                month=today.month,
+                month_income=row["month_income"] or 0,
+                month_expenses=row["month_expenses"] or 0,
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0004_keyset_pagination_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserTotals",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="totals",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "total_income",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "total_expenses",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                ("year", models.PositiveIntegerField()),
+                ("month", models.PositiveIntegerField()),
+                (
+                    "month_income",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "month_expenses",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+            ],
+        ),
+        migrations.RunPython(backfill_user_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.14 on 2026-10-18 06:10
+
+from django.db import migrations
+
+# frozen copy of the full-text index DDL, independent of finance.search
+PG_INDEX = "trans_notes_fts_idx"
+FTS_TABLE = "finance_transactions_fts"
+
+
+def has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def forwards(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON finance_transactions "
+            "USING GIN (to_tsvector('simple', notes))"
+        )
+    elif connection.vendor == "sqlite" and has_fts5(connection):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "owner, notes, tokenize='unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, owner, notes) "
+            "SELECT id, 'u' || user_id, notes FROM finance_transactions"
+        )
+
+
+def backwards(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {PG_INDEX}")
+    elif connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0005_usertotals"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
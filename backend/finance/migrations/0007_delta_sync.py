@@ -0,0 +1,87 @@
+# Generated by Django 4.2.14 on 2026-10-18 06:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0006_transaction_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tombstone",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("transactions", "transactions"),
+                            ("budgets", "budgets"),
+                            ("categories", "categories"),
+                        ],
+                        max_length=12,
+                    ),
+                ),
+                ("object_id", models.IntegerField()),
+                ("deleted_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="budgets",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="categories",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="transactions",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="budgets",
+            index=models.Index(
+                fields=["user", "updated_at"], name="budget_user_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="categories",
+            index=models.Index(
+                fields=["user", "updated_at"], name="cat_user_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                fields=["user", "updated_at"], name="trans_user_updated_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="tombstone",
+            name="user",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["user", "deleted_at"], name="tombstone_user_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(fields=["deleted_at"], name="tombstone_time_idx"),
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 4.2.14 on 2026-10-18 06:39
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0007_delta_sync"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecurringRule",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "types",
+                    models.CharField(
+                        choices=[("income", "income"), ("expense", "expense")],
+                        max_length=10,
+                    ),
+                ),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("notes", models.TextField(blank=True, default="")),
+                (
+                    "frequency",
+                    models.CharField(
+                        choices=[
+                            ("daily", "Daily"),
+                            ("weekly", "Weekly"),
+                            ("monthly", "Monthly"),
+                            ("yearly", "Yearly"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "interval",
+                    models.PositiveSmallIntegerField(
+                        default=1,
+                        validators=[django.core.validators.MinValueValidator(1)],
+                    ),
+                ),
+                ("start_date", models.DateField()),
+                ("end_date", models.DateField(blank=True, null=True)),
+                ("next_date", models.DateField(blank=True, null=True)),
+                ("create_time", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="recurringrule",
+            name="category",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="finance.categories"
+            ),
+        ),
+        migrations.AddField(
+            model_name="recurringrule",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="recurring_rules",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="transactions",
+            name="recurring_rule",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="transactions",
+                to="finance.recurringrule",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="recurringrule",
+            index=models.Index(fields=["next_date"], name="recurring_next_date_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="transactions",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("recurring_rule__isnull", False)),
+                fields=("recurring_rule", "occu_date"),
+                name="unique_recurring_occurrence",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.14 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0010_receipt_batch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transactions",
+            name="receipt_task",
+            field=models.CharField(blank=True, max_length=36, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                condition=models.Q(("receipt_task__isnull", False)),
+                fields=["user", "receipt_task"],
+                name="trans_user_receipt_idx",
+            ),
+        ),
+    ]
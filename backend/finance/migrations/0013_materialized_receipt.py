@@ -0,0 +1,64 @@
+# Generated by Django 4.2.14 on 2026-10-18 07:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_added_receipts(apps, schema_editor):
+    # the receipts added before the marker existed
+    Transactions = apps.get_model("finance", "Transactions")
+    MaterializedReceipt = apps.get_model("finance", "MaterializedReceipt")
+    added = (
+        Transactions.objects.filter(receipt_task__isnull=False)
+        .values_list("user_id", "receipt_task")
+        .distinct()
+    )
+    MaterializedReceipt.objects.bulk_create(
+        [
+            MaterializedReceipt(user_id=user_id, task_id=task_id)
+            for user_id, task_id in added
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0012_category_alias"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MaterializedReceipt",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=36)),
+                ("create_time", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="materializedreceipt",
+            constraint=models.UniqueConstraint(
+                fields=("user", "task_id"), name="unique_materialized_receipt"
+            ),
+        ),
+        migrations.RunPython(mark_added_receipts, migrations.RunPython.noop),
+    ]
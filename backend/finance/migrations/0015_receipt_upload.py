@@ -0,0 +1,59 @@
+# Generated by Django 4.2.14 on 2026-10-18 08:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0014_idempotency_key"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReceiptUpload",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("digest", models.CharField(max_length=64)),
+                ("task_id", models.CharField(max_length=64)),
+                ("fingerprint", models.BigIntegerField(blank=True, null=True)),
+                ("similar", models.BooleanField(default=False)),
+                ("hits", models.PositiveIntegerField(default=0)),
+                ("create_time", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "-create_time"],
+                        name="receipt_upload_recent_idx",
+                    ),
+                    models.Index(
+                        fields=["create_time"], name="receipt_upload_time_idx"
+                    ),
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="receiptupload",
+            constraint=models.UniqueConstraint(
+                fields=("user", "digest"), name="unique_receipt_upload"
+            ),
+        ),
+    ]
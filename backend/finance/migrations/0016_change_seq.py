@@ -0,0 +1,79 @@
+# Generated by Django 4.2.14 on 2026-10-18 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("finance", "0015_receipt_upload"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeCounter",
+            fields=[
+                (
+                    "scope",
+                    models.PositiveIntegerField(primary_key=True, serialize=False),
+                ),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name="budgets",
+            name="budget_user_updated_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="tombstone",
+            name="tombstone_user_time_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="transactions",
+            name="trans_user_updated_idx",
+        ),
+        migrations.AddField(
+            model_name="budgets",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="categories",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="tombstone",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="transactions",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="budgets",
+            index=models.Index(
+                fields=["user", "change_seq"], name="budget_user_change_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="categories",
+            index=models.Index(
+                fields=["user", "change_seq"], name="cat_user_change_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["user", "change_seq"], name="tombstone_user_change_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactions",
+            index=models.Index(
+                fields=["user", "change_seq"], name="trans_user_change_idx"
+            ),
+        ),
+    ]
@@ -6,10 +6,15 @@ Description: The models of the pfm.
 """
 
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
 from django.db.models import Q, Sum
 from django.utils import timezone
 from datetime import timedelta
+from collections import namedtuple
+import uuid
+from .periods import period_range, in_range
 
 
 # user management
@@ -41,13 +46,59 @@ class Categories(models.Model):
     )
     name = models.CharField(max_length=50)
     create_time = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     category_type = models.CharField(max_length=7, choices=CATEGORY_TYPES)
+    # the change number of the last write (finance.changes), for the delta sync
+    change_seq = models.BigIntegerField(default=0)
 
     objects = CategoryManager()
 
+    class Meta:
+        indexes = [
+            # the fingerprint of the category matcher
+            models.Index(fields=["user", "updated_at"], name="cat_user_updated_idx"),
+            # delta sync
+            models.Index(fields=["user", "change_seq"], name="cat_user_change_idx"),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.get_category_type_display()})"
 
+    def save(self, *args, **kwargs):
+        from . import changes
+
+        with transaction.atomic():
+            changes.stamp([self])
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "change_seq"}
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # the budgets of the category are deleted with it (CASCADE)
+        with transaction.atomic():
+            Tombstone.record(self)
+            Tombstone.record(*Budgets.objects.filter(category=self).only("id", "user"))
+            return super().delete(*args, **kwargs)
+
+
+# the category a user picked for a category name returned by the receipt
+# extraction, name is normalized (category_matcher.normalize)
+class CategoryAlias(models.Model):
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name="category_aliases"
+    )
+    name = models.CharField(max_length=100)
+    category = models.ForeignKey(Categories, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "name"], name="unique_alias_name")
+        ]
+
+    def __str__(self):
+        return f"{self.name} -> {self.category.name}"
+
 
 # transaction
 class Transactions(models.Model):
@@ -75,10 +126,201 @@ class Transactions(models.Model):
     occu_date = models.DateField(auto_now=False, auto_now_add=False)
     notes = models.TextField()
     create_time = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # the rule that materialized the transaction, if any
+    recurring_rule = models.ForeignKey(
+        "RecurringRule",
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        related_name="transactions",
+        db_constraint=False,
+    )
+    # the receipt task the transaction was created from, if any
+    receipt_task = models.CharField(max_length=36, null=True, blank=True)
+    # the change number of the last write (finance.changes), for the delta sync
+    change_seq = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # one transaction per occurrence, whatever runs the scheduler twice
+            models.UniqueConstraint(
+                fields=["recurring_rule", "occu_date"],
+                condition=Q(recurring_rule__isnull=False),
+                name="unique_recurring_occurrence",
+            )
+        ]
+        indexes = [
+            # delta sync
+            models.Index(fields=["user", "change_seq"], name="trans_user_change_idx"),
+            # the transactions of a receipt
+            models.Index(
+                fields=["user", "receipt_task"],
+                condition=Q(receipt_task__isnull=False),
+                name="trans_user_receipt_idx",
+            ),
+            models.Index(
+                fields=["user", "types", "occu_date"], name="trans_user_type_date_idx"
+            ),
+            models.Index(
+                fields=["user", "category", "occu_date"], name="trans_user_cat_date_idx"
+            ),
+            # keyset pagination of the transaction list
+            models.Index(
+                fields=["user", "occu_date", "id"], name="trans_user_date_id_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user} - {self.types} - {self.amount}"
 
+    def stored_ledger_entry(self):
+        """
+        Lock the stored row and return its ledger entry, None if it no longer exists.
+
+        Called in the transaction of the write: a concurrent update or delete of
+        the same row waits for this one to commit, then reads what it stored, so
+        both never remove the same old amount.
+        """
+        values = (
+            Transactions.objects.select_for_update()
+            .filter(pk=self.pk)
+            .values(*LEDGER_FIELDS)
+        )
+        return LedgerEntry(**values[0]) if values else None
+
+    def save(self, *args, **kwargs):
+        from . import changes, ledger
+
+        with transaction.atomic():
+            previous = None if self._state.adding else self.stored_ledger_entry()
+            changes.stamp([self])
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "change_seq"}
+            super().save(*args, **kwargs)
+            # the instance itself, so the ledger also indexes its notes
+            ledger.record(
+                added=[self], removed=[previous] if previous is not None else []
+            )
+
+    def delete(self, *args, **kwargs):
+        from . import ledger, search
+
+        pk, using = self.pk, self._state.db
+        with transaction.atomic():
+            previous = self.stored_ledger_entry()
+            if previous is not None:
+                Tombstone.record(self)
+            result = super().delete(*args, **kwargs)
+            # a row deleted by a concurrent request is not removed twice
+            if previous is not None and result[1].get(self._meta.label):
+                search.unindex_transactions([pk], using)
+                ledger.record(removed=[previous])
+        return result
+
+
+# the transaction fields that the rollups depend on
+LedgerEntry = namedtuple(
+    "LedgerEntry", ["user_id", "types", "amount", "category_id", "occu_date"]
+)
+LEDGER_FIELDS = set(LedgerEntry._fields)
+
+
+# monthly rollup of the transactions, maintained by ledger.record
+class MonthlyRollup(models.Model):
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name="monthly_rollups"
+    )
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    category = models.ForeignKey(
+        Categories,
+        on_delete=models.DO_NOTHING,
+        related_name="monthly_rollups",
+        db_constraint=False,
+    )
+    types = models.CharField(max_length=10, choices=Transactions.TRANS_TYPES)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "year", "month", "category", "types"],
+                name="unique_monthly_rollup",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.year}/{self.month} - {self.types} - {self.total}"
+
+
+# lifetime and current month totals of a user, maintained by ledger.record
+class UserTotals(models.Model):
+    user = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, primary_key=True, related_name="totals"
+    )
+    total_income = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_expenses = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # the month the month_* counters belong to, rolled over lazily on read
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    month_income = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    month_expenses = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.user} - {self.total_income} / {self.total_expenses}"
+
+
+# the last change number of the synced rows of a user, scope is the user id
+# (0 for the global categories), see finance.changes
+class ChangeCounter(models.Model):
+    scope = models.PositiveIntegerField(primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.scope} - {self.value}"
+
+
+# recurring transaction (rent, salary, subscriptions), materialized by the
+# materialize_recurring command
+class RecurringRule(models.Model):
+    FREQUENCIES = (
+        ("daily", "Daily"),
+        ("weekly", "Weekly"),
+        ("monthly", "Monthly"),
+        ("yearly", "Yearly"),
+    )
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name="recurring_rules"
+    )
+    category = models.ForeignKey(Categories, on_delete=models.CASCADE)
+    types = models.CharField(max_length=10, choices=Transactions.TRANS_TYPES)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    notes = models.TextField(blank=True, default="")
+    frequency = models.CharField(max_length=10, choices=FREQUENCIES)
+    # every <interval> days/weeks/months/years
+    interval = models.PositiveSmallIntegerField(
+        default=1, validators=[MinValueValidator(1)]
+    )
+    start_date = models.DateField()
+    end_date = models.DateField(null=True, blank=True)
+    # the first occurrence not materialized yet, null once the rule has ended
+    next_date = models.DateField(null=True, blank=True)
+    create_time = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the scheduler only reads the due rules
+            models.Index(fields=["next_date"], name="recurring_next_date_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.frequency} - {self.amount}"
+
 
 # budget
 class Budgets(models.Model):
@@ -95,14 +337,61 @@ class Budgets(models.Model):
     )  # Optional, only needed for monthly budgets
     year = models.PositiveIntegerField()
     create_time = models.DateTimeField(auto_now_add=True)
+    # also set by the ledger and reconcile_budgets when they move spent
+    updated_at = models.DateTimeField(auto_now=True)
+    # the change number of the last write, also taken by the ledger and
+    # reconcile_budgets when they move spent
+    change_seq = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # delta sync
+            models.Index(fields=["user", "change_seq"], name="budget_user_change_idx"),
+        ]
 
     def __str__(self):
         return f"{self.category.name} - {self.get_period_display()} {self.year}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields() & BUDGET_PERIOD_FIELDS:
+            instance._stored_period = instance.period()
+        return instance
+
+    def period(self):
+        return (self.category_id, self.period_type, self.year, self.month)
+
     def save(self, *args, **kwargs):
-        # Calculate spent before saving the budget
-        self.spent = self.calculate_spent()
-        super().save(*args, **kwargs)
+        from . import changes
+
+        with transaction.atomic():
+            # the change number first: the ledger writes of the user wait for
+            # this save, the spent calculated below misses none of them
+            changes.stamp([self])
+            # spent is maintained by the ledger with F() deltas, it is only calculated
+            # for a new budget or when the budget moves to another category/period
+            if (
+                self._state.adding
+                or getattr(self, "_stored_period", None) != self.period()
+            ):
+                self.spent = self.calculate_spent()
+            elif kwargs.get("update_fields") is None:
+                # never write back a spent read earlier, it would undo concurrent deltas
+                kwargs["update_fields"] = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != "spent"
+                ]
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "change_seq"}
+            super().save(*args, **kwargs)
+        self._stored_period = self.period()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Tombstone.record(self)
+            return super().delete(*args, **kwargs)
 
     def calculate_spent(self):
         # Get the base query for transactions
@@ -110,19 +399,23 @@ class Budgets(models.Model):
             user=self.user, category=self.category, types="expense"
         )
 
-        # Filter by the period type
-        if self.period_type == "monthly":
-            transactions = transactions.filter(
-                occu_date__year=self.year, occu_date__month=self.month
-            )
-        elif self.period_type == "yearly":
-            transactions = transactions.filter(occu_date__year=self.year)
+        # Filter by the period, as a date range so the index can be used
+        if self.period_type in ("monthly", "yearly"):
+            try:
+                start, end = period_range(self.period_type, self.year, self.month)
+            except (TypeError, ValueError):
+                # no such month (or year), nothing can be spent in it
+                return 0
+            transactions = transactions.filter(**in_range(start, end))
 
         # Calculate the total spent amount
         total_spent = transactions.aggregate(Sum("amount"))["amount__sum"] or 0
         return total_spent
 
 
+BUDGET_PERIOD_FIELDS = {"category_id", "period_type", "year", "month"}
+
+
 # notification
 class Notification(models.Model):
     NOTIFY_LEVEL = (
@@ -134,3 +427,172 @@ class Notification(models.Model):
     notify = models.TextField()
     types = models.CharField(max_length=10, choices=NOTIFY_LEVEL)
     create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "create_time"], name="notify_user_time_idx"),
+        ]
+
+
+# a deleted row, so that the sync endpoint can tell the clients to drop it
+class Tombstone(models.Model):
+    # the model_name of the synced models
+    KINDS = (
+        ("transactions", "transactions"),
+        ("budgets", "budgets"),
+        ("categories", "categories"),
+    )
+    id = models.AutoField(primary_key=True)
+    # null for the global categories
+    user = models.ForeignKey(CustomUser, null=True, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=12, choices=KINDS)
+    object_id = models.IntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+    # the change number of the delete, for the delta sync
+    change_seq = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "change_seq"], name="tombstone_user_change_idx"
+            ),
+            # pruning
+            models.Index(fields=["deleted_at"], name="tombstone_time_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} deleted {self.deleted_at}"
+
+    @classmethod
+    def record(cls, *instances):
+        """
+        Write the tombstones of rows about to be deleted, in the transaction of the delete.
+        """
+        from . import changes
+
+        now = timezone.now()
+        cls.objects.bulk_create(
+            changes.stamp(
+                [
+                    cls(
+                        user_id=instance.user_id,
+                        kind=instance._meta.model_name,
+                        object_id=instance.pk,
+                        deleted_at=now,
+                    )
+                    for instance in instances
+                    if instance.pk is not None
+                ]
+            )
+        )
+
+
+# receipt extraction task of the local receipt backend (the AWS backend keeps
+# its tasks in DynamoDB)
+class ReceiptTask(models.Model):
+    STATUSES = (
+        ("submitted", "submitted"),
+        ("completed", "completed"),
+        ("failed", "failed"),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUSES, default="submitted")
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    create_time = models.DateTimeField(auto_now_add=True)
+    # set by the worker, started_at - create_time is the time spent in the queue
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.id} - {self.status}"
+
+
+# receipts uploaded together, items has one entry per image in upload order:
+# {"name", "task_id", "duplicate"}, or {"name", "error"} for an invalid image
+class ReceiptBatch(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    items = models.JSONField(default=list)
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.id} - {len(self.items)} receipts"
+
+
+# an upload of a receipt image, looked up by the SHA-256 digest of its bytes;
+# fingerprint is the dHash as a signed 64 bit integer (null when the perceptual
+# match is off), similar marks a digest linked to the task of a near-duplicate
+# and hits counts the later uploads of the same bytes
+class ReceiptUpload(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=64)
+    task_id = models.CharField(max_length=64)
+    fingerprint = models.BigIntegerField(null=True, blank=True)
+    similar = models.BooleanField(default=False)
+    hits = models.PositiveIntegerField(default=0)
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "digest"], name="unique_receipt_upload"
+            )
+        ]
+        indexes = [
+            # the recent uploads of a user
+            models.Index(
+                fields=["user", "-create_time"], name="receipt_upload_recent_idx"
+            ),
+            # pruning
+            models.Index(fields=["create_time"], name="receipt_upload_time_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.digest[:12]} - {self.task_id}"
+
+
+# a receipt task whose transactions were added, the unique row makes
+# materialize_receipt add a receipt once even for concurrent requests
+class MaterializedReceipt(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    task_id = models.CharField(max_length=36)
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "task_id"], name="unique_materialized_receipt"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.task_id} - {self.user_id}"
+
+
+# the Idempotency-Key of a request, key is the digest of the header value;
+# status_code is null while the first request runs, expires_at is its lock
+# timeout, then the end of the IDEMPOTENCY_KEY_TTL of the stored response
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    request_digest = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    location = models.CharField(max_length=255, blank=True, default="")
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key"
+            )
+        ]
+        indexes = [
+            # pruning
+            models.Index(fields=["expires_at"], name="idempotency_expires_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.key} - {self.status_code or 'in progress'}"
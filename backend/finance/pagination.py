@@ -0,0 +1,153 @@
+"""
+File: pagination.py
+Author: Haitao Wang
+Date: 2024-10-10
+Description: Keyset (cursor) pagination for the list endpoints
+"""
+
+import datetime
+import json
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    DjangoJSONEncoder with datetimes at full precision, it truncates them to ms.
+    """
+
+    def default(self, o):
+        # a truncated create_time would skip the rows of the same millisecond
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class CursorSerializer:
+    """
+    signing serializer of the cursor positions, dates and decimals become strings.
+
+    The model fields parse the strings back in the filter of the next page.
+    """
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"), cls=CursorEncoder).encode(
+            "latin-1"
+        )
+
+    def loads(self, data):
+        return json.loads(data.decode("latin-1"))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over the view's ``keyset_ordering`` (default ("-id",)).
+
+    A page is fetched with WHERE (ordering columns) after (last row of the
+    previous page) LIMIT page_size + 1, so the cost of a page does not depend
+    on how deep it is, and rows inserted meanwhile never shift the pages.
+    The last ordering field must be unique (the id). The cursor is the signed
+    position of the last row, clients pass it back unchanged; it is signed for
+    the model and ordering of the view, a cursor of another list is rejected
+    with a 400 like a tampered one.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+    salt = "finance.pagination"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = tuple(getattr(view, "keyset_ordering", ("-id",)))
+        self.page_size = self.get_page_size(request)
+        self.cursor_salt = ":".join(
+            [self.salt, queryset.model._meta.label_lower, *self.ordering]
+        )
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.after(position))
+            except (ValidationError, ValueError, TypeError):
+                # a position the ordering fields cannot parse
+                raise ParseError(self.invalid_cursor_message)
+
+        rows = list(queryset[: self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        self.next_position = self.position_of(rows[-1]) if self.has_next else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def position_of(self, row):
+        return [getattr(row, field.lstrip("-")) for field in self.ordering]
+
+    def after(self, position):
+        """
+        Build the "row comes after position" condition, e.g. for (-occu_date, -id):
+        occu_date < d OR (occu_date = d AND id < i)
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= Q(**equal, **{f"{name}__{lookup}": value})
+            equal[name] = value
+        return condition
+
+    def encode_cursor(self, position):
+        return signing.dumps(
+            position, salt=self.cursor_salt, serializer=CursorSerializer, compress=True
+        )
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = signing.loads(
+                cursor, salt=self.cursor_salt, serializer=CursorSerializer
+            )
+        except signing.BadSignature:
+            raise ParseError(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise ParseError(self.invalid_cursor_message)
+        return position
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.next_position)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
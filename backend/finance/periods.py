@@ -0,0 +1,43 @@
+"""
+File: periods.py
+Author: Haitao Wang
+Date: 2024-10-08
+Description: Helpers turning budget periods into half-open date ranges
+
+Filtering on occu_date >= start AND occu_date < end lets the database use the
+(user, ..., occu_date) indexes, EXTRACT(YEAR/MONTH FROM occu_date) can not.
+"""
+
+from datetime import date
+
+
+def month_range(year, month):
+    """
+    Return the [start, end) dates of a month.
+    """
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+
+def year_range(year):
+    """
+    Return the [start, end) dates of a year.
+    """
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+
+def period_range(period_type, year, month=None):
+    """
+    Return the [start, end) dates of a budget period (monthly or yearly).
+    """
+    if period_type == "monthly":
+        return month_range(year, month)
+    return year_range(year)
+
+
+def in_range(start, end, field="occu_date"):
+    """
+    Return the filter kwargs of the half-open range [start, end) on a date field.
+    """
+    return {f"{field}__gte": start, f"{field}__lt": end}
@@ -8,7 +8,7 @@ the process is moving to AWS Lamda, here only process the result
 
 import os
 from typing import List, Dict
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 import ast
 from decimal import Decimal
 
@@ -120,10 +120,18 @@ def convert_to_floats(data):
         return data
 
 
+# built once, every validation reuses its compiled core schema
+INVOICE_ADAPTER = TypeAdapter(Invoice)
+
+
 # convert data to object
 def process_result(resultstr):
-    # invoice_data = convert_dynamodb_item(resultstr)
-    invoice_data = convert_to_floats(resultstr)
-    invoice = Invoice(**invoice_data)
+    # the lax mode reads the Decimals of DynamoDB as floats/ints, no convert_to_floats walk
+    return INVOICE_ADAPTER.validate_python(resultstr)
+
 
-    return invoice
+def validate_result(result):
+    """
+    Validate an extraction result, return the Invoice as JSON ready data
+    """
+    return INVOICE_ADAPTER.dump_python(process_result(result), mode="json")
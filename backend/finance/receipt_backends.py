@@ -0,0 +1,360 @@
+"""
+File: receipt_backends.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Pluggable receipt processing backends, chosen with the RECEIPT_BACKEND setting
+
+- aws: the image is sent to the receipt Lambda and the task is kept in the
+  ReceiptTasks DynamoDB table, which the Lambda completes.
+- local: the extraction runs in a process pool of this server and the task
+  is a ReceiptTask row, so the receipt path can be run and load tested
+  offline on one box.
+
+A task is {"task_id", "status", "result"}, status is submitted, completed or
+failed (result is the Invoice dict once completed).
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone as dt_timezone
+from functools import partial
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import ReceiptTask
+from .receipt_events import TaskWatcher
+
+logger = logging.getLogger(__name__)
+
+COMPLETED_KEY = "pfm:receipt-task:{task_id}"
+
+
+class ReceiptBackend:
+    """
+    Interface of the receipt backends.
+    """
+
+    def submit(self, user, image_bytes):
+        """
+        Queue the extraction of a receipt (JPEG bytes) for the user, return the task id.
+        """
+        raise NotImplementedError
+
+    def submit_many(self, user, images):
+        """
+        Queue the extraction of several receipts, return their task ids in order.
+        """
+        return [self.submit(user, image_bytes) for image_bytes in images]
+
+    def get_task(self, task_id, user):
+        """
+        Return the task of the user as a dict, None if there is no such task.
+        """
+        raise NotImplementedError
+
+    def get_statuses(self, task_ids):
+        """
+        Return {task_id: status} of the existing tasks among task_ids, in one read.
+        """
+        raise NotImplementedError
+
+
+class AWSReceiptBackend(ReceiptBackend):
+    """
+    Extraction by the receipt Lambda, tasks in DynamoDB.
+    """
+
+    def __init__(self):
+        import boto3
+
+        self.lambda_client = boto3.client(
+            "lambda", region_name=settings.RECEIPT_AWS_REGION
+        )
+        self.table = boto3.resource(
+            "dynamodb", region_name=settings.RECEIPT_AWS_REGION
+        ).Table(settings.RECEIPT_TASK_TABLE)
+
+    def _item(self, user, task_id):
+        return {
+            "task_id": task_id,
+            "status": "submitted",
+            "result": None,
+            "user_id": user.id,
+        }
+
+    def _invoke(self, task_id, image_bytes):
+        self.lambda_client.invoke(
+            FunctionName=settings.RECEIPT_LAMBDA_FUNCTION,
+            InvocationType="Event",
+            Payload=json.dumps(
+                {
+                    "task_id": task_id,
+                    "image_data": base64.b64encode(image_bytes).decode("utf-8"),
+                }
+            ),
+        )
+
+    def submit(self, user, image_bytes):
+        task_id = str(uuid.uuid4())
+        # stored before the invoke, a fast Lambda must not be overwritten by "submitted"
+        self.table.put_item(Item=self._item(user, task_id))
+        self._invoke(task_id, image_bytes)
+        return task_id
+
+    def submit_many(self, user, images):
+        task_ids = [str(uuid.uuid4()) for _ in images]
+        # one BatchWriteItem per 25 tasks, then the invokes fanned out (the
+        # low-level client is thread safe)
+        with self.table.batch_writer() as batch:
+            for task_id in task_ids:
+                batch.put_item(Item=self._item(user, task_id))
+        workers = min(len(images), settings.RECEIPT_SUBMIT_CONCURRENCY) or 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(self._invoke, task_ids, images))
+        return task_ids
+
+    def get_task(self, task_id, user):
+        item = self.table.get_item(Key={"task_id": task_id}).get("Item")
+        # a task without an owner (written before user_id was stored) is
+        # nobody's, it is never returned nor cached
+        if item is None or item.get("user_id") != user.id:
+            return None
+        return {
+            "task_id": task_id,
+            "status": item["status"],
+            "result": item.get("result"),
+        }
+
+    def get_statuses(self, task_ids):
+        statuses = {}
+        # BatchGetItem reads at most 100 keys
+        for start in range(0, len(task_ids), 100):
+            response = self.table.meta.client.batch_get_item(
+                RequestItems={
+                    self.table.name: {
+                        "Keys": [
+                            {"task_id": task_id}
+                            for task_id in task_ids[start : start + 100]
+                        ],
+                        "ProjectionExpression": "task_id, #status",
+                        "ExpressionAttributeNames": {"#status": "status"},
+                    }
+                }
+            )
+            # unprocessed keys are simply read on the next round
+            for item in response["Responses"].get(self.table.name, []):
+                statuses[item["task_id"]] = item["status"]
+        return statuses
+
+
+def run_extractor(extractor, image_bytes):
+    """
+    Worker side of the local backend, return (start time, invoice dict).
+    """
+    return time.time(), extractor(image_bytes)
+
+
+class LocalReceiptBackend(ReceiptBackend):
+    """
+    Extraction in a process pool of this server, tasks in the ReceiptTask table.
+
+    The workers only run the extractor, the rows are written by the done
+    callbacks in this process. stats() reports the queue depth (tasks
+    submitted and not finished) and the counters since the start.
+    """
+
+    def __init__(self, extractor=None, workers=None):
+        self.extractor = extractor or import_string(settings.RECEIPT_LOCAL_EXTRACTOR)
+        self.workers = workers or settings.RECEIPT_LOCAL_WORKERS
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._failed = 0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def submit(self, user, image_bytes):
+        task = ReceiptTask.objects.create(user=user)
+        # queued once the row is committed, the callback must find it
+        transaction.on_commit(partial(self._queue, task.id, image_bytes))
+        return str(task.id)
+
+    def submit_many(self, user, images):
+        tasks = ReceiptTask.objects.bulk_create(ReceiptTask(user=user) for _ in images)
+        for task, image_bytes in zip(tasks, images):
+            transaction.on_commit(partial(self._queue, task.id, image_bytes))
+        return [str(task.id) for task in tasks]
+
+    def _queue(self, task_id, image_bytes):
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self.executor().submit(run_extractor, self.extractor, image_bytes)
+        except BrokenProcessPool as e:
+            self.shutdown(wait=False)
+            self._finished(task_id, None, error=e)
+            return
+        future.add_done_callback(partial(self._finished, task_id))
+
+    def _finished(self, task_id, future, error=None):
+        from .receipt import validate_result
+
+        # the callbacks run on the long lived thread of the pool, drop its
+        # connection once broken or past CONN_MAX_AGE (never in a transaction)
+        if not connection.in_atomic_block:
+            close_old_connections()
+        values = {"finished_at": timezone.now()}
+        try:
+            if error is None:
+                started, result = future.result()
+                values.update(
+                    status="completed",
+                    result=validate_result(result),
+                    started_at=datetime.fromtimestamp(started, dt_timezone.utc),
+                )
+        except Exception as e:
+            error = e
+        if error is not None:
+            logger.error(f"Error processing receipt {task_id}: {error}")
+            values.update(status="failed", error=str(error))
+            if isinstance(error, BrokenProcessPool):
+                self.shutdown(wait=False)
+        try:
+            ReceiptTask.objects.filter(id=task_id).update(**values)
+        except Exception as e:
+            logger.error(f"Error storing receipt task {task_id}: {e}")
+        with self._lock:
+            self._pending -= 1
+            if values["status"] == "completed":
+                self._completed += 1
+            else:
+                self._failed += 1
+        get_watcher().notify(str(task_id), values["status"])
+
+    def get_task(self, task_id, user):
+        try:
+            task_id = uuid.UUID(str(task_id))
+        except ValueError:
+            return None
+        task = (
+            ReceiptTask.objects.filter(id=task_id, user=user)
+            .values("status", "result", "error")
+            .first()
+        )
+        if task is None:
+            return None
+        data = {
+            "task_id": str(task_id),
+            "status": task["status"],
+            "result": task["result"],
+        }
+        if task["status"] == "failed":
+            data["error"] = task["error"]
+        return data
+
+    def get_statuses(self, task_ids):
+        valid = []
+        for task_id in task_ids:
+            try:
+                valid.append(uuid.UUID(str(task_id)))
+            except ValueError:
+                pass
+        return {
+            str(task_id): status
+            for task_id, status in ReceiptTask.objects.filter(id__in=valid).values_list(
+                "id", "status"
+            )
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self._pending,
+                "completed": self._completed,
+                "failed": self._failed,
+            }
+
+
+BACKENDS = {"aws": AWSReceiptBackend, "local": LocalReceiptBackend}
+
+_backend = None
+_watcher = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Return the receipt backend of the RECEIPT_BACKEND setting (a name of BACKENDS or a dotted path), created on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.RECEIPT_BACKEND
+                backend_class = BACKENDS.get(name) or import_string(name)
+                _backend = backend_class()
+    return _backend
+
+
+def get_task(task_id, user):
+    """
+    Return the task of the user, None if there is no such task.
+
+    A completed task never changes: its result is validated once into the
+    Invoice shape and the task is kept in the "receipts" cache, the next polls
+    are served from there without reading the backend. A result that is not
+    a valid Invoice makes the task failed.
+    """
+    store = caches["receipts"]
+    key = COMPLETED_KEY.format(task_id=task_id)
+    cached = store.get(key)
+    if cached is not None and cached[0] == user.id:
+        return cached[1]
+    # the pydantic models are built on the first result, not at startup
+    from .receipt import validate_result
+
+    task = get_backend().get_task(task_id, user)
+    if task is None or task["status"] != "completed":
+        return task
+    try:
+        task["result"] = validate_result(task["result"])
+    except ValueError as e:
+        logger.error(f"Invalid receipt result of task {task_id}: {e}")
+        return {**task, "status": "failed", "result": None, "error": "Invalid result."}
+    store.set(key, (user.id, task), settings.RECEIPT_DEDUPE_TTL)
+    return task
+
+
+def get_watcher():
+    """
+    Return the TaskWatcher of this process, reading the statuses from the receipt backend.
+    """
+    global _watcher
+    if _watcher is None:
+        with _backend_lock:
+            if _watcher is None:
+                _watcher = TaskWatcher(
+                    lambda task_ids: get_backend().get_statuses(task_ids),
+                    settings.RECEIPT_WATCH_INTERVAL,
+                )
+    return _watcher
@@ -0,0 +1,123 @@
+"""
+File: receipt_batch.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Batch submission of receipt images
+
+The images of a batch are checked against the earlier uploads, decoded and
+downscaled in parallel in a thread pool (PIL releases the GIL while decoding
+and resampling), and the new ones are handed to the receipt backend in one
+submit_many fan-out. The wall time of a batch is about the time of its
+slowest image, not the sum of all of them.
+"""
+
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from . import receipt_dedupe
+from .models import ReceiptBatch
+from .receipt_backends import get_backend
+from .receipt_image import InvalidImage, prepare_receipt
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def preprocess_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=settings.RECEIPT_PREPROCESS_WORKERS,
+                thread_name_prefix="receipt-preprocess",
+            )
+        return _pool
+
+
+def _prepare(data, perceptual):
+    """
+    Pool side: return (JPEG bytes, fingerprint or None) of an upload, raise InvalidImage.
+    """
+    image_binary = prepare_receipt(data)
+    return image_binary, receipt_dedupe.dhash(image_binary) if perceptual else None
+
+
+def submit_batch(user, uploads):
+    """
+    Submit the uploads, a list of (name, bytes), and return the ReceiptBatch.
+    """
+    perceptual = settings.RECEIPT_DEDUPE_PERCEPTUAL
+    items = [{"name": name} for name, _ in uploads]
+    digests = [receipt_dedupe.content_digest(data) for _, data in uploads]
+
+    # receipts uploaded before, the database and backend reads stay on this thread
+    first = {}
+    todo = []
+    for i, digest in enumerate(digests):
+        if digest in first:
+            continue
+        first[digest] = i
+        task = receipt_dedupe.find_task(user, digest)
+        if task is not None:
+            items[i].update(task_id=task["task_id"], duplicate=True)
+        else:
+            todo.append(i)
+
+    futures = {
+        i: preprocess_pool().submit(_prepare, uploads[i][1], perceptual) for i in todo
+    }
+    prepared = {}
+    for i, future in futures.items():
+        try:
+            image_binary, fingerprint = future.result()
+        except InvalidImage:
+            items[i]["error"] = "Uploaded file is not a valid image."
+            continue
+        if fingerprint is not None:
+            task = receipt_dedupe.find_similar_task(user, digests[i], fingerprint)
+            if task is not None:
+                items[i].update(task_id=task["task_id"], duplicate=True)
+                continue
+        prepared[i] = (image_binary, fingerprint)
+
+    order = list(prepared)
+    task_ids = get_backend().submit_many(user, [prepared[i][0] for i in order])
+    for i, task_id in zip(order, task_ids):
+        items[i].update(task_id=task_id, duplicate=False)
+        receipt_dedupe.remember(user, digests[i], task_id, prepared[i][1])
+
+    # the same image twice in the batch shares the task of the first one
+    for i, digest in enumerate(digests):
+        if first[digest] != i:
+            items[i].update(
+                {
+                    key: value
+                    for key, value in items[first[digest]].items()
+                    if key != "name"
+                }
+            )
+            if "task_id" in items[i]:
+                items[i]["duplicate"] = True
+
+    return ReceiptBatch.objects.create(user=user, items=items)
+
+
+def batch_status(batch):
+    """
+    Return the batch with the current status of every image (one backend read) and the counts per status.
+    """
+    task_ids = [item["task_id"] for item in batch.items if "task_id" in item]
+    statuses = get_backend().get_statuses(task_ids) if task_ids else {}
+    items = []
+    for item in batch.items:
+        if "task_id" in item:
+            item = {**item, "status": statuses.get(item["task_id"], "submitted")}
+        else:
+            item = {**item, "status": "invalid"}
+        items.append(item)
+    return {
+        "batch_id": str(batch.id),
+        "items": items,
+        "counts": dict(Counter(item["status"] for item in items)),
+    }
@@ -0,0 +1,179 @@
+"""
+File: receipt_dedupe.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Content-addressed dedupe of the receipt uploads
+
+An upload is keyed by the SHA-256 of its bytes, looked up before the image is
+even decoded, so a repeat upload of the same photo gets the existing task (and
+its result, once completed) back instead of a new paid extraction. With
+RECEIPT_DEDUPE_PERCEPTUAL, the dHash of the normalized image also matches
+near-duplicates (the same photo re-encoded or resized) against the last
+RECEIPT_DEDUPE_RECENT receipts of the user.
+
+The uploads are ReceiptUpload rows, shared by every instance; an entry is
+used for RECEIPT_DEDUPE_TTL seconds and the prune_receipt_uploads command
+deletes the older ones. A task that failed or no longer exists is not reused.
+The hit and miss counts reported by the stats endpoint are computed from
+the rows.
+"""
+
+import hashlib
+from datetime import timedelta
+from io import BytesIO
+from django.conf import settings
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from .models import ReceiptUpload
+from .receipt_backends import get_task
+
+# the dHash compares HASH_SIZE x HASH_SIZE neighbour pixels, a 64 bit fingerprint
+HASH_SIZE = 8
+FINGERPRINT_BITS = 64
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(jpeg_bytes):
+    """
+    Difference hash of an image: one bit per pair of horizontal neighbours of a 9x8 grayscale thumbnail.
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(jpeg_bytes))
+    # a 1/8 scale decode is plenty for 9x8 pixels
+    image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+    pixels = (
+        image.convert("L")
+        .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+        .tobytes()
+    )
+    fingerprint = 0
+    for row in range(HASH_SIZE):
+        line = pixels[row * (HASH_SIZE + 1) : (row + 1) * (HASH_SIZE + 1)]
+        for left, right in zip(line, line[1:]):
+            fingerprint = fingerprint << 1 | (left > right)
+    return fingerprint
+
+
+def _signed(fingerprint):
+    """
+    The 64 bit fingerprint as the signed integer of a bigint column.
+    """
+    if fingerprint >= 1 << (FINGERPRINT_BITS - 1):
+        fingerprint -= 1 << FINGERPRINT_BITS
+    return fingerprint
+
+
+def distance(left, right):
+    """
+    Number of bits that differ between two fingerprints, signed or not.
+    """
+    return bin((left ^ right) & ((1 << FINGERPRINT_BITS) - 1)).count("1")
+
+
+def _uploads(user):
+    cutoff = timezone.now() - timedelta(seconds=settings.RECEIPT_DEDUPE_TTL)
+    return ReceiptUpload.objects.filter(user=user, create_time__gte=cutoff)
+
+
+def _live_task(user, task_id):
+    task = get_task(task_id, user)
+    if task is None or task["status"] == "failed":
+        return None
+    return task
+
+
+def _link(user, digest, task_id, fingerprint=None, similar=False):
+    ReceiptUpload.objects.bulk_create(
+        [
+            ReceiptUpload(
+                user=user,
+                digest=digest,
+                task_id=task_id,
+                fingerprint=None if fingerprint is None else _signed(fingerprint),
+                similar=similar,
+            )
+        ],
+        # an expired upload of the same bytes is replaced
+        update_conflicts=True,
+        unique_fields=["user", "digest"],
+        update_fields=["task_id", "fingerprint", "similar", "hits", "create_time"],
+    )
+
+
+def find_task(user, digest):
+    """
+    Return the task of an earlier upload of the user with this digest, None if there is none.
+    """
+    upload = _uploads(user).filter(digest=digest).values("id", "task_id").first()
+    if upload is None:
+        return None
+    task = _live_task(user, upload["task_id"])
+    if task is None:
+        ReceiptUpload.objects.filter(id=upload["id"]).delete()
+        return None
+    ReceiptUpload.objects.filter(id=upload["id"]).update(hits=F("hits") + 1)
+    return task
+
+
+def find_similar_task(user, digest, fingerprint):
+    """
+    Return the task of a recent upload of the user within RECEIPT_DEDUPE_DISTANCE bits of the fingerprint.
+
+    The digest of this upload is linked to the task, a repeat is an exact hit.
+    """
+    recent = (
+        _uploads(user)
+        .filter(fingerprint__isnull=False)
+        .order_by("-create_time")
+        .values_list("fingerprint", "task_id")[: settings.RECEIPT_DEDUPE_RECENT]
+    )
+    for other, task_id in recent:
+        if distance(other, fingerprint) <= settings.RECEIPT_DEDUPE_DISTANCE:
+            task = _live_task(user, task_id)
+            if task is not None:
+                _link(user, digest, task_id, similar=True)
+                return task
+    return None
+
+
+def remember(user, digest, task_id, fingerprint=None):
+    """
+    Record the task of a new upload (a miss), later uploads of the same receipt find it.
+    """
+    _link(user, digest, task_id, fingerprint)
+
+
+def prune_uploads():
+    """
+    Delete the uploads older than RECEIPT_DEDUPE_TTL, return the number deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.RECEIPT_DEDUPE_TTL)
+    deleted, _ = ReceiptUpload.objects.filter(create_time__lt=cutoff).delete()
+    return deleted
+
+
+def dedupe_stats():
+    """
+    Return the hit and miss counts of the uploads kept.
+    """
+    counts = ReceiptUpload.objects.aggregate(
+        exact_hits=Sum("hits", default=0),
+        similar_hits=Count("id", filter=Q(similar=True)),
+        misses=Count("id", filter=Q(similar=False)),
+    )
+    exact, similar, misses = (
+        counts["exact_hits"],
+        counts["similar_hits"],
+        counts["misses"],
+    )
+    total = exact + similar + misses
+    return {
+        "exact_hits": exact,
+        "similar_hits": similar,
+        "misses": misses,
+        "hit_rate": (exact + similar) / total if total else 0.0,
+    }
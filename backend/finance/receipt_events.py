@@ -0,0 +1,103 @@
+"""
+File: receipt_events.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: In-process notification of receipt task changes, for the long-poll task status
+
+The status requests waiting on a task block on one Condition of the process.
+They are woken by:
+
+- the local backend, which notifies a task as soon as its worker finishes
+  (when the request is served by the process that submitted it);
+- one watcher thread per process, which reads the status of every watched
+  task in one batch every RECEIPT_WATCH_INTERVAL seconds (the AWS backend, or
+  a task submitted by another process).
+
+The storage is read once per interval for all the waiting clients, instead of
+once per poll of every client.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class TaskWatcher:
+    """
+    Wait for the status of receipt tasks to change.
+
+    ``fetch(task_ids)`` returns {task_id: status} of the tasks that exist.
+    """
+
+    def __init__(self, fetch, interval=1.0):
+        self.fetch = fetch
+        self.interval = interval
+        self._changed = threading.Condition()
+        # task id -> number of waiting requests, and the last status seen
+        self._waiters = Counter()
+        self._status = {}
+        self._thread = None
+
+    def notify(self, task_id, status):
+        """
+        Record a new status of the task and wake the requests waiting on it.
+        """
+        with self._changed:
+            if task_id in self._waiters:
+                self._status[task_id] = status
+                self._changed.notify_all()
+
+    def wait(self, task_id, status, timeout):
+        """
+        Block until the task leaves ``status`` or timeout seconds pass, return whether it changed.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self._waiters[task_id] += 1
+            self._status.setdefault(task_id, status)
+            self._start()
+            try:
+                while self._status[task_id] == status:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._changed.wait(remaining)
+                return True
+            finally:
+                self._waiters[task_id] -= 1
+                if not self._waiters[task_id]:
+                    del self._waiters[task_id]
+                    del self._status[task_id]
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="receipt-task-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._changed:
+                task_ids = list(self._waiters)
+            if not task_ids:
+                continue
+            try:
+                close_old_connections()
+                statuses = self.fetch(task_ids)
+            except Exception as e:
+                logger.error(f"Error watching receipt tasks: {e}")
+                continue
+            with self._changed:
+                changed = False
+                for task_id, status in statuses.items():
+                    if task_id in self._waiters and self._status[task_id] != status:
+                        self._status[task_id] = status
+                        changed = True
+                if changed:
+                    self._changed.notify_all()
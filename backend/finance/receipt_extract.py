@@ -0,0 +1,101 @@
+"""
+File: receipt_extract.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Receipt extractors of the local receipt backend, run in the worker processes
+
+An extractor takes the JPEG bytes of a receipt and returns the Invoice as a
+dict (the shape the AWS Lambda stores in DynamoDB). They are module level
+functions, so the process pool can pickle them.
+"""
+
+import base64
+import time
+from io import BytesIO
+from PIL import Image
+
+EXTRACT_MODEL = "gpt-4o"
+EXTRACT_PROMPT = (
+    "Extract the invoice of this supermarket receipt: the products with their "
+    "count, unit and total price, a category for every product based on its "
+    "description, the totals, and the subtotal of every category."
+)
+
+
+def extract_invoice(image_bytes):
+    """
+    Extract the invoice with GPT-4o (OPENAI_API_KEY in the environment), the same extraction as the Lambda.
+    """
+    import instructor
+    from openai import OpenAI
+    from .receipt import Invoice
+
+    client = instructor.from_openai(OpenAI())
+    image_url = "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode()
+    invoice = client.chat.completions.create(
+        model=EXTRACT_MODEL,
+        response_model=Invoice,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": EXTRACT_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            }
+        ],
+    )
+    return invoice.model_dump()
+
+
+def simulated_invoice(products=5):
+    """
+    A valid Invoice dict with ``products`` lines, what the simulated extractor returns.
+    """
+    lines = [
+        {
+            "product_description": f"item {i}",
+            "count": 1,
+            "unit_item_price": 2.5 + i,
+            "product_total_price": 2.5 + i,
+            "category": "Groceries" if i % 2 else "Household",
+        }
+        for i in range(products)
+    ]
+    subtotals = {}
+    for line in lines:
+        subtotals[line["category"]] = (
+            subtotals.get(line["category"], 0) + line["product_total_price"]
+        )
+    total = sum(line["product_total_price"] for line in lines)
+    return {
+        "invoice_number": "SIMULATED",
+        "billing_address": {
+            "name": "Simulated Market",
+            "address_line": "1 Test Street",
+            "city": "Testville",
+            "state_province_code": "TS",
+            "postal_code": 12345,
+        },
+        "product": lines,
+        "total_bill": {
+            "total": total,
+            "discount_amount": 0,
+            "tax_amount": 0,
+            "delivery_charges": 0,
+            "final_total": total,
+            "category_subtotals": subtotals,
+        },
+    }
+
+
+def simulated_extract(image_bytes, latency=0.5, cpu=0.0):
+    """
+    Offline extractor for load tests: decode the image, burn ``cpu`` seconds, wait ``latency`` seconds (the model call).
+    """
+    Image.open(BytesIO(image_bytes)).load()
+    deadline = time.process_time() + cpu
+    while time.process_time() < deadline:
+        pass
+    time.sleep(latency)
+    return simulated_invoice()
@@ -0,0 +1,67 @@
+"""
+File: receipt_image.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Preprocessing of the uploaded receipt images before extraction
+
+The upload is decoded once: opening it reads the header only, a large JPEG is
+switched to draft mode so the decoder scales it down by 1/2, 1/4 or 1/8 while
+decoding (a 12 MP photo is never held at full size), and the load validates
+the image data. A small JPEG that already fits MAX_SIZE is sent as uploaded,
+without a decode-encode round trip.
+
+PIL is imported by the first preprocessing, the app starts without it.
+"""
+
+from io import BytesIO
+
+# largest upload accepted
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+# longest side of the image sent to the extraction
+MAX_SIZE = (1024, 1024)
+JPEG_MODES = ("RGB", "L")
+# largest JPEG sent as uploaded, base64 in the 256 KB payload of an async Lambda invoke
+MAX_PASSTHROUGH_BYTES = 128 * 1024
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def fits(image, size=MAX_SIZE):
+    return image.width <= size[0] and image.height <= size[1]
+
+
+def prepare_receipt(data, size=MAX_SIZE):
+    """
+    Validate the uploaded image bytes and return them as a JPEG that fits size.
+
+    Raise InvalidImage if the bytes are not a complete image PIL can read.
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(BytesIO(data))
+        if (
+            image.format == "JPEG"
+            and image.mode in JPEG_MODES
+            and fits(image, size)
+            and len(data) <= MAX_PASSTHROUGH_BYTES
+        ):
+            image.load()
+            return data
+        if image.format == "JPEG":
+            # decode at the smallest DCT scale still covering size
+            image.draft("RGB", size)
+        image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        # UnidentifiedImageError and truncated data are OSErrors
+        raise InvalidImage(str(e)) from e
+
+    # draft already did the coarse reduction, the resampling does the rest
+    image.thumbnail(size, reducing_gap=None)
+    if image.mode not in JPEG_MODES:
+        image = image.convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    return buffered.getvalue()
@@ -0,0 +1,109 @@
+"""
+File: receipt_transactions.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Turn the Invoice of a completed receipt task into expense transactions
+
+One transaction per category subtotal (the default, what the receipt screen
+confirms) or one per product. The rows are inserted with one bulk_create and
+posted to the ledger with one ledger.record (one budget delta pass, one
+notification evaluation), in one atomic block. A receipt is added once (a
+unique MaterializedReceipt row per user and task), the transactions keep the
+task id.
+
+The category names are mapped with the cached matcher of the user
+(category_matcher), and the categories the user corrected on the products are
+learnt as aliases for the next receipts.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import IntegrityError, transaction
+from . import changes, ledger
+from .category_matcher import get_matcher, learn_aliases
+from .models import MaterializedReceipt, Transactions
+
+CENT = Decimal("0.01")
+
+
+class AlreadyAdded(Exception):
+    pass
+
+
+def receipt_lines(invoice, split="category", notes="Add by receipt"):
+    """
+    Return the (category name, amount, notes) lines of an Invoice dict, per category subtotal or per product.
+    """
+    if split == "product":
+        lines = [
+            (
+                product["category"],
+                product["product_total_price"],
+                f"{notes}: {product['product_description']}",
+            )
+            for product in invoice["product"]
+        ]
+    else:
+        lines = [
+            (category, amount, notes)
+            for category, amount in invoice["total_bill"]["category_subtotals"].items()
+        ]
+    return [
+        (category, Decimal(str(amount)).quantize(CENT, ROUND_HALF_UP), line_notes)
+        for category, amount, line_notes in lines
+    ]
+
+
+def materialize_receipt(
+    user,
+    task_id,
+    invoice,
+    occu_date,
+    split="category",
+    notes="Add by receipt",
+    original=None,
+):
+    """
+    Create the expense transactions of the invoice, return (transactions, skipped lines).
+
+    A line whose category matches no expense category of the user, or whose
+    amount is not positive, is skipped; nothing is written if every line is.
+    Raise AlreadyAdded if the receipt was already added. original is the
+    extracted Invoice when invoice is the user's edit of it, the changed
+    product categories are learnt.
+    """
+    matcher = get_matcher(user)
+    rows, skipped = [], []
+    for name, amount, line_notes in receipt_lines(invoice, split, notes):
+        category = matcher.match(name)
+        if category is None or amount <= 0:
+            reason = "unknown category" if category is None else "amount"
+            skipped.append({"category": name, "amount": amount, "reason": reason})
+            continue
+        rows.append(
+            Transactions(
+                user=user,
+                types="expense",
+                amount=amount,
+                category=category,
+                occu_date=occu_date,
+                notes=line_notes,
+                receipt_task=task_id,
+            )
+        )
+
+    if not rows:
+        return rows, skipped
+
+    with transaction.atomic():
+        # the unique marker, not a check of existing rows: a concurrent request
+        # for the same task waits on it and fails once this one commits
+        try:
+            MaterializedReceipt.objects.create(user=user, task_id=task_id)
+        except IntegrityError:
+            raise AlreadyAdded(task_id)
+        # one insert, one rollup pass, one spent delta per (budget, period)
+        rows = Transactions.objects.bulk_create(changes.stamp(rows), batch_size=500)
+        ledger.record(added=rows)
+        if original is not None and original != invoice:
+            learn_aliases(user, original, invoice)
+    return rows, skipped
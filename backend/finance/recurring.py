@@ -0,0 +1,189 @@
+"""
+File: recurring.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Schedule of the recurring rules and the bulk materialization of their occurrences
+
+The due rules are read in batches (next_date <= until, by id). For every
+batch, all the occurrences up to ``until`` (a backlog of months after a
+downtime included) are inserted with one bulk_create, posted to the ledger
+with one ledger.record (rollups, totals, budget spent, notifications), and
+the next_date of the rules is moved past them, all in one transaction. The
+cost per batch is a handful of queries whatever the number of occurrences.
+
+Occurrences are unique per (rule, date) in the database, the ones already
+there are skipped, so running the scheduler twice never doubles a rent.
+"""
+
+import calendar
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, timedelta
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from . import changes, ledger
+from .models import RecurringRule, Transactions
+
+# times a batch colliding with a concurrent run is read again
+MAX_RETRIES = 3
+
+
+def add_months(day, months, anchor_day):
+    """
+    Move day by months, on anchor_day or the last day of the month if it is shorter.
+    """
+    index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(index, 12)
+    month += 1
+    return date(year, month, min(anchor_day, calendar.monthrange(year, month)[1]))
+
+
+def following(rule, day):
+    """
+    Return the occurrence of the rule after the occurrence ``day``.
+    """
+    if rule.frequency == "daily":
+        return day + timedelta(days=rule.interval)
+    if rule.frequency == "weekly":
+        return day + timedelta(weeks=rule.interval)
+    months = rule.interval * (12 if rule.frequency == "yearly" else 1)
+    # anchored on the start day, Jan 31 -> Feb 28 -> Mar 31
+    return add_months(day, months, rule.start_date.day)
+
+
+def first_occurrence(rule, day):
+    """
+    Return the first occurrence of the rule on or after day, None if the rule has ended by then.
+    """
+    start = rule.start_date
+    if day <= start:
+        found = start
+    elif rule.frequency in ("daily", "weekly"):
+        step = rule.interval * (7 if rule.frequency == "weekly" else 1)
+        found = start + timedelta(days=-(-(day - start).days // step) * step)
+    else:
+        step = rule.interval * (12 if rule.frequency == "yearly" else 1)
+        months = (day.year - start.year) * 12 + day.month - start.month
+        found = add_months(start, months // step * step, start.day)
+        if found < day:
+            found = add_months(start, (months // step + 1) * step, start.day)
+    if rule.end_date and found > rule.end_date:
+        return None
+    return found
+
+
+def due_dates(rule, until):
+    """
+    Return (the occurrences of the rule from next_date up to until, the next_date after them).
+    """
+    dates = []
+    day = rule.next_date
+    while day is not None and day <= until:
+        if rule.end_date and day > rule.end_date:
+            day = None
+            break
+        dates.append(day)
+        day = following(rule, day)
+    if day is not None and rule.end_date and day > rule.end_date:
+        day = None
+    return dates, day
+
+
+def materialize(rules, until):
+    """
+    Create the due transactions of a batch of rules and move their next_date, return the created transactions.
+
+    Must run in a transaction, the caller holds the rules.
+    """
+    planned = []
+    for rule in rules:
+        dates, rule.next_date = due_dates(rule, until)
+        planned += [(rule, day) for day in dates]
+    if not planned:
+        return []
+
+    # occurrences created by a concurrent run or by an earlier version of the rule
+    existing = set(
+        Transactions.objects.filter(
+            recurring_rule__in=[rule.id for rule in rules],
+            occu_date__gte=min(day for _, day in planned),
+        ).values_list("recurring_rule_id", "occu_date")
+    )
+    transactions = Transactions.objects.bulk_create(
+        changes.stamp(
+            [
+                Transactions(
+                    user_id=rule.user_id,
+                    category_id=rule.category_id,
+                    types=rule.types,
+                    amount=rule.amount,
+                    occu_date=day,
+                    notes=rule.notes,
+                    recurring_rule=rule,
+                )
+                for rule, day in planned
+                if (rule.id, day) not in existing
+            ]
+        ),
+        batch_size=500,
+    )
+    # one UPDATE per new next_date: the rules of a batch share few of them, and
+    # a bulk_update builds a CASE of every rule
+    moved = defaultdict(list)
+    for rule in rules:
+        moved[rule.next_date].append(rule.id)
+    for next_date, ids in moved.items():
+        RecurringRule.objects.filter(id__in=ids).update(next_date=next_date)
+    ledger.record(added=transactions)
+    return transactions
+
+
+@dataclass
+class MaterializeResult:
+    rules: int = 0
+    created: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+
+def materialize_due(until=None, batch_size=1000, user_id=None):
+    """
+    Materialize every occurrence due up to until (default today), batch by batch.
+
+    Each batch commits on its own. On PostgreSQL the rules are locked with
+    SKIP LOCKED, so concurrent schedulers split the work; elsewhere a batch
+    that collides with another run is simply read again.
+    """
+    until = until or timezone.localdate()
+    result = MaterializeResult()
+    started = time.perf_counter()
+    last_id = 0
+    retries = 0
+    while True:
+        rules = RecurringRule.objects.filter(
+            next_date__lte=until, id__gt=last_id
+        ).order_by("id")
+        if user_id is not None:
+            rules = rules.filter(user_id=user_id)
+        if connection.features.has_select_for_update_skip_locked:
+            rules = rules.select_for_update(skip_locked=True)
+        try:
+            with transaction.atomic():
+                batch = list(rules[:batch_size])
+                if not batch:
+                    break
+                created = materialize(batch, until)
+        except IntegrityError:
+            # another run materialized some of these occurrences, read them again
+            retries += 1
+            if retries > MAX_RETRIES:
+                raise
+            continue
+        retries = 0
+        last_id = batch[-1].id
+        result.rules += len(batch)
+        result.created += len(created)
+        result.batches += 1
+    result.seconds = time.perf_counter() - started
+    return result
@@ -0,0 +1,158 @@
+"""
+File: report_engine.py
+Author: Haitao Wang
+Date: 2024-10-02
+Description: Report engine, build the report sections from one grouped query
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+from django.db.models import Sum
+from .models import Budgets, MonthlyRollup
+
+
+def monthly_totals(user):
+    """
+    Return the user's totals grouped by (year, month, types, category name).
+
+    This is the only query the engine issues, it reads the monthly rollup table,
+    so its cost depends on the number of months and categories, not on the
+    number of transactions.
+    """
+    return (
+        MonthlyRollup.objects.filter(user=user, count__gt=0)
+        .values("year", "month", "types", "category__name")
+        .annotate(sum_total=Sum("total"))
+        .order_by("year", "month", "category__name")
+    )
+
+
+def build_report(user, year):
+    """
+    Build the trends, category pie, cash flow and year-end summary sections.
+
+    Query count: exactly 1 (``monthly_totals``), no matter how long the history is.
+    All the joins between the sections are done with dicts keyed by (year, month).
+    """
+    income_by_month = defaultdict(Decimal)
+    expense_by_month = defaultdict(Decimal)
+    expense_by_category = defaultdict(Decimal)
+    expense_trends = []
+
+    for row in monthly_totals(user):
+        period = (row["year"], row["month"])
+        total = row["sum_total"]
+        if row["types"] == "income":
+            income_by_month[period] += total
+        else:
+            expense_by_month[period] += total
+            expense_by_category[row["category__name"]] += total
+            expense_trends.append(
+                {
+                    "year": row["year"],
+                    "month": row["month"],
+                    "category_name": row["category__name"],
+                    "total": total,
+                }
+            )
+
+    income_trends = [
+        {"year": y, "month": m, "total": total}
+        for (y, m), total in income_by_month.items()
+    ]
+
+    expense_categories = [
+        {"category__name": name, "total": total}
+        for name, total in sorted(expense_by_category.items())
+    ]
+
+    # cash flow (income - expenses) for every month that has any activity
+    cash_flow = []
+    for y, m in sorted(income_by_month.keys() | expense_by_month.keys()):
+        income_total = income_by_month.get((y, m), Decimal("0"))
+        expense_total = expense_by_month.get((y, m), Decimal("0"))
+        cash_flow.append(
+            {
+                "year": y,
+                "month": m,
+                "income_total": income_total,
+                "expense_total": expense_total,
+                "cash_flow": float(income_total) - float(expense_total),
+            }
+        )
+
+    # year-end financial summary
+    total_income = sum(
+        (total for (y, m), total in income_by_month.items() if y == year),
+        Decimal("0"),
+    )
+    total_expenses = sum(
+        (total for (y, m), total in expense_by_month.items() if y == year),
+        Decimal("0"),
+    )
+
+    return {
+        "income_trends": income_trends,
+        "expense_trends": expense_trends,
+        "expense_categories": expense_categories,
+        "cash_flow": cash_flow,
+        "year_end_summary": {
+            "total_income": total_income,
+            "total_expenses": total_expenses,
+            "net_savings": float(total_income) - float(total_expenses),
+        },
+    }
+
+
+def budget_vs_actual(user):
+    """
+    Compare every budget of the user with the actual spending of its period.
+
+    Query count: exactly 2, the budgets with their category, and one grouped
+    aggregate of the expense rollups by (category, year, month). Monthly budgets
+    look up their month, yearly budgets sum the months of their year.
+    """
+    budgets = list(
+        Budgets.objects.filter(user=user)
+        .select_related("category")
+        .order_by("year", "month", "category__name")
+    )
+    if not budgets:
+        return []
+
+    spent_by_month = defaultdict(Decimal)
+    spent_by_year = defaultdict(Decimal)
+    rows = (
+        MonthlyRollup.objects.filter(
+            user=user,
+            types="expense",
+            category_id__in={budget.category_id for budget in budgets},
+            year__in={budget.year for budget in budgets},
+        )
+        .values("category_id", "year", "month")
+        .annotate(sum_total=Sum("total"))
+        .order_by()
+    )
+    for row in rows:
+        spent_by_month[(row["category_id"], row["year"], row["month"])] += row[
+            "sum_total"
+        ]
+        spent_by_year[(row["category_id"], row["year"])] += row["sum_total"]
+
+    result = []
+    for budget in budgets:
+        if budget.period_type == "yearly":
+            actual = spent_by_year.get((budget.category_id, budget.year))
+        else:
+            actual = spent_by_month.get((budget.category_id, budget.year, budget.month))
+        result.append(
+            {
+                "year": budget.year,
+                "month": budget.month,
+                "period_type": budget.period_type,
+                "category__name": budget.category.name,
+                "budgeted_amount": budget.limits,
+                "actual_amount": actual or Decimal("0"),
+            }
+        )
+    return result
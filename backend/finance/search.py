@@ -0,0 +1,167 @@
+"""
+File: search.py
+Author: Haitao Wang
+Date: 2024-10-17
+Description: Filters and full-text search over the notes of the transactions
+
+- PostgreSQL: GIN index on to_tsvector('simple', notes), matched with to_tsquery.
+- SQLite: FTS5 table of (owner, notes) written next to the transactions by
+  ledger.record and Transactions.delete, inside their transaction. owner is a
+  "u<user id>" token ANDed into the MATCH, so the full-text side only returns
+  the rows of the user instead of every user's matches.
+- Other databases, or SQLite built without FTS5: one icontains per word.
+
+Every word of the search must match, as a prefix ("groc" finds "groceries").
+"""
+
+import re
+from datetime import timedelta
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+TS_CONFIG = "simple"
+PG_INDEX = "trans_notes_fts_idx"
+FTS_TABLE = "finance_transactions_fts"
+TABLE = "finance_transactions"
+MAX_TERMS = 8
+WORD_RE = re.compile(r"\w+")
+
+_fts_tables = {}
+
+
+def search_terms(text):
+    """
+    Split a search into lower case words, the only characters that reach the query syntax.
+    """
+    return WORD_RE.findall(text.lower())[:MAX_TERMS]
+
+
+def has_fts_table(connection):
+    key = (connection.alias, connection.settings_dict["NAME"])
+    if key not in _fts_tables:
+        _fts_tables[key] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[key]
+
+
+def search_notes(queryset, text, user_id):
+    """
+    Filter a Transactions queryset of the user to the rows whose notes contain every word of text.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset
+    connection = connections[queryset.db]
+
+    if connection.vendor == "postgresql":
+        notes = f"{connection.ops.quote_name(TABLE)}.notes"
+        return queryset.filter(
+            RawSQL(
+                f"to_tsvector('{TS_CONFIG}', {notes}) @@ to_tsquery('{TS_CONFIG}', %s)",
+                [" & ".join(f"{term}:*" for term in terms)],
+                output_field=BooleanField(),
+            )
+        )
+
+    if connection.vendor == "sqlite" and has_fts_table(connection):
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                [
+                    f'owner : "u{int(user_id)}" AND notes : ('
+                    + " ".join(f'"{term}"*' for term in terms)
+                    + ")"
+                ],
+            )
+        )
+
+    for term in terms:
+        queryset = queryset.filter(notes__icontains=term)
+    return queryset
+
+
+def filter_transactions(queryset, filters, user_id):
+    """
+    Apply the validated list filters (TransactionFilterSerializer) to a Transactions queryset.
+
+    The queryset is already restricted to user_id, so every filter keeps the
+    user_id prefix of the (user, types/category/occu_date) indexes usable.
+    """
+    if "start_date" in filters:
+        queryset = queryset.filter(occu_date__gte=filters["start_date"])
+    if "end_date" in filters:
+        # inclusive end date, as a half-open bound like periods.in_range
+        queryset = queryset.filter(
+            occu_date__lt=filters["end_date"] + timedelta(days=1)
+        )
+    if "category" in filters:
+        queryset = queryset.filter(category_id__in=filters["category"])
+    if "types" in filters:
+        queryset = queryset.filter(types=filters["types"])
+    if "min_amount" in filters:
+        queryset = queryset.filter(amount__gte=filters["min_amount"])
+    if "max_amount" in filters:
+        queryset = queryset.filter(amount__lte=filters["max_amount"])
+    if filters.get("search"):
+        queryset = search_notes(queryset, filters["search"], user_id)
+    return queryset
+
+
+def fts_connection(using):
+    """
+    Return the connection if it keeps an FTS5 table, else None.
+    """
+    connection = connections[using]
+    if connection.vendor == "sqlite" and has_fts_table(connection):
+        return connection
+    return None
+
+
+def index_transactions(transactions):
+    """
+    Write the notes of saved transactions (new or updated) to the FTS5 table.
+
+    Called after the rows are written, in the same transaction. Not done by
+    triggers: a trigger makes every INSERT open the FTS5 table before taking
+    the write lock, and concurrent SQLite writers then fail with "database is
+    locked" instead of waiting for each other.
+    """
+    transactions = [txn for txn in transactions if txn.pk is not None]
+    if not transactions:
+        return
+    connection = fts_connection(transactions[0]._state.db or "default")
+    if connection is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {FTS_TABLE}(rowid, owner, notes) VALUES (%s, %s, %s)",
+            [(txn.pk, f"u{txn.user_id}", txn.notes) for txn in transactions],
+        )
+
+
+def unindex_transactions(ids, using="default"):
+    """
+    Remove deleted transactions from the FTS5 table.
+    """
+    connection = fts_connection(using)
+    if connection is None or not ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(pk,) for pk in ids]
+        )
+
+
+def rebuild_index(using="default"):
+    """
+    Refill the FTS5 table from the transactions (after raw or bulk writes that skipped the ledger).
+    """
+    connection = fts_connection(using)
+    if connection is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, owner, notes) "
+            f"SELECT id, 'u' || user_id, notes FROM {TABLE}"
+        )
@@ -7,7 +7,10 @@ Description: serializer implement of the models
 
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Transactions, Budgets, Categories, Notification
+from django.utils import timezone
+from .models import Transactions, Budgets, Categories, Notification, RecurringRule
+from .fieldsets import SparseFieldsMixin
+from .recurring import first_occurrence
 
 User = get_user_model()
 
@@ -113,7 +116,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
         return instance
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for category .
 
@@ -130,16 +133,31 @@ class CategorySerializer(serializers.ModelSerializer):
         read_only_fields = ["id"]
 
 
-class BudgetSerializer(serializers.ModelSerializer):
+class UserCategoryField(serializers.PrimaryKeyRelatedField):
+    """
+    Write-only category id, the global categories and the user's own, never another user's.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("write_only", True)
+        kwargs.setdefault("source", "category")
+        super().__init__(**kwargs)
+
+    def get_queryset(self):
+        request = self.context.get("request")
+        if request is None:
+            return Categories.objects.filter(user__isnull=True)
+        return Categories.objects.for_user(request.user)
+
+
+class BudgetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for budget .
 
     """
 
     category = CategorySerializer(read_only=True)
-    category_id = serializers.PrimaryKeyRelatedField(
-        queryset=Categories.objects.all(), write_only=True, source="category"
-    )
+    category_id = UserCategoryField()
 
     class Meta:
         model = Budgets
@@ -153,18 +171,33 @@ class BudgetSerializer(serializers.ModelSerializer):
             "month",
             "year",
         ]
-        read_only_fields = ["id", "category_id"]
+        # spent is maintained from the transactions
+        read_only_fields = ["id", "category_id", "spent"]
 
+    def validate(self, attrs):
+        period_type = attrs.get(
+            "period_type", getattr(self.instance, "period_type", None)
+        )
+        month = attrs.get("month", getattr(self.instance, "month", None))
+        year = attrs.get("year", getattr(self.instance, "year", None))
+        if period_type == "monthly" and month is None:
+            raise serializers.ValidationError(
+                {"month": "A monthly budget needs a month."}
+            )
+        if month is not None and not 1 <= month <= 12:
+            raise serializers.ValidationError({"month": "month must be 1 to 12."})
+        if year is not None and not 1 <= year < 9999:
+            raise serializers.ValidationError({"year": "year must be 1 to 9998."})
+        return attrs
 
-class TransactionSerializer(serializers.ModelSerializer):
+
+class TransactionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for Transaction .
     """
 
     category = CategorySerializer(read_only=True)
-    category_id = serializers.PrimaryKeyRelatedField(
-        queryset=Categories.objects.all(), write_only=True, source="category"
-    )
+    category_id = UserCategoryField()
 
     amount = serializers.DecimalField(max_digits=10, decimal_places=2)
 
@@ -182,7 +215,71 @@ class TransactionSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "category_id"]
 
 
-class NotificationSerializer(serializers.ModelSerializer):
+class RecurringRuleSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """
+    Serializer for recurring rule .
+
+    Fields:
+        frequency (str): daily, weekly, monthly or yearly.
+        interval (int): every <interval> days/weeks/months/years.
+        start_date, end_date (date): the first occurrence, the optional last day.
+        next_date (date): the next occurrence to create, null once the rule has ended.
+    """
+
+    category = CategorySerializer(read_only=True)
+    category_id = UserCategoryField()
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+    # the fields that move the next occurrence when they change
+    SCHEDULE_FIELDS = ("frequency", "interval", "start_date", "end_date")
+
+    class Meta:
+        model = RecurringRule
+        fields = [
+            "id",
+            "category",
+            "category_id",
+            "types",
+            "amount",
+            "notes",
+            "frequency",
+            "interval",
+            "start_date",
+            "end_date",
+            "next_date",
+        ]
+        read_only_fields = ["id", "next_date"]
+
+    def validate(self, attrs):
+        start_date = attrs.get("start_date", getattr(self.instance, "start_date", None))
+        end_date = attrs.get("end_date", getattr(self.instance, "end_date", None))
+        if start_date and end_date and end_date < start_date:
+            raise serializers.ValidationError("end_date must not be before start_date.")
+        return attrs
+
+    def create(self, validated_data):
+        # a start in the past is caught up by the next scheduler run
+        validated_data["next_date"] = validated_data["start_date"]
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        rescheduled = any(
+            getattr(instance, name) != validated_data[name]
+            for name in self.SCHEDULE_FIELDS
+            if name in validated_data
+        )
+        instance = super().update(instance, validated_data)
+        if rescheduled:
+            # the new schedule starts from today, the occurrences already
+            # created are kept and never created twice
+            instance.next_date = first_occurrence(
+                instance, max(instance.start_date, timezone.localdate())
+            )
+            instance.save(update_fields=["next_date", "updated_at"])
+        return instance
+
+
+class NotificationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for notification .
 
@@ -192,3 +289,106 @@ class NotificationSerializer(serializers.ModelSerializer):
         model = Notification
         fields = ["id", "user_id", "notify", "types", "create_time"]
         read_only_fields = ["id"]
+
+
+class BulkTransactionListSerializer(serializers.ListSerializer):
+    """
+    List serializer for the bulk transaction create, validates all the categories with one query.
+    """
+
+    def validate(self, attrs):
+        user = self.context["request"].user
+        category_ids = {row["category_id"] for row in attrs}
+        categories = Categories.objects.for_user(user).in_bulk(category_ids)
+        missing = category_ids - categories.keys()
+        if missing:
+            raise serializers.ValidationError(
+                f"Unknown categories: {', '.join(map(str, sorted(missing)))}."
+            )
+        for row in attrs:
+            row["category"] = categories[row.pop("category_id")]
+        return attrs
+
+
+class BulkTransactionSerializer(serializers.ModelSerializer):
+    """
+    Serializer for one row of a bulk transaction create.
+    """
+
+    category_id = serializers.IntegerField(write_only=True)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        model = Transactions
+        fields = ["types", "amount", "category_id", "occu_date", "notes"]
+        list_serializer_class = BulkTransactionListSerializer
+
+
+class TransactionFilterSerializer(serializers.Serializer):
+    """
+    Query params of the transaction list filters.
+
+    Fields:
+        start_date, end_date (date): inclusive bounds of occu_date.
+        category (str): category id, or comma separated ids.
+        types (str): income or expense.
+        min_amount, max_amount (decimal): inclusive bounds of amount.
+        search (str): words that must all appear in the notes.
+    """
+
+    start_date = serializers.DateField(required=False)
+    end_date = serializers.DateField(required=False)
+    category = serializers.CharField(required=False)
+    types = serializers.ChoiceField(choices=Transactions.TRANS_TYPES, required=False)
+    min_amount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, required=False
+    )
+    max_amount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, required=False
+    )
+    search = serializers.CharField(required=False, max_length=200)
+
+    def validate_category(self, value):
+        try:
+            return [int(category_id) for category_id in value.split(",")]
+        except ValueError:
+            raise serializers.ValidationError("Expected comma separated ids.")
+
+    def validate(self, attrs):
+        if attrs.get("start_date") and attrs.get("end_date"):
+            if attrs["start_date"] > attrs["end_date"]:
+                raise serializers.ValidationError(
+                    "start_date must not be after end_date."
+                )
+        if attrs.get("min_amount") is not None and attrs.get("max_amount") is not None:
+            if attrs["min_amount"] > attrs["max_amount"]:
+                raise serializers.ValidationError(
+                    "min_amount must not be greater than max_amount."
+                )
+        return attrs
+
+
+class ReceiptTransactionsSerializer(serializers.Serializer):
+    """
+    Options of the transactions created from a receipt task.
+
+    Fields:
+        split (str): category (one transaction per category subtotal) or product.
+        occu_date (date): date of the transactions, today by default.
+        notes (str): notes of the transactions (product lines add the description).
+        result (dict): the Invoice as edited by the user, the task result by default.
+    """
+
+    split = serializers.ChoiceField(choices=["category", "product"], default="category")
+    occu_date = serializers.DateField(default=timezone.localdate)
+    notes = serializers.CharField(default="Add by receipt", max_length=200)
+    result = serializers.JSONField(required=False)
+
+    def validate_result(self, value):
+        # the pydantic models are built on the first result, not at startup
+        from .receipt import validate_result
+
+        try:
+            return validate_result(value)
+        except ValueError:
+            raise serializers.ValidationError("Not a valid invoice.")
@@ -0,0 +1,135 @@
+"""
+File: sync.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Delta sync of the transactions, budgets and categories of a user
+
+Every synced row carries the change number of its last write (change_seq,
+see finance.changes; the ledger and reconcile_budgets also take one when they
+move Budgets.spent) and every delete leaves a Tombstone with its own number.
+A sync returns the rows changed and the ids deleted since the watermark of the
+previous sync, read with the (user, change_seq) indexes.
+
+The watermark is the signed pair of change numbers (the user's, the global
+categories') read before the rows, and the time of the sync. The numbers are
+assigned by the database and commit in order, so a row written in a long
+transaction that commits after a sync gets a number above its watermark and
+is sent by the next sync.
+"""
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from .changes import current_numbers
+from .fieldsets import shape_queryset
+from .models import Budgets, Categories, Tombstone, Transactions
+from .serializers import BudgetSerializer, CategorySerializer, TransactionSerializer
+
+SALT = "finance.sync"
+KINDS = (
+    ("transactions", TransactionSerializer),
+    ("budgets", BudgetSerializer),
+    ("categories", CategorySerializer),
+)
+
+
+class InvalidWatermark(Exception):
+    pass
+
+
+class Watermark:
+    """
+    The change numbers (of the user, of the global categories) a sync has sent, and when it ran.
+    """
+
+    def __init__(self, user_seq, global_seq, synced_at):
+        self.user_seq = user_seq
+        self.global_seq = global_seq
+        self.synced_at = synced_at
+
+    def changed(self, shared=False):
+        """
+        The rows written after the watermark; with shared, also the global rows (user null) by their own counter.
+        """
+        condition = Q(change_seq__gt=self.user_seq)
+        if not shared:
+            return condition
+        return Q(condition, user__isnull=False) | Q(
+            user__isnull=True, change_seq__gt=self.global_seq
+        )
+
+
+def encode_watermark(watermark):
+    return signing.dumps(
+        [watermark.user_seq, watermark.global_seq, watermark.synced_at.isoformat()],
+        salt=SALT,
+    )
+
+
+def decode_watermark(token):
+    try:
+        user_seq, global_seq, synced_at = signing.loads(token, salt=SALT)
+        return Watermark(
+            int(user_seq), int(global_seq), datetime.fromisoformat(synced_at)
+        )
+    except (signing.BadSignature, TypeError, ValueError):
+        raise InvalidWatermark("Invalid watermark, sync again without since.")
+
+
+def synced_queryset(kind, user):
+    if kind == "transactions":
+        return Transactions.objects.filter(user=user)
+    if kind == "budgets":
+        return Budgets.objects.filter(user=user)
+    return Categories.objects.for_user(user)
+
+
+def changes(user, since=None):
+    """
+    Return the sync response of the user: the rows changed and the ids deleted since the watermark.
+
+    Without a watermark, or with one older than the kept tombstones, every row
+    is returned and reset is set: the client must drop what it has first.
+    """
+    now = timezone.now()
+    reset = since is None or since.synced_at < now - timedelta(
+        days=settings.SYNC_TOMBSTONE_DAYS
+    )
+    # read before the rows: every number up to these is committed, the rows
+    # read below can only be newer (sent again next time, applied as upserts)
+    result = {
+        "watermark": encode_watermark(Watermark(*current_numbers(user.id), now)),
+        "reset": reset,
+    }
+    for kind, serializer_class in KINDS:
+        queryset = synced_queryset(kind, user)
+        if not reset:
+            queryset = queryset.filter(since.changed(shared=kind == "categories"))
+        queryset = shape_queryset(
+            queryset.order_by("change_seq", "id"), serializer_class()
+        )
+        result[kind] = serializer_class(queryset, many=True).data
+
+    deleted = {kind: [] for kind, _ in KINDS}
+    if not reset:
+        tombstones = Tombstone.objects.filter(
+            Q(user=user) | Q(user__isnull=True), since.changed(shared=True)
+        ).values_list("kind", "object_id")
+        for kind, object_id in tombstones:
+            deleted[kind].append(object_id)
+    result["deleted"] = deleted
+    return result
+
+
+def prune_tombstones():
+    """
+    Delete the tombstones older than SYNC_TOMBSTONE_DAYS, return the number deleted.
+
+    The watermarks older than that get a reset, so no client misses a delete.
+    """
+    deleted, _ = Tombstone.objects.filter(
+        deleted_at__lt=timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    ).delete()
+    return deleted
@@ -1,3 +1,1386 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from unittest import skipIf
+from unittest.mock import patch
 
 # Create your tests here.
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection, transaction as db_transaction
+from django.db.models import F
+from PIL import Image
+from .models import (
+    Budgets,
+    Categories,
+    CategoryAlias,
+    ChangeCounter,
+    CustomUser,
+    IdempotencyKey,
+    MonthlyRollup,
+    Notification,
+    ReceiptTask,
+    ReceiptUpload,
+    RecurringRule,
+    Transactions,
+    UserTotals,
+)
+from . import receipt_backends, receipt_dedupe
+from .cache import cache_stats, get_data_version
+from .idempotency import REPLAY_HEADER
+from .category_matcher import get_matcher
+from .pagination import KeysetPagination
+from .report_engine import budget_vs_actual, build_report
+from .ledger import user_totals
+from .importers import StatementError, import_statement
+from .receipt_backends import AWSReceiptBackend, LocalReceiptBackend
+from .receipt_batch import batch_status, submit_batch
+from .receipt_extract import simulated_invoice
+from .receipt_image import InvalidImage, prepare_receipt
+from .receipt_transactions import AlreadyAdded, materialize_receipt
+from .recurring import first_occurrence, materialize_due
+
+# the threads need a database that takes concurrent writers, the SQLite test
+# database fails them with "database table is locked"
+concurrent_writes = skipIf(
+    connection.vendor == "sqlite", "SQLite does not take concurrent writers"
+)
+
+
+class BudgetLedgerConcurrencyTest(TransactionTestCase):
+    """
+    Many threads write expenses of the same budget at once, no delta may be lost.
+    """
+
+    threads = 8
+    rows_per_thread = 15
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="ledger", email="ledger@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.fuel = Categories.objects.create(name="Fuel", category_type="expense")
+        self.monthly = Budgets.objects.create(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("100000"),
+            period_type="monthly",
+            month=3,
+            year=2024,
+        )
+        self.yearly = Budgets.objects.create(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("100000"),
+            period_type="yearly",
+            year=2024,
+        )
+        self.other = Budgets.objects.create(
+            user=self.user,
+            category=self.fuel,
+            limits=Decimal("100000"),
+            period_type="monthly",
+            month=4,
+            year=2024,
+        )
+
+    def hammer(self, work):
+        errors = []
+
+        def run(index):
+            try:
+                work(index)
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+    def assertSpentMatchesTransactions(self):
+        for budget in Budgets.objects.all():
+            self.assertEqual(budget.spent, budget.calculate_spent(), budget.period())
+
+    @concurrent_writes
+    def test_concurrent_creates_updates_and_deletes(self):
+        def create(index):
+            for i in range(self.rows_per_thread):
+                Transactions.objects.create(
+                    user=self.user,
+                    types="expense",
+                    amount=Decimal("1.25"),
+                    category=self.food,
+                    occu_date=date(2024, 3, 1 + i % 28),
+                    notes=f"thread {index} row {i}",
+                )
+
+        self.hammer(create)
+        total = Decimal("1.25") * self.threads * self.rows_per_thread
+        self.monthly.refresh_from_db()
+        self.yearly.refresh_from_db()
+        self.assertEqual(self.monthly.spent, total)
+        self.assertEqual(self.yearly.spent, total)
+
+        rows = list(Transactions.objects.order_by("id"))
+
+        def change(index):
+            for i, txn in enumerate(rows[index :: self.threads]):
+                if i % 3 == 0:
+                    txn.delete()
+                elif i % 3 == 1:
+                    # move to another category and month
+                    txn.category = self.fuel
+                    txn.occu_date = date(2024, 4, 2)
+                    txn.save()
+                else:
+                    txn.amount = Decimal("3.00")
+                    txn.save()
+
+        self.hammer(change)
+        self.assertSpentMatchesTransactions()
+
+    @concurrent_writes
+    def test_concurrent_writes_of_the_same_rows(self):
+        for i in range(self.rows_per_thread):
+            Transactions.objects.create(
+                user=self.user,
+                types="expense",
+                amount=Decimal("1.25"),
+                category=self.food,
+                occu_date=date(2024, 3, 1 + i),
+                notes=f"row {i}",
+            )
+        ids = list(Transactions.objects.order_by("id").values_list("id", flat=True))
+
+        def change(index):
+            # every thread loads the rows before any write, then writes all of them
+            rows = list(Transactions.objects.filter(id__in=ids).order_by("id"))
+            for i, txn in enumerate(rows):
+                if i % 2 == 0:
+                    txn.delete()
+                else:
+                    txn.amount = Decimal(index + 1)
+                    txn.save()
+
+        self.hammer(change)
+        self.assertEqual(Transactions.objects.count(), self.rows_per_thread // 2)
+        self.assertSpentMatchesTransactions()
+
+    def test_stale_instances_of_the_same_row(self):
+        # what two requests see when they load the row before either writes
+        txn = Transactions.objects.create(
+            user=self.user,
+            types="expense",
+            amount=Decimal("1.25"),
+            category=self.food,
+            occu_date=date(2024, 3, 1),
+        )
+        first = Transactions.objects.get(pk=txn.pk)
+        second = Transactions.objects.get(pk=txn.pk)
+        first.amount = Decimal("5.00")
+        first.save()
+        second.amount = Decimal("7.00")
+        second.save()
+        self.assertSpentMatchesTransactions()
+
+        first = Transactions.objects.get(pk=txn.pk)
+        second = Transactions.objects.get(pk=txn.pk)
+        first.delete()
+        second.delete()
+        self.monthly.refresh_from_db()
+        self.assertEqual(self.monthly.spent, Decimal("0"))
+        self.assertSpentMatchesTransactions()
+
+    def test_budget_save_keeps_concurrent_spent(self):
+        stale = Budgets.objects.get(pk=self.monthly.pk)
+        Transactions.objects.create(
+            user=self.user,
+            types="expense",
+            amount=Decimal("10.00"),
+            category=self.food,
+            occu_date=date(2024, 3, 5),
+            notes="after the budget was loaded",
+        )
+        stale.limits = Decimal("500")
+        stale.save()
+        stale.refresh_from_db()
+        self.assertEqual(stale.spent, Decimal("10.00"))
+        self.assertEqual(stale.limits, Decimal("500"))
+
+
+class MaterializeReceiptTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="added", email="added@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        Categories.objects.create(name="Fuel", category_type="expense")
+        self.budget = Budgets.objects.create(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("20"),
+            period_type="monthly",
+            month=3,
+            year=2024,
+        )
+
+    def test_receipt_added_once(self):
+        invoice = {
+            "total_bill": {
+                "category_subtotals": {"Food": 12.5, "Spaceships": 3, "Fuel": 0}
+            }
+        }
+        rows, skipped = materialize_receipt(
+            self.user, "task-1", invoice, date(2024, 3, 4)
+        )
+        self.assertEqual([row.amount for row in rows], [Decimal("12.50")])
+        self.assertEqual(
+            [line["reason"] for line in skipped],
+            ["unknown category", "amount"],
+        )
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.spent, Decimal("12.50"))
+        with self.assertRaises(AlreadyAdded):
+            materialize_receipt(self.user, "task-1", invoice, date(2024, 3, 4))
+        self.assertEqual(Transactions.objects.filter(receipt_task="task-1").count(), 1)
+
+    def test_corrected_categories_are_learnt(self):
+        original = {
+            "product": [
+                {
+                    "category": "Snacks",
+                    "product_total_price": 4,
+                    "product_description": "chips",
+                }
+            ]
+        }
+        edited = {"product": [dict(original["product"][0], category="Food")]}
+        rows, skipped = materialize_receipt(
+            self.user,
+            "task-2",
+            edited,
+            date(2024, 3, 5),
+            split="product",
+            original=original,
+        )
+        self.assertEqual(rows[0].notes, "Add by receipt: chips")
+        alias = CategoryAlias.objects.get(user=self.user, name="snacks")
+        self.assertEqual(alias.category, self.food)
+        self.assertEqual(get_matcher(self.user).match("Snacks"), self.food)
+
+
+@concurrent_writes
+class MaterializeReceiptConcurrencyTest(TransactionTestCase):
+    """
+    Two requests add the same receipt at once, its transactions are created once.
+    """
+
+    def test_concurrent_materialize(self):
+        user = CustomUser.objects.create_user(
+            username="receipt", email="receipt@example.com", password="password123"
+        )
+        food = Categories.objects.create(name="Food", category_type="expense")
+        budget = Budgets.objects.create(
+            user=user,
+            category=food,
+            limits=Decimal("1000"),
+            period_type="monthly",
+            month=3,
+            year=2024,
+        )
+        invoice = {"total_bill": {"category_subtotals": {"Food": 12.5}}}
+        start = threading.Barrier(2)
+        results = []
+
+        def add():
+            try:
+                start.wait()
+                rows, _ = materialize_receipt(user, "task-1", invoice, date(2024, 3, 4))
+                results.append(len(rows))
+            except AlreadyAdded:
+                results.append("already added")
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=add) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(results, key=str), [1, "already added"])
+        self.assertEqual(Transactions.objects.filter(receipt_task="task-1").count(), 1)
+        budget.refresh_from_db()
+        self.assertEqual(budget.spent, Decimal("12.50"))
+
+
+class KeysetPaginationTest(TestCase):
+    def test_rows_of_one_millisecond_across_pages(self):
+        user = CustomUser.objects.create_user(
+            username="pages", email="pages@example.com", password="password123"
+        )
+        Notification.objects.bulk_create(
+            Notification(user=user, notify=f"n{i}", types="info") for i in range(5)
+        )
+        # one ledger pass: every create_time within the same millisecond
+        start = datetime(2024, 3, 4, 10, 20, 3, 456000, tzinfo=timezone.utc)
+        for i, notification in enumerate(Notification.objects.order_by("id")):
+            notification.create_time = start + timedelta(microseconds=100 * i)
+            notification.save(update_fields=["create_time"])
+
+        client = APIClient()
+        client.force_authenticate(user)
+        seen, url = [], "/notifications/?page_size=2"
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [row["notify"] for row in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(seen, ["n4", "n3", "n2", "n1", "n0"])
+
+    def test_cursor_of_another_list_or_unparsable_is_a_400(self):
+        user = CustomUser.objects.create_user(
+            username="cursor", email="cursor@example.com", password="password123"
+        )
+        Notification.objects.bulk_create(
+            Notification(user=user, notify=f"n{i}", types="info") for i in range(3)
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(
+            "/notifications/?page_size=1", HTTP_X_FORWARDED_PROTO="https"
+        )
+        self.assertTrue(response.data["next"].startswith("https://"))
+        cursor = response.data["next"].split("cursor=")[1]
+        response = client.get(f"/transactions/?cursor={cursor}")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"], "Invalid cursor")
+
+        # signed for the transactions, but not a date
+        paginator = KeysetPagination()
+        paginator.cursor_salt = "finance.pagination:finance.transactions:-occu_date:-id"
+        cursor = paginator.encode_cursor(["yesterday", 1])
+        self.assertEqual(client.get(f"/transactions/?cursor={cursor}").status_code, 400)
+
+
+class BulkCreateTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="bulk", email="bulk@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.budget = Budgets.objects.create(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("100"),
+            period_type="monthly",
+            year=2024,
+            month=5,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def row(self, amount, day=3):
+        return {
+            "types": "expense",
+            "amount": amount,
+            "category_id": self.food.id,
+            "occu_date": f"2024-05-{day:02d}",
+            "notes": "bulk",
+        }
+
+    def test_rows_and_budget_in_one_write(self):
+        response = self.client.post(
+            "/transactions/bulk/",
+            {"transactions": [self.row("5.00"), self.row("7.50", 20)]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(len(response.data), 2)
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.spent, Decimal("12.50"))
+        rollup = MonthlyRollup.objects.get(user=self.user, year=2024, month=5)
+        self.assertEqual((rollup.total, rollup.count), (Decimal("12.50"), 2))
+
+    def test_one_invalid_row_creates_nothing(self):
+        response = self.client.post(
+            "/transactions/bulk/",
+            [self.row("5.00"), self.row("not a number")],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transactions.objects.filter(user=self.user).exists())
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.spent, 0)
+
+
+class TransactionSearchTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="search", email="search@example.com", password="password123"
+        )
+        other = CustomUser.objects.create_user(
+            username="nosy", email="nosy@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.rows = {}
+        for user, notes, amount, day in [
+            (self.user, "Weekly groceries", "40.00", 3),
+            (self.user, "Grocery run, downtown", "8.00", 10),
+            (self.user, "Coffee", "3.00", 12),
+            (other, "groceries", "50.00", 3),
+        ]:
+            self.rows[(user.id, notes)] = Transactions.objects.create(
+                user=user,
+                types="expense",
+                amount=Decimal(amount),
+                category=self.food,
+                occu_date=date(2024, 5, day),
+                notes=notes,
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def notes(self, query):
+        response = self.client.get(f"/transactions/?{query}")
+        self.assertEqual(response.status_code, 200, response.data)
+        return sorted(row["notes"] for row in response.data["results"])
+
+    def test_prefix_search_of_the_own_rows(self):
+        self.assertEqual(
+            self.notes("search=GROC"), ["Grocery run, downtown", "Weekly groceries"]
+        )
+        self.assertEqual(self.notes("search=groc%20down"), ["Grocery run, downtown"])
+        self.assertEqual(self.notes("search=tea"), [])
+
+    def test_filters_combine_with_the_search(self):
+        self.assertEqual(self.notes("search=groc&min_amount=10"), ["Weekly groceries"])
+        self.assertEqual(
+            self.notes("start_date=2024-05-10&end_date=2024-05-12"),
+            ["Coffee", "Grocery run, downtown"],
+        )
+        self.assertEqual(
+            self.client.get("/transactions/?category=food").status_code, 400
+        )
+
+    def test_deleted_and_edited_rows_leave_the_index(self):
+        self.rows[(self.user.id, "Weekly groceries")].delete()
+        coffee = self.rows[(self.user.id, "Coffee")]
+        coffee.notes = "groceries after all"
+        coffee.save()
+        self.assertEqual(
+            self.notes("search=groc"),
+            ["Grocery run, downtown", "groceries after all"],
+        )
+
+
+class IdempotencyTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="retry", email="retry@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.budget = Budgets.objects.create(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("100"),
+            period_type="monthly",
+            year=2024,
+            month=5,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.body = {
+            "types": "expense",
+            "amount": "5.00",
+            "category_id": self.food.id,
+            "occu_date": "2024-05-03",
+            "notes": "retry",
+        }
+
+    def post(self, key, body):
+        return self.client.post(
+            "/transactions/", body, format="json", HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post("key-1", self.body)
+        self.assertEqual(first.status_code, 201, first.data)
+        retry = self.post("key-1", self.body)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry[REPLAY_HEADER], "true")
+        self.assertEqual(Transactions.objects.filter(user=self.user).count(), 1)
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.spent, Decimal("5.00"))
+
+        # another request under a used key, and a new key
+        other = self.post("key-1", dict(self.body, amount="6.00"))
+        self.assertEqual(other.status_code, 422)
+        self.assertEqual(self.post("key-2", self.body).status_code, 201)
+        self.assertEqual(Transactions.objects.filter(user=self.user).count(), 2)
+
+    def test_running_and_failed_requests(self):
+        IdempotencyKey.objects.create(
+            user=self.user,
+            key=hashlib.sha256(b"key-1").hexdigest(),
+            request_digest="",
+            expires_at=datetime.now(timezone.utc) + timedelta(minutes=1),
+        )
+        self.assertEqual(self.post("key-1", self.body).status_code, 409)
+
+        # a rejected request releases its key, the corrected one goes through
+        self.assertEqual(self.post("key-3", dict(self.body, notes="")).status_code, 400)
+        self.assertEqual(self.post("key-3", self.body).status_code, 201)
+        self.assertFalse(Transactions.objects.filter(notes="").exists())
+
+
+class RecurringTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="recurring", email="recurring@example.com", password="password123"
+        )
+        self.rent = Categories.objects.create(name="Rent", category_type="expense")
+        self.budget = Budgets.objects.create(
+            user=self.user,
+            category=self.rent,
+            limits=Decimal("2000"),
+            period_type="monthly",
+            year=2024,
+            month=2,
+        )
+
+    def rule(self, frequency, start_date, **fields):
+        return RecurringRule.objects.create(
+            user=self.user,
+            category=self.rent,
+            types="expense",
+            amount=Decimal("1000.00"),
+            notes="rent",
+            frequency=frequency,
+            start_date=start_date,
+            next_date=start_date,
+            **fields,
+        )
+
+    def test_backlog_materialized_once(self):
+        rule = self.rule("monthly", date(2024, 1, 31))
+        result = materialize_due(until=date(2024, 4, 15))
+        self.assertEqual((result.rules, result.created), (1, 3))
+        self.assertEqual(
+            list(
+                Transactions.objects.filter(recurring_rule=rule)
+                .order_by("occu_date")
+                .values_list("occu_date", flat=True)
+            ),
+            [date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31)],
+        )
+        rule.refresh_from_db()
+        self.assertEqual(rule.next_date, date(2024, 4, 30))
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.spent, Decimal("1000.00"))
+
+        # a second run has nothing due, a rewound rule skips the existing rows
+        self.assertEqual(materialize_due(until=date(2024, 4, 15)).created, 0)
+        RecurringRule.objects.filter(id=rule.id).update(next_date=rule.start_date)
+        self.assertEqual(materialize_due(until=date(2024, 4, 15)).created, 0)
+        self.assertEqual(Transactions.objects.filter(recurring_rule=rule).count(), 3)
+
+    def test_interval_and_end_date(self):
+        rule = self.rule(
+            "weekly", date(2024, 4, 1), interval=2, end_date=date(2024, 4, 20)
+        )
+        self.assertEqual(materialize_due(until=date(2024, 6, 1)).created, 2)
+        rule.refresh_from_db()
+        self.assertIsNone(rule.next_date)
+        self.assertEqual(
+            first_occurrence(self.rule("monthly", date(2024, 1, 31)), date(2024, 3, 5)),
+            date(2024, 3, 31),
+        )
+
+
+class ImportStatementTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="import", email="import@example.com", password="password123"
+        )
+        Categories.objects.create(name="Miscellaneous", category_type="expense")
+        Categories.objects.create(name="Miscellaneous Income", category_type="income")
+
+    def test_ragged_rows(self):
+        statement = (
+            "date,amount,description\n"
+            "2024-01-02,-5.00,coffee,extra,fields\n"
+            "2024-01-03,-6.00\n"
+            "2024-01-04\n"
+        )
+        result = import_statement(self.user, BytesIO(statement.encode()), "csv")
+        self.assertEqual((result.imported, result.skipped), (2, 1))
+        self.assertEqual(result.errors[0]["row"], 3)
+
+    def test_unreadable_file_imports_nothing(self):
+        rows = "".join(f"2024-01-{day:02d},-1.00,row\n" for day in range(1, 21))
+        statement = (
+            f'date,amount,description\n{rows}2024-01-21,-1.00,"{"x" * 200000}"\n'
+        )
+        with self.assertRaises(StatementError):
+            import_statement(
+                self.user, BytesIO(statement.encode()), "csv", chunk_size=5
+            )
+        self.assertFalse(Transactions.objects.filter(user=self.user).exists())
+
+    def test_budgets_are_evaluated_once(self):
+        Budgets.objects.create(
+            user=self.user,
+            category=Categories.objects.get(name="Miscellaneous"),
+            limits=Decimal("10"),
+            period_type="monthly",
+            year=2024,
+            month=1,
+        )
+        rows = "".join(f"2024-01-{day:02d},-3.00,row {day}\n" for day in range(1, 7))
+        result = import_statement(
+            self.user,
+            BytesIO(f"date,amount,description\n{rows}".encode()),
+            "csv",
+            chunk_size=2,
+        )
+        self.assertEqual((result.imported, result.chunks), (6, 3))
+        budget = Budgets.objects.get(user=self.user)
+        self.assertEqual(budget.spent, Decimal("18.00"))
+        # overspent after the second chunk already, one notification all the same
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 1)
+        imported = Transactions.objects.filter(user=self.user)
+        self.assertEqual(imported.values("change_seq").distinct().count(), 1)
+
+
+class BudgetPeriodTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="budget", email="budget@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        Transactions.objects.create(
+            user=self.user,
+            types="expense",
+            amount=Decimal("8.00"),
+            category=self.food,
+            occu_date=date(2024, 5, 3),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_monthly_budget_needs_a_valid_month(self):
+        body = {
+            "category_id": self.food.id,
+            "limits": "100",
+            "period_type": "monthly",
+            "year": 2024,
+        }
+        self.assertEqual(self.client.post("/budgets/", body).status_code, 400)
+        response = self.client.post("/budgets/", dict(body, month=13))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/budgets/", dict(body, month=5))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Decimal(response.data["spent"]), Decimal("8.00"))
+
+    def test_spent_of_an_invalid_period_is_zero(self):
+        budget = Budgets(
+            user=self.user,
+            category=self.food,
+            limits=Decimal("100"),
+            period_type="monthly",
+            year=2024,
+        )
+        self.assertEqual(budget.calculate_spent(), 0)
+        budget.month = 13
+        self.assertEqual(budget.calculate_spent(), 0)
+
+
+class CategoryOwnershipTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="owner", email="owner@example.com", password="password123"
+        )
+        other = CustomUser.objects.create_user(
+            username="other", email="other@example.com", password="password123"
+        )
+        self.own = Categories.objects.create(
+            name="Mine", category_type="expense", user=self.user
+        )
+        self.foreign = Categories.objects.create(
+            name="Theirs", category_type="expense", user=other
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_transaction_and_budget_take_only_visible_categories(self):
+        transaction = {
+            "types": "expense",
+            "amount": "5.00",
+            "occu_date": "2024-05-03",
+            "notes": "lunch",
+        }
+        budget = {"limits": "50", "period_type": "monthly", "year": 2024, "month": 5}
+        for path, body in [("/transactions/", transaction), ("/budgets/", budget)]:
+            response = self.client.post(path, dict(body, category_id=self.foreign.id))
+            self.assertEqual(response.status_code, 400, path)
+            self.assertIn("category_id", response.data)
+            response = self.client.post(path, dict(body, category_id=self.own.id))
+            self.assertEqual(response.status_code, 201, response.data)
+        self.assertFalse(Transactions.objects.filter(category=self.foreign).exists())
+
+
+class CategoryMatcherTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="matcher", email="matcher@example.com", password="password123"
+        )
+
+    def test_own_category_wins_over_a_global_one(self):
+        Categories.objects.create(name="Groceries", category_type="expense")
+        own = Categories.objects.create(
+            name="groceries", category_type="expense", user=self.user
+        )
+        matcher = get_matcher(self.user)
+        self.assertEqual(matcher.match("GROCERIES"), own)
+
+    def test_alias_and_close_names(self):
+        fuel = Categories.objects.create(name="Fuel", category_type="expense")
+        misc = Categories.objects.create(name="Miscellaneous", category_type="expense")
+        CategoryAlias.objects.create(user=self.user, name="petrol", category=fuel)
+        matcher = get_matcher(self.user)
+        self.assertEqual(matcher.match("Petrol"), fuel)
+        self.assertEqual(matcher.match("misc."), misc)
+        self.assertIsNone(matcher.match("Electronics"))
+
+    def test_rebuilt_when_a_category_changes(self):
+        matcher = get_matcher(self.user)
+        self.assertIs(get_matcher(self.user), matcher)
+        Categories.objects.create(name="Pets", category_type="expense")
+        self.assertIsNot(get_matcher(self.user), matcher)
+        self.assertIsNotNone(get_matcher(self.user).match("pets"))
+
+
+class ReceiptBackendTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="receipts", email="receipts@example.com", password="password123"
+        )
+
+    def test_local_task_completed_by_the_pool_callback(self):
+        backend = LocalReceiptBackend(extractor=lambda image_bytes: None, workers=1)
+        task = ReceiptTask.objects.create(user=self.user)
+        future = Future()
+        future.set_result((time.time(), simulated_invoice(products=2)))
+        backend._pending += 1
+        backend._finished(task.id, future)
+        task = backend.get_task(task.id, self.user)
+        self.assertEqual(task["status"], "completed")
+        self.assertEqual(len(task["result"]["product"]), 2)
+        self.assertEqual(backend.stats()["completed"], 1)
+
+    def test_aws_task_without_owner_is_not_found(self):
+        items = {
+            "mine": {
+                "status": "completed",
+                "result": None,
+                "user_id": Decimal(self.user.id),
+            },
+            "theirs": {"status": "completed", "result": None, "user_id": Decimal(0)},
+            "legacy": {"status": "completed", "result": None},
+        }
+
+        class Table:
+            def get_item(self, Key):
+                item = items.get(Key["task_id"])
+                return {} if item is None else {"Item": item}
+
+        backend = AWSReceiptBackend.__new__(AWSReceiptBackend)
+        backend.table = Table()
+        self.assertIsNotNone(backend.get_task("mine", self.user))
+        self.assertIsNone(backend.get_task("theirs", self.user))
+        self.assertIsNone(backend.get_task("legacy", self.user))
+
+
+class ReceiptImageTest(TestCase):
+    def encode(self, size, fmt="JPEG", mode="RGB"):
+        buffered = BytesIO()
+        Image.new(mode, size, "white").save(buffered, format=fmt)
+        return buffered.getvalue()
+
+    def test_large_images_are_scaled_down_to_a_jpeg(self):
+        for data in [
+            self.encode((3000, 2000)),
+            self.encode((1500, 3000), "PNG", "RGBA"),
+        ]:
+            image = Image.open(BytesIO(prepare_receipt(data)))
+            self.assertEqual((image.format, image.mode), ("JPEG", "RGB"))
+            self.assertEqual(max(image.size), 1024)
+
+    def test_small_jpeg_is_sent_as_uploaded(self):
+        data = self.encode((800, 600))
+        self.assertIs(prepare_receipt(data), data)
+
+    def test_broken_uploads_are_rejected(self):
+        data = self.encode((3000, 2000))
+        for broken in [b"not an image", data[: len(data) // 2]]:
+            with self.assertRaises(InvalidImage):
+                prepare_receipt(broken)
+
+
+class ReceiptResultCacheTest(TestCase):
+    def setUp(self):
+        caches["receipts"].clear()
+        self.user = CustomUser.objects.create_user(
+            username="parsed", email="parsed@example.com", password="password123"
+        )
+        self.tasks = {
+            "valid": simulated_invoice(products=2),
+            "invalid": {"product": "none"},
+        }
+        self.reads = []
+        test = self
+
+        class Backend:
+            def get_task(self, task_id, user):
+                test.reads.append(task_id)
+                if user != test.user:
+                    return None
+                result = test.tasks[task_id]
+                return {"task_id": task_id, "status": "completed", "result": result}
+
+        patcher = patch.object(receipt_backends, "_backend", Backend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_completed_result_validated_once(self):
+        first = receipt_backends.get_task("valid", self.user)
+        self.assertEqual(len(first["result"]["product"]), 2)
+        self.assertEqual(receipt_backends.get_task("valid", self.user), first)
+        self.assertEqual(self.reads, ["valid"])
+        # the cached task is only served to its owner
+        other = CustomUser.objects.create_user(
+            username="stranger", email="stranger@example.com", password="password123"
+        )
+        self.assertIsNone(receipt_backends.get_task("valid", other))
+
+    def test_invalid_result_fails_the_task(self):
+        for _ in range(2):
+            with self.assertLogs("finance.receipt_backends", "ERROR"):
+                task = receipt_backends.get_task("invalid", self.user)
+            self.assertEqual((task["status"], task["result"]), ("failed", None))
+        self.assertEqual(self.reads, ["invalid", "invalid"])
+
+
+@override_settings(RECEIPT_DEDUPE_PERCEPTUAL=False)
+class ReceiptBatchTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="batch", email="batch@example.com", password="password123"
+        )
+        self.submitted = []
+        test = self
+
+        class Backend:
+            def submit_many(self, user, images):
+                first = len(test.submitted) + 1
+                test.submitted += images
+                return [f"task-{first + i}" for i in range(len(images))]
+
+            def get_task(self, task_id, user):
+                return {"task_id": task_id, "status": "submitted", "result": None}
+
+            def get_statuses(self, task_ids):
+                return {"task-1": "completed"}
+
+        patcher = patch.object(receipt_backends, "_backend", Backend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def image(self, color):
+        buffered = BytesIO()
+        Image.new("RGB", (64, 64), color).save(buffered, format="JPEG")
+        return buffered.getvalue()
+
+    def test_batch_submits_each_new_image_once(self):
+        white, black = self.image("white"), self.image("black")
+        batch = submit_batch(
+            self.user,
+            [("a.jpg", white), ("b.jpg", white), ("c.jpg", b"junk"), ("d.jpg", black)],
+        )
+        self.assertEqual(len(self.submitted), 2)
+        self.assertEqual(
+            [(item.get("task_id"), item.get("duplicate")) for item in batch.items],
+            [("task-1", False), ("task-1", True), (None, None), ("task-2", False)],
+        )
+        status = batch_status(batch)
+        self.assertEqual(
+            [item["status"] for item in status["items"]],
+            ["completed", "completed", "invalid", "submitted"],
+        )
+        self.assertEqual(
+            status["counts"], {"completed": 2, "invalid": 1, "submitted": 1}
+        )
+
+        # uploaded again in a later batch, the earlier task is reused
+        again = submit_batch(self.user, [("e.jpg", black)])
+        self.assertEqual(again.items[0]["task_id"], "task-2")
+        self.assertTrue(again.items[0]["duplicate"])
+        self.assertEqual(len(self.submitted), 2)
+
+
+class ReceiptDedupeTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="dedupe", email="dedupe@example.com", password="password123"
+        )
+        self.tasks = {
+            "done": {"task_id": "done", "status": "completed", "result": None},
+            "broken": {"task_id": "broken", "status": "failed", "result": None},
+        }
+        patcher = patch(
+            "finance.receipt_dedupe.get_task",
+            lambda task_id, user: self.tasks.get(task_id),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_exact_and_similar_uploads_reuse_the_task(self):
+        fingerprint = (1 << 63) | 0b1011
+        receipt_dedupe.remember(self.user, "a" * 64, "done", fingerprint)
+        self.assertEqual(
+            receipt_dedupe.find_task(self.user, "a" * 64)["task_id"], "done"
+        )
+        self.assertIsNone(receipt_dedupe.find_task(self.user, "b" * 64))
+        # two bits away from an upload with the top bit set
+        task = receipt_dedupe.find_similar_task(self.user, "b" * 64, fingerprint ^ 0b11)
+        self.assertEqual(task["task_id"], "done")
+        self.assertIsNone(
+            receipt_dedupe.find_similar_task(self.user, "c" * 64, fingerprint ^ 0b111)
+        )
+        # the similar upload is now an exact hit
+        self.assertEqual(
+            receipt_dedupe.find_task(self.user, "b" * 64)["task_id"], "done"
+        )
+        self.assertEqual(
+            receipt_dedupe.dedupe_stats(),
+            {"exact_hits": 2, "similar_hits": 1, "misses": 1, "hit_rate": 0.75},
+        )
+
+    def test_failed_and_expired_uploads_are_not_reused(self):
+        receipt_dedupe.remember(self.user, "a" * 64, "broken")
+        self.assertIsNone(receipt_dedupe.find_task(self.user, "a" * 64))
+        self.assertFalse(ReceiptUpload.objects.filter(digest="a" * 64).exists())
+
+        receipt_dedupe.remember(self.user, "b" * 64, "done")
+        ReceiptUpload.objects.update(
+            create_time=datetime(2020, 1, 1, tzinfo=timezone.utc)
+        )
+        self.assertIsNone(receipt_dedupe.find_task(self.user, "b" * 64))
+        self.assertEqual(receipt_dedupe.prune_uploads(), 1)
+
+
+@override_settings(RECEIPT_LONG_POLL_TIMEOUT=0.5)
+class ReceiptLongPollTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="poll", email="poll@example.com", password="password123"
+        )
+        backend = LocalReceiptBackend(extractor=lambda image_bytes: None, workers=1)
+        patcher = patch.object(receipt_backends, "_backend", backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.task = ReceiptTask.objects.create(user=self.user)
+        self.url = f"/transactions/{self.task.id}/check_task_status/"
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_wait_is_clamped_to_poll_wait(self):
+        started = time.monotonic()
+        response = self.client.get(self.url, {"wait": 60, "status": "submitted"})
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response.data["status"], "submitted")
+        self.assertEqual(response.data["poll_wait"], 0.5)
+        self.assertEqual(self.client.get(self.url, {"wait": "soon"}).status_code, 400)
+
+    def test_changed_status_is_returned_at_once(self):
+        ReceiptTask.objects.filter(id=self.task.id).update(
+            status="completed", result=simulated_invoice(products=1)
+        )
+        # the status the client has is older than the stored one, no wait
+        response = self.client.get(self.url, {"wait": 60, "status": "submitted"})
+        self.assertEqual(response.data["status"], "completed")
+        self.assertEqual(len(response.data["result"]["product"]), 1)
+        other = APIClient()
+        other.force_authenticate(
+            CustomUser.objects.create_user(
+                username="stranger", email="stranger@example.com", password="x"
+            )
+        )
+        self.assertEqual(other.get(self.url).status_code, 404)
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="rollup", email="rollup@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.salary = Categories.objects.create(name="Salary", category_type="income")
+        today = date.today()
+        for amount, category, types in [
+            ("12.50", self.food, "expense"),
+            ("7.25", self.food, "expense"),
+            ("1000.00", self.salary, "income"),
+        ]:
+            Transactions.objects.create(
+                user=self.user,
+                types=types,
+                amount=Decimal(amount),
+                category=category,
+                occu_date=today,
+                notes="rollup",
+            )
+
+    def test_ledger_keeps_rollups_and_totals(self):
+        rollup = MonthlyRollup.objects.get(user=self.user, category=self.food)
+        self.assertEqual((rollup.total, rollup.count), (Decimal("19.75"), 2))
+        totals = user_totals(self.user)
+        self.assertEqual(totals.total_expenses, Decimal("19.75"))
+        self.assertEqual(totals.month_income, Decimal("1000.00"))
+
+        Transactions.objects.filter(amount=Decimal("7.25")).get().delete()
+        rollup.refresh_from_db()
+        self.assertEqual((rollup.total, rollup.count), (Decimal("12.50"), 1))
+        self.assertEqual(user_totals(self.user).total_expenses, Decimal("12.50"))
+
+    def test_rebuild_repairs_drifted_rollups_and_totals(self):
+        user_totals(self.user)
+        MonthlyRollup.objects.filter(category=self.food).update(total=1, count=5)
+        UserTotals.objects.filter(user=self.user).update(total_expenses=3)
+        out = StringIO()
+        call_command("rebuild_rollups", "--verify", stdout=out)
+        self.assertIn("1 mismatches", out.getvalue())
+
+        call_command("rebuild_rollups", stdout=StringIO())
+        rollup = MonthlyRollup.objects.get(user=self.user, category=self.food)
+        self.assertEqual((rollup.total, rollup.count), (Decimal("19.75"), 2))
+        totals = UserTotals.objects.get(user=self.user)
+        self.assertEqual(totals.total_expenses, Decimal("19.75"))
+        self.assertEqual(totals.total_income, Decimal("1000.00"))
+        out = StringIO()
+        call_command("rebuild_rollups", "--verify", stdout=out)
+        self.assertIn("0 mismatches", out.getvalue())
+
+
+class ReportTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="report", email="report@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.rent = Categories.objects.create(name="Rent", category_type="expense")
+        salary = Categories.objects.create(name="Salary", category_type="income")
+        for occu_date, amount, category in [
+            (date(2023, 12, 20), "7.00", self.food),
+            (date(2024, 1, 5), "10.00", self.food),
+            (date(2024, 1, 31), "100.00", salary),
+            (date(2024, 2, 1), "5.00", self.food),
+            (date(2024, 2, 3), "50.00", self.rent),
+        ]:
+            Transactions.objects.create(
+                user=self.user,
+                types=category.category_type,
+                amount=Decimal(amount),
+                category=category,
+                occu_date=occu_date,
+                notes="report",
+            )
+
+    def test_report_sections_from_one_query(self):
+        with self.assertNumQueries(1):
+            report = build_report(self.user, 2024)
+        self.assertEqual(
+            report["income_trends"],
+            [{"year": 2024, "month": 1, "total": Decimal("100.00")}],
+        )
+        self.assertEqual(
+            report["expense_categories"],
+            [
+                {"category__name": "Food", "total": Decimal("22.00")},
+                {"category__name": "Rent", "total": Decimal("50.00")},
+            ],
+        )
+        self.assertEqual(
+            [
+                (row["year"], row["month"], row["cash_flow"])
+                for row in report["cash_flow"]
+            ],
+            [(2023, 12, -7.0), (2024, 1, 90.0), (2024, 2, -55.0)],
+        )
+        self.assertEqual(
+            report["year_end_summary"],
+            {
+                "total_income": Decimal("100.00"),
+                "total_expenses": Decimal("65.00"),
+                "net_savings": 35.0,
+            },
+        )
+
+    def test_budget_vs_actual_in_two_queries(self):
+        for category, period_type, month, limits in [
+            (self.food, "monthly", 1, "20"),
+            (self.food, "yearly", None, "200"),
+            (self.rent, "monthly", 3, "60"),
+        ]:
+            Budgets.objects.create(
+                user=self.user,
+                category=category,
+                limits=Decimal(limits),
+                period_type=period_type,
+                year=2024,
+                month=month,
+            )
+        with self.assertNumQueries(2):
+            rows = budget_vs_actual(self.user)
+        actual = {
+            (row["category__name"], row["month"]): row["actual_amount"] for row in rows
+        }
+        self.assertEqual(
+            actual,
+            {
+                ("Food", 1): Decimal("10.00"),
+                # the months of the year, the December of 2023 is not counted
+                ("Food", None): Decimal("15.00"),
+                ("Rent", 3): Decimal("0"),
+            },
+        )
+
+
+class DashboardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username="dashboard", email="dashboard@example.com", password="password123"
+        )
+        food = Categories.objects.create(name="Food", category_type="expense")
+        salary = Categories.objects.create(name="Salary", category_type="income")
+        today = date.today()
+        for occu_date, amount, category in [
+            (today, "10.00", food),
+            (today.replace(year=today.year - 1, day=1), "4.00", food),
+            (today.replace(year=today.year - 1, day=1), "100.00", salary),
+        ]:
+            Transactions.objects.create(
+                user=self.user,
+                types=category.category_type,
+                amount=Decimal(amount),
+                category=category,
+                occu_date=occu_date,
+                notes="dashboard",
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_lifetime_and_month_totals(self):
+        data = self.client.get("/dashboard/").data
+        self.assertEqual(
+            {
+                name: Decimal(data[name])
+                for name in (
+                    "total_income",
+                    "total_expenses",
+                    "total_savings",
+                    "month_income",
+                    "month_expenses",
+                )
+            },
+            {
+                "total_income": Decimal("100.00"),
+                "total_expenses": Decimal("14.00"),
+                "total_savings": Decimal("86.00"),
+                "month_income": Decimal("0"),
+                "month_expenses": Decimal("10.00"),
+            },
+        )
+        with self.assertNumQueries(1):
+            user_totals(self.user)
+
+    def test_month_counters_roll_over(self):
+        # counters left from another month are recomputed from the rollups
+        UserTotals.objects.filter(user=self.user).update(
+            year=2000, month=1, month_income=999, month_expenses=999
+        )
+        totals = user_totals(self.user)
+        self.assertEqual((totals.month_income, totals.month_expenses), (0, 10))
+        self.assertEqual(totals.total_expenses, Decimal("14.00"))
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username="cached", email="cached@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def spend(self, amount):
+        return Transactions.objects.create(
+            user=self.user,
+            types="expense",
+            amount=Decimal(amount),
+            category=self.food,
+            occu_date=date.today(),
+            notes="cached",
+        )
+
+    def expenses(self):
+        return Decimal(self.client.get("/dashboard/").data["total_expenses"])
+
+    def test_write_outside_the_views_invalidates(self):
+        self.spend("10.00")
+        self.assertEqual(self.expenses(), Decimal("10.00"))
+        self.assertEqual(self.expenses(), Decimal("10.00"))
+        self.assertEqual(cache_stats()["hits"], 1)
+
+        # a job or a command, no view in between
+        self.spend("2.50")
+        self.assertEqual(self.expenses(), Decimal("12.50"))
+        report = self.client.get("/reports/").data
+        self.spend("1.00")
+        self.assertNotEqual(self.client.get("/reports/").data, report)
+
+    def test_version_is_read_from_the_database(self):
+        self.spend("10.00")
+        self.expenses()
+        version = get_data_version(self.user.id)
+        # another process committed a write, this process cached nothing of it
+        ChangeCounter.objects.filter(scope=self.user.id).update(value=F("value") + 1)
+        self.assertNotEqual(get_data_version(self.user.id), version)
+
+    def test_rebuild_invalidates_the_repaired_users(self):
+        self.spend("10.00")
+        UserTotals.objects.filter(user=self.user).update(total_expenses=3)
+        self.assertEqual(self.expenses(), Decimal("3"))
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.assertEqual(self.expenses(), Decimal("10.00"))
+
+        # a drift bumps the version even when the cached value looks right
+        MonthlyRollup.objects.filter(user=self.user).update(total=1)
+        version = get_data_version(self.user.id)
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.assertNotEqual(get_data_version(self.user.id), version)
+
+
+class SyncTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="sync", email="sync@example.com", password="password123"
+        )
+        self.food = Categories.objects.create(name="Food", category_type="expense")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add(self, amount, **fields):
+        return Transactions.objects.create(
+            user=self.user,
+            types="expense",
+            amount=Decimal(amount),
+            category=self.food,
+            occu_date=date(2024, 5, 3),
+            notes="sync",
+            **fields,
+        )
+
+    def sync(self, since=None):
+        response = self.client.get("/sync/", {"since": since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_the_watermark(self):
+        kept = self.add("1.00")
+        gone = self.add("2.00")
+        first = self.sync()
+        self.assertTrue(first["reset"])
+        self.assertEqual(len(first["transactions"]), 2)
+
+        kept.amount = Decimal("3.00")
+        kept.save()
+        gone_id = gone.id
+        gone.delete()
+        pets = Categories.objects.create(name="Pets", category_type="expense")
+        second = self.sync(first["watermark"])
+        self.assertFalse(second["reset"])
+        self.assertEqual([row["id"] for row in second["transactions"]], [kept.id])
+        self.assertEqual(second["deleted"]["transactions"], [gone_id])
+        self.assertEqual([row["id"] for row in second["categories"]], [pets.id])
+
+        third = self.sync(second["watermark"])
+        self.assertEqual(third["transactions"], [])
+        self.assertEqual(third["deleted"]["transactions"], [])
+        self.assertEqual(self.client.get("/sync/", {"since": "x"}).status_code, 400)
+
+    def test_row_committed_after_the_watermark(self):
+        first = self.sync()
+        # written by a long transaction: stamped (updated_at) before the sync,
+        # committed after it
+        late = self.add("4.00")
+        Transactions.objects.filter(id=late.id).update(
+            updated_at=datetime.now(timezone.utc) - timedelta(hours=1)
+        )
+        second = self.sync(first["watermark"])
+        self.assertEqual([row["id"] for row in second["transactions"]], [late.id])
+
+
+class SyncConcurrencyTest(TransactionTestCase):
+    @concurrent_writes
+    def test_row_committed_during_a_sync(self):
+        user = CustomUser.objects.create_user(
+            username="sync", email="sync@example.com", password="password123"
+        )
+        food = Categories.objects.create(name="Food", category_type="expense")
+        client = APIClient()
+        client.force_authenticate(user)
+        first = client.get("/sync/").data
+        written, release = threading.Event(), threading.Event()
+
+        def write():
+            try:
+                with db_transaction.atomic():
+                    Transactions.objects.create(
+                        user=user,
+                        types="expense",
+                        amount=Decimal("5.00"),
+                        category=food,
+                        occu_date=date(2024, 5, 3),
+                        notes="late",
+                    )
+                    written.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        written.wait(10)
+        during = client.get("/sync/", {"since": first["watermark"]}).data
+        release.set()
+        writer.join()
+        self.assertEqual(during["transactions"], [])
+        after = client.get("/sync/", {"since": during["watermark"]}).data
+        self.assertEqual([row["notes"] for row in after["transactions"]], ["late"])
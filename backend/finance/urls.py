@@ -15,7 +15,11 @@ from .views import (
     TransactionViewSet,
     BudgetViewSet,
     CategoryViewSet,
+    NotificationViewSet,
     ReportView,
+    CacheStatsView,
+    SyncView,
+    RecurringRuleViewSet,
     googlelogin,
 )
 from rest_framework import permissions, routers
@@ -30,6 +34,8 @@ router = DefaultRouter()
 router.register(r"transactions", TransactionViewSet, basename="transactions")
 router.register(r"budgets", BudgetViewSet, basename="budgets")
 router.register(r"categories", CategoryViewSet, basename="categories")
+router.register(r"notifications", NotificationViewSet, basename="notifications")
+router.register(r"recurring-rules", RecurringRuleViewSet, basename="recurring-rules")
 
 """
 schema_view = get_schema_view(
@@ -60,6 +66,8 @@ urlpatterns = [
     # ),
     path("dashboard/", DashboardView.as_view(), name="dashboard"),
     path("reports/", ReportView.as_view(), name="reports"),
+    path("cache-stats/", CacheStatsView.as_view(), name="cache-stats"),
+    path("sync/", SyncView.as_view(), name="sync"),
     # path("redoc/", schema_view.with_ui("redoc", cache_timeout=0), name="schema-redoc"),
     path("google-login/", googlelogin.google_login, name="google-login"),
     path("", include(router.urls)),
@@ -4,8 +4,12 @@ from .user import LoginView, RegisterView, ProfileView
 from .transaction import TransactionViewSet
 from .budget import BudgetViewSet
 from .category import CategoryViewSet
+from .notification import NotificationViewSet
 from .dashboard import DashboardView
 from .reports import ReportView
+from .stats import CacheStatsView
+from .sync import SyncView
+from .recurring import RecurringRuleViewSet
 
 __all__ = [
     "LoginView",
@@ -13,7 +17,11 @@ __all__ = [
     "TransactionViewSet",
     "BudgetViewSet",
     "CategoryViewSet",
+    "NotificationViewSet",
     "DashboardView",
     "ReportView",
     "ProfileView",
+    "CacheStatsView",
+    "SyncView",
+    "RecurringRuleViewSet",
 ]
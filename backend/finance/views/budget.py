@@ -9,23 +9,33 @@ from rest_framework import generics, viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.decorators import action
-from ..models import Transactions, Categories, Budgets
+from ..models import Transactions, Budgets
 from ..serializers import BudgetSerializer
+from ..pagination import KeysetPagination
+from ..fieldsets import SparseFieldsViewMixin
+from ..idempotency import idempotent
+from django.db.models import Value
+from django.db.models.functions import Coalesce
 
 # from drf_yasg.utils import swagger_auto_schema
 
 
-class BudgetViewSet(viewsets.ModelViewSet):
+class BudgetViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing budgets.
     """
 
     serializer_class = BudgetSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ("-year", "-month_key", "-id")
 
     def get_queryset(self):
-        return Budgets.objects.filter(user_id=self.request.user.id).order_by(
-            "-year", "-month"
+        # yearly budgets have no month, sort them after the months of their year
+        return (
+            Budgets.objects.filter(user_id=self.request.user.id)
+            .annotate(month_key=Coalesce("month", Value(0)))
+            .order_by("-year", "-month_key", "-id")
         )
 
     # @swagger_auto_schema(
@@ -34,12 +44,16 @@ class BudgetViewSet(viewsets.ModelViewSet):
     # )
     def list(self, request, *args, **kwargs):
         """
-        List all budgets for the authenticated user.
+        List the budgets of the authenticated user, one page at a time.
         Request:
         - Authorization: Bearer <token>
+        - cursor: str (optional, the cursor of the next page)
+        - page_size: int (optional, default 50, max 200)
+        - fields: str (optional, comma separated fields to return, e.g. id,amount)
 
         Response:
-        - list of budget objects
+        - next: url of the next page, null on the last page
+        - results: list of budget objects
         """
         return super().list(request, *args, **kwargs)
 
@@ -48,12 +62,14 @@ class BudgetViewSet(viewsets.ModelViewSet):
     #    request_body=BudgetSerializer,
     #    responses={201: BudgetSerializer},
     # )
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Create a new budget for the authenticated user.
 
         Request:
         - Authorization: Bearer <token>
+        - Idempotency-Key: str (optional header, a retry with the same key returns the first response)
         - category: int (category ID)
         - limit: float
         - spent: float
@@ -66,8 +82,7 @@ class BudgetViewSet(viewsets.ModelViewSet):
         """
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        category = Categories.objects.get(id=request.data["category_id"])
-        serializer.save(user=request.user, category=category)
+        serializer.save(user=request.user)
 
         headers = self.get_success_headers(serializer.data)
         return Response(
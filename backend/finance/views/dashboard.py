@@ -11,7 +11,10 @@ from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from ..serializers import TransactionSerializer, NotificationSerializer
 from ..models import Transactions, Notification
+from ..cache import cached_response
+from ..ledger import user_totals
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 # from drf_yasg.utils import swagger_auto_schema
 # from drf_yasg import openapi
@@ -44,16 +47,34 @@ class DashboardView(APIView):
         - total_income: float
         - total_expenses: float
         - total_savings: float
+        - month_income: float (current month)
+        - month_expenses: float (current month)
         - recent_transactions: list of transaction objects
         """
         user = request.user
-        total_income = Transactions.objects.filter(
-            user_id=user.id, types="income"
-        ).aggregate(Sum("amount"))["amount__sum"] or Decimal("0.0")
-        total_expenses = Transactions.objects.filter(
-            user_id=user.id, types="expense"
-        ).aggregate(Sum("amount"))["amount__sum"] or Decimal("0.0")
-        total_savings = total_income - total_expenses
+        month = request.query_params.get("month", None)
+        year = request.query_params.get("year", None)
+
+        data = cached_response(
+            "dashboard",
+            user.id,
+            # the month counters change with the calendar month, not only on writes
+            {
+                "year": year,
+                "month": month,
+                "today": timezone.localdate().isoformat()[:7],
+            },
+            lambda: self.get_dashboard(user),
+        )
+        return Response(data)
+
+    def get_dashboard(self, user):
+        """
+        Compute the dashboard data, the result is cached until the user's data changes.
+        """
+        # one primary key lookup of the totals kept in sync by the ledger
+        totals = user_totals(user)
+        total_savings = totals.total_income - totals.total_expenses
 
         # recent_transactions = Transactions.objects.filter(user_id=user.id).order_by(
         #    "-occu_date"
@@ -68,12 +89,12 @@ class DashboardView(APIView):
 
         recent_tnotification = NotificationSerializer(notifications, many=True).data
 
-        return Response(
-            {
-                "total_income": total_income,
-                "total_expenses": total_expenses,
-                "total_savings": total_savings,
-                # "recent_transactions": recent_transactions_data,
-                "recent_notification": recent_tnotification,
-            }
-        )
+        return {
+            "total_income": totals.total_income,
+            "total_expenses": totals.total_expenses,
+            "total_savings": total_savings,
+            "month_income": totals.month_income,
+            "month_expenses": totals.month_expenses,
+            # "recent_transactions": recent_transactions_data,
+            "recent_notification": recent_tnotification,
+        }
@@ -5,8 +5,6 @@ Date: 2024-09-18
 Description: Google account login handler
 """
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework_simplejwt.tokens import RefreshToken
@@ -17,6 +15,10 @@ from ..models import CustomUser
 
 @api_view(["POST"])
 def google_login(request):
+    # google-auth is only needed by this view, not imported at startup
+    from google.oauth2 import id_token
+    from google.auth.transport import requests
+
     token = request.data.get("token")
 
     try:
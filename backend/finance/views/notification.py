@@ -0,0 +1,46 @@
+"""
+File: notification.py
+Author: Haitao Wang
+Date: 2024-10-10
+Description: Notification view
+"""
+
+from rest_framework import viewsets
+from rest_framework.permissions import IsAuthenticated
+from ..models import Notification
+from ..serializers import NotificationSerializer
+from ..pagination import KeysetPagination
+from ..fieldsets import SparseFieldsViewMixin
+
+
+class NotificationViewSet(SparseFieldsViewMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    ViewSet for listing notifications.
+    """
+
+    serializer_class = NotificationSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    # backed by the (user, create_time) index
+    keyset_ordering = ("-create_time", "-id")
+
+    def get_queryset(self):
+        return Notification.objects.filter(user_id=self.request.user.id).order_by(
+            "-create_time", "-id"
+        )
+
+    def list(self, request, *args, **kwargs):
+        """
+        List the notifications of the authenticated user, newest first, one page at a time.
+
+        Request:
+        - Authorization: Bearer <token>
+        - cursor: str (optional, the cursor of the next page)
+        - page_size: int (optional, default 50, max 200)
+        - fields: str (optional, comma separated fields to return, e.g. id,amount)
+
+        Response:
+        - next: url of the next page, null on the last page
+        - results: list of notification objects
+        """
+        return super().list(request, *args, **kwargs)
@@ -0,0 +1,107 @@
+"""
+File: recurring.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Recurring rule view
+"""
+
+from rest_framework import viewsets
+from rest_framework.permissions import IsAuthenticated
+from ..models import RecurringRule
+from ..serializers import RecurringRuleSerializer
+from ..fieldsets import SparseFieldsViewMixin
+
+# from drf_yasg.utils import swagger_auto_schema
+
+
+class RecurringRuleViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
+    """
+    ViewSet for managing recurring rules, their transactions are created by the materialize_recurring command.
+    """
+
+    serializer_class = RecurringRuleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return RecurringRule.objects.filter(user_id=self.request.user.id).order_by(
+            "-create_time"
+        )
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+    # @swagger_auto_schema(
+    #    operation_description="List user recurring rules",
+    #    responses={200: RecurringRuleSerializer(many=True)},
+    # )
+    def list(self, request, *args, **kwargs):
+        """
+        List the recurring rules of the authenticated user.
+
+        Request:
+        - Authorization: Bearer <token>
+        - fields: str (optional, comma separated fields to return)
+
+        Response:
+        - list of recurring rule objects
+        """
+        return super().list(request, *args, **kwargs)
+
+    # @swagger_auto_schema(
+    #    operation_description="Create a new recurring rule",
+    #    request_body=RecurringRuleSerializer,
+    #    responses={201: RecurringRuleSerializer},
+    # )
+    def create(self, request, *args, **kwargs):
+        """
+        Create a new recurring rule for the authenticated user.
+
+        Request:
+        - Authorization: Bearer <token>
+        - types: str
+        - amount: float
+        - category_id: int
+        - notes: str (optional)
+        - frequency: str (daily, weekly, monthly or yearly)
+        - interval: int (optional, default 1)
+        - start_date: str (a start in the past is caught up by the next scheduler run)
+        - end_date: str (optional)
+
+        Response:
+        - recurring rule object, next_date is the first occurrence to create
+        """
+        return super().create(request, *args, **kwargs)
+
+    # @swagger_auto_schema(
+    #    operation_description="Update a recurring rule",
+    #    request_body=RecurringRuleSerializer,
+    #    responses={200: RecurringRuleSerializer},
+    # )
+    def update(self, request, *args, **kwargs):
+        """
+        Update a recurring rule of the authenticated user.
+
+        Request:
+        - Authorization: Bearer <token>
+        - the fields of create (all of them for PUT, some for PATCH)
+
+        Response:
+        - recurring rule object, a change of the schedule restarts it from today
+        """
+        return super().update(request, *args, **kwargs)
+
+    # @swagger_auto_schema(
+    #    operation_description="Delete a recurring rule",
+    #    responses={204: "No Content"},
+    # )
+    def destroy(self, request, *args, **kwargs):
+        """
+        Delete a recurring rule, the transactions it created are kept.
+
+        Request:
+        - Authorization: Bearer <token>
+
+        Response:
+        - 204 No Content
+        """
+        return super().destroy(request, *args, **kwargs)
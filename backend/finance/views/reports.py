@@ -7,6 +7,7 @@ Description: Report view
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.contrib.auth import get_user_model
 from django.db.models import Sum
@@ -14,18 +15,9 @@ from django.db.models import Sum
 # from drf_yasg.utils import swagger_auto_schema
 # from drf_yasg import openapi
 from ..models import Transactions, Budgets
+from ..report_engine import build_report, budget_vs_actual
+from ..cache import cached_response
 from django.utils import timezone
-from django.db.models import Sum, F, Func, Value
-
-
-class Year(Func):
-    function = "EXTRACT"
-    template = "%(function)s(YEAR FROM %(expressions)s)"
-
-
-class Month(Func):
-    function = "EXTRACT"
-    template = "%(function)s(MONTH FROM %(expressions)s)"
 
 
 class ReportView(APIView):
@@ -55,110 +47,41 @@ class ReportView(APIView):
         user = request.user
 
         # Use the current year as the default
-        year = request.query_params.get("year", timezone.now().year)
-        month = request.query_params.get("month", None)
-
-        # Calculate income and expense trends
-        income_trends = (
-            Transactions.objects.filter(user=user, types="income")
-            .annotate(year=Year("occu_date"), month=Month("occu_date"))
-            .values("year", "month")
-            .annotate(total=Sum("amount"))
-            .order_by("year", "month")
-        )
-
-        expense_trends = (
-            Transactions.objects.filter(user=user, types="expense")
-            .annotate(
-                year=Year("occu_date"),
-                month=Month("occu_date"),
-                category_name=F("category__name"),
+        try:
+            year = int(request.query_params.get("year", timezone.now().year))
+        except ValueError:
+            return Response(
+                {"error": "year must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            .values("year", "month", "category_name")
-            .annotate(total=Sum("amount"))
-            .order_by("year", "month", "category_name")
-        )
 
-        # Calculate expense categories for pie chart
-        expense_categories = (
-            Transactions.objects.filter(user=user, types="expense")
-            .values("category__name")
-            .annotate(total=Sum("amount"))
-            .order_by("category__name")
-        )
-
-        # Calculate cash flow (income - expenses)
-        cash_flow = []
-        for income in income_trends:
-            expense = next(
-                (
-                    exp
-                    for exp in expense_trends
-                    if exp["year"] == income["year"] and exp["month"] == income["month"]
-                ),
-                {"total": 0},
-            )
-            cash_flow.append(
-                {
-                    "year": income["year"],
-                    "month": income["month"],
-                    "income_total": income["total"],
-                    "expense_total": expense["total"],
-                    "cash_flow": float(income["total"]) - float(expense["total"]),
-                }
-            )
-
-        # Budget vs. Actual (assuming Budget model exists and related to user and categories)
-        budget_vs_actual = []
-        budgets = Budgets.objects.filter(user=user)
-        for budget in budgets:
-            actual_spent = (
-                Transactions.objects.filter(
-                    user=user,
-                    category=budget.category,
-                    occu_date__year=budget.year,
-                    occu_date__month=budget.month,
-                ).aggregate(total=Sum("amount"))["total"]
-                or 0
-            )
-            budget_vs_actual.append(
-                {
-                    "year": budget.year,
-                    "month": budget.month,
-                    "category__name": budget.category.name,
-                    "budgeted_amount": budget.limits,
-                    "actual_amount": actual_spent,
-                }
-            )
+        month = request.query_params.get("month", None)
 
-        # Year-End Financial Summary
-        total_income = (
-            Transactions.objects.filter(
-                user=user, types="income", occu_date__year=year
-            ).aggregate(total=Sum("amount"))["total"]
-            or 0
-        )
-        total_expenses = (
-            Transactions.objects.filter(
-                user=user, types="expense", occu_date__year=year
-            ).aggregate(total=Sum("amount"))["total"]
-            or 0
+        data = cached_response(
+            "reports",
+            user.id,
+            {"year": year, "month": month},
+            lambda: self.get_report(user, year),
         )
-        net_savings = float(total_income) - float(total_expenses)
+        return Response(data)
 
-        year_end_summary = {
-            "total_income": total_income,
-            "total_expenses": total_expenses,
-            "net_savings": net_savings,
-        }
+    def get_report(self, user, year):
+        """
+        Compute the report data, the result is cached until the user's data changes.
 
-        return Response(
-            {
-                "income_trends": list(income_trends),
-                "expense_trends": list(expense_trends),
-                "expense_categories": list(expense_categories),
-                "cash_flow": cash_flow,
-                "budget_vs_actual": budget_vs_actual,
-                "year_end_summary": year_end_summary,
-            }
-        )
+        Query count: 3 (see build_report and budget_vs_actual).
+        """
+        # trends, expense categories, cash flow and year-end summary in one query
+        report = build_report(user, year)
+
+        # Budget vs. Actual, a constant number of queries for any number of budgets
+        budgets = budget_vs_actual(user)
+
+        return {
+            "income_trends": report["income_trends"],
+            "expense_trends": report["expense_trends"],
+            "expense_categories": report["expense_categories"],
+            "cash_flow": report["cash_flow"],
+            "budget_vs_actual": budgets,
+            "year_end_summary": report["year_end_summary"],
+        }
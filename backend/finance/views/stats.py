@@ -0,0 +1,35 @@
+"""
+File: stats.py
+Author: Haitao Wang
+Date: 2024-10-06
+Description: Runtime statistics view
+"""
+
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+from ..cache import cache_stats
+from ..receipt_dedupe import dedupe_stats
+
+
+class CacheStatsView(APIView):
+    """
+    Endpoint for the hit and miss counters of the response cache and the receipt dedupe.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        """
+        Get the response cache and receipt dedupe counters.
+
+        Request:
+        - Authorization: Bearer <token> (staff user)
+
+        Response:
+        - response_cache: {hits, misses, hit_rate}
+        - receipt_dedupe: {exact_hits, similar_hits, misses, hit_rate}
+        """
+        return Response(
+            {"response_cache": cache_stats(), "receipt_dedupe": dedupe_stats()}
+        )
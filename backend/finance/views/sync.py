@@ -0,0 +1,50 @@
+"""
+File: sync.py
+Author: Haitao Wang
+Date: 2024-10-18
+Description: Delta sync view for the offline clients
+"""
+
+from rest_framework import status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from .. import sync
+
+# from drf_yasg.utils import swagger_auto_schema
+
+
+class SyncView(APIView):
+    """
+    Endpoint for the rows changed since the previous sync.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    # @swagger_auto_schema(
+    #    operation_description="Get the transactions, budgets and categories changed since a watermark",
+    #    responses={200: "changed rows, deleted ids and the next watermark"},
+    # )
+    def get(self, request):
+        """
+        Get the transactions, budgets and categories created, changed or deleted since the watermark.
+
+        Request:
+        - Authorization: Bearer <token>
+        - since: str (optional, the watermark of the previous sync)
+
+        Response:
+        - watermark: str, pass it as since to the next sync
+        - reset: bool, true if every row is returned (no or expired since), drop the local copy first
+        - transactions: list of transaction objects
+        - budgets: list of budget objects
+        - categories: list of category objects
+        - deleted: {"transactions": [id], "budgets": [id], "categories": [id]}
+        - 400: Bad Request if since is not a watermark of this server
+        """
+        since = request.query_params.get("since")
+        try:
+            since = sync.decode_watermark(since) if since else None
+        except sync.InvalidWatermark as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(sync.changes(request.user, since))
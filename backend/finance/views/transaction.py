@@ -11,42 +11,73 @@ from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.decorators import action
-from ..models import Transactions, Categories, Budgets, Notification
-from ..serializers import TransactionSerializer, CategorySerializer
+from ..models import Transactions, Budgets, Notification, ReceiptBatch
+from ..serializers import (
+    TransactionSerializer,
+    CategorySerializer,
+    BulkTransactionSerializer,
+    TransactionFilterSerializer,
+    ReceiptTransactionsSerializer,
+)
+from .. import changes, ledger, importers
+from ..search import filter_transactions
+from ..pagination import KeysetPagination
+from ..fieldsets import SparseFieldsViewMixin
+from ..idempotency import idempotent
 from decimal import Decimal
 
 # from drf_yasg.utils import swagger_auto_schema
 # from drf_yasg import openapi
-from PIL import Image, UnidentifiedImageError
-from io import BytesIO
 import logging
 from django.db.models import Sum, F, Func, Value
-from ..receipt import process_result
-import base64
+from django.db import connection, transaction as db_transaction
+from django.core.exceptions import ValidationError
+from ..receipt_backends import get_backend, get_task, get_watcher
+from ..receipt_image import InvalidImage, MAX_UPLOAD_BYTES, prepare_receipt
+from ..receipt_batch import batch_status, submit_batch
+from .. import receipt_transactions
+from .. import receipt_dedupe
+from django.conf import settings
 import calendar
-import uuid  # generate openAI task ID
-import boto3
-import json
+import math
 
 logger = logging.getLogger(__name__)
 
-# Initialize AWS Lambda and DynamoDB client
-lambda_client = boto3.client("lambda", region_name="us-east-1")
-dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
-table = dynamodb.Table("ReceiptTasks")
+# max number of rows of one bulk create request
+BULK_MAX_ROWS = 1000
 
 
-class TransactionViewSet(viewsets.ModelViewSet):
+def poll_wait():
+    """
+    Longest wait of a long-poll task status request, the client passes it as wait.
+    """
+    return settings.RECEIPT_LONG_POLL_TIMEOUT
+
+
+class TransactionViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing transactions.
     """
 
     serializer_class = TransactionSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    # backed by the (user, occu_date, id) index
+    keyset_ordering = ("-occu_date", "-id")
 
     def get_queryset(self):
-        return Transactions.objects.filter(user_id=self.request.user.id).order_by(
-            "-occu_date"
+        queryset = Transactions.objects.filter(user_id=self.request.user.id).order_by(
+            "-occu_date", "-id"
+        )
+        if self.action == "list":
+            queryset = self.apply_filters(queryset)
+        return queryset
+
+    def apply_filters(self, queryset):
+        params = TransactionFilterSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        return filter_transactions(
+            queryset, params.validated_data, self.request.user.id
         )
 
     # @swagger_auto_schema(
@@ -55,13 +86,22 @@ class TransactionViewSet(viewsets.ModelViewSet):
     # )
     def list(self, request, *args, **kwargs):
         """
-        List all transactions for the authenticated user.
+        List the transactions of the authenticated user, newest first, one page at a time.
 
         Request:
         - Authorization: Bearer <token>
+        - cursor: str (optional, the cursor of the next page)
+        - page_size: int (optional, default 50, max 200)
+        - fields: str (optional, comma separated fields to return, e.g. id,amount)
+        - start_date, end_date: str (optional, inclusive YYYY-MM-DD bounds)
+        - category: int (optional, category id, or comma separated ids)
+        - types: str (optional, income or expense)
+        - min_amount, max_amount: float (optional, inclusive bounds)
+        - search: str (optional, words that must all appear in the notes)
 
         Response:
-        - list of transaction objects
+        - next: url of the next page, null on the last page
+        - results: list of transaction objects
         """
         return super().list(request, *args, **kwargs)
 
@@ -70,12 +110,14 @@ class TransactionViewSet(viewsets.ModelViewSet):
     #    request_body=TransactionSerializer,
     #    responses={201: TransactionSerializer},
     # )
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Create a new transaction for the authenticated user.
 
         Request:
         - Authorization: Bearer <token>
+        - Idempotency-Key: str (optional header, a retry with the same key returns the first response)
         - type: str
         - amount: float
         - category: int (category ID)
@@ -93,50 +135,110 @@ class TransactionViewSet(viewsets.ModelViewSet):
         print("process add transaction")
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        category = Categories.objects.get(id=request.data["category_id"])
-        transaction = serializer.save(user=request.user, category=category)
+        # Transactions.save posts the row to the ledger: rollups, budget spent
+        # (atomic F() deltas) and the budget notifications
+        transaction = serializer.save(user=request.user)
         headers = self.get_success_headers(serializer.data)
 
-        if transaction.types == "expense":
-            transaction_date = transaction.occu_date
-            transaction_month = transaction_date.month
-            transaction_year = transaction_date.year
-            try:
-                # Find the corresponding budget
-                budget = Budgets.objects.get(
-                    category=transaction.category,
-                    user=transaction.user,
-                    month=transaction_month,
-                    year=transaction_year,
-                )
-                # Update the spent value
-                budget.spent += transaction.amount
-                budget.save()
-                # if spending is more than the budget, generate a notification
-                per = budget.spent / budget.limits
-                if per >= 1:
-                    # warning
-                    notification = Notification.objects.create(
-                        user=request.user,
-                        notify=f"{category.name} budget has been overspent for {calendar.month_name[budget.month]}. ",
-                        types="warning",
-                    )
-                    notification.save()
-                elif per >= 0.9:
-                    # info
-                    notification = Notification.objects.create(
-                        user=request.user,
-                        notify=f"{per*100}% of the {calendar.month_name[budget.month]} {category.name} budget has been spent. ",
-                        types="info",
-                    )
-                    notification.save()
-            except Budgets.DoesNotExist:
-                print("no budget updated")
         return Response(
             serializer.data, status=status.HTTP_201_CREATED, headers=headers
         )
         # return super().create(request, *args, **kwargs)
 
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="bulk",
+        permission_classes=[IsAuthenticated],
+    )
+    @idempotent
+    def bulk(self, request):
+        """
+        Create many transactions for the authenticated user in one request.
+
+        Request:
+        - Authorization: Bearer <token>
+        - Idempotency-Key: str (optional header, a retry with the same key returns the first response)
+        - list of transactions (or {"transactions": [...]}), at most BULK_MAX_ROWS
+          - types: str
+          - amount: float
+          - category_id: int
+          - occu_date: str
+          - notes: str
+
+        Response:
+        - 201: list of the created transaction objects
+        - 400: the validation errors, nothing is created
+        """
+        rows = request.data
+        if isinstance(rows, dict):
+            rows = rows.get("transactions")
+        serializer = BulkTransactionSerializer(
+            data=rows,
+            many=True,
+            allow_empty=False,
+            max_length=BULK_MAX_ROWS,
+            context=self.get_serializer_context(),
+        )
+        serializer.is_valid(raise_exception=True)
+
+        transactions = [
+            Transactions(user=request.user, **row) for row in serializer.validated_data
+        ]
+        with db_transaction.atomic():
+            # one insert, one rollup pass, one spent delta per (budget, period)
+            transactions = Transactions.objects.bulk_create(
+                changes.stamp(transactions), batch_size=500
+            )
+            ledger.record(added=transactions)
+
+        return Response(
+            TransactionSerializer(transactions, many=True).data,
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        parser_classes=[MultiPartParser],
+        permission_classes=[IsAuthenticated],
+    )
+    @idempotent
+    def import_statement(self, request):
+        """
+        Import a bank statement into the authenticated user's transactions.
+
+        Request:
+        - Authorization: Bearer <token>
+        - Idempotency-Key: str (optional header, a retry with the same key returns the first response)
+        - file: file (CSV, OFX or QIF)
+        - format: str (optional, csv/ofx/qif, taken from the file extension by default)
+        - date_format: str (optional, strptime format of the dates, e.g. %d/%m/%Y)
+
+        Response:
+        - 201: imported, skipped, chunks, seconds, rows_per_second, errors
+        - 400: Bad Request if no file is uploaded, the format is unknown or the file can not be read (nothing is imported)
+        """
+        upload = request.FILES.get("file")
+        if not upload:
+            return Response(
+                {"error": "No file uploaded."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        fmt = request.data.get("format") or importers.detect_format(upload.name)
+        if fmt not in importers.FORMATS:
+            return Response(
+                {"error": "Unknown statement format, use csv, ofx or qif."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            result = importers.import_statement(
+                request.user, upload, fmt, date_format=request.data.get("date_format")
+            )
+        except importers.StatementError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result.as_dict(), status=status.HTTP_201_CREATED)
+
     # @swagger_auto_schema(
     #    method="post",
     #    operation_description="Process a receipt image, extract transaction details, and return them.",
@@ -186,7 +288,9 @@ class TransactionViewSet(viewsets.ModelViewSet):
         - image: file (JPEG, PNG)
 
         Response:
-        - 200: Extracted transaction data from the receipt
+        - 200: {"task_id", "poll_wait"}, poll_wait is the longest wait of a
+          check_task_status request (a receipt uploaded before gets its task
+          back, with "duplicate": true)
         - 400: Bad Request if no image is uploaded
         - 500: Internal Server Error if something goes wrong
         Process a receipt image, extract transaction details, and return a task ID.
@@ -199,80 +303,168 @@ class TransactionViewSet(viewsets.ModelViewSet):
                     {"error": "No image uploaded."}, status=status.HTTP_400_BAD_REQUEST
                 )
 
-            if image.size > 5 * 1024 * 1024:  # max image 5MB
+            if image.size > MAX_UPLOAD_BYTES:  # max image 5MB
                 return Response(
                     {"error": "Image size exceeds the allowed limit of 5MB."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
+            # the same photo uploaded again, before any decode
+            data = image.read()
+            digest = receipt_dedupe.content_digest(data)
+            task = receipt_dedupe.find_task(request.user, digest)
+            if task is not None:
+                return Response(
+                    {**task, "duplicate": True, "poll_wait": poll_wait()},
+                    status=status.HTTP_200_OK,
+                )
+
+            # validated and downscaled in one decode
             try:
-                image_data = Image.open(image)
-                image_data.verify()  # 验verify image format
-            except UnidentifiedImageError:
+                image_binary = prepare_receipt(data)
+            except InvalidImage:
                 return Response(
                     {"error": "Uploaded file is not a valid image."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            # image to binary data
-            image_data = Image.open(image)
-            image_data.thumbnail((1024, 1024))  # adjust the image size
-            buffered = BytesIO()
-            image_data.save(buffered, format="JPEG")
-            image_binary = buffered.getvalue()
-            image_base64 = base64.b64encode(image_binary).decode("utf-8")
-
-            # 生taskid
-            task_id = str(uuid.uuid4())
-
-            # task data to lambda
-            lambda_payload = {
-                "task_id": task_id,
-                "image_data": image_base64,
-            }
-
-            response = lambda_client.invoke(
-                FunctionName="pfm-ProcessReceiptFunction-SPRh84ot6ujL",
-                InvocationType="Event",
-                Payload=json.dumps(lambda_payload),
+            fingerprint = None
+            if settings.RECEIPT_DEDUPE_PERCEPTUAL:
+                fingerprint = receipt_dedupe.dhash(image_binary)
+                task = receipt_dedupe.find_similar_task(
+                    request.user, digest, fingerprint
+                )
+                if task is not None:
+                    return Response(
+                        {**task, "duplicate": True, "poll_wait": poll_wait()},
+                        status=status.HTTP_200_OK,
+                    )
+
+            # queued on the receipt backend of the settings (AWS Lambda or local pool)
+            task_id = get_backend().submit(request.user, image_binary)
+            receipt_dedupe.remember(request.user, digest, task_id, fingerprint)
+
+            return Response(
+                {"task_id": task_id, "poll_wait": poll_wait()},
+                status=status.HTTP_200_OK,
             )
 
-            # Store task status in DynamoDB
-            table.put_item(
-                Item={"task_id": task_id, "status": "submitted", "result": None}
+        except Exception as e:
+            logger.error(f"Error processing receipt: {e}")
+            return Response(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-            return Response({"task_id": task_id}, status=status.HTTP_200_OK)
+    @action(detail=False, methods=["post"], permission_classes=[IsAuthenticated])
+    def process_receipts(self, request):
+        """
+        Process a batch of receipt images, preprocessed in parallel and submitted together.
+
+        Request:
+        - Authorization: Bearer <token>
+        - images: files (JPEG, PNG), at most RECEIPT_BATCH_MAX_IMAGES
+
+        Response:
+        - 200: {"batch_id", "items": [{"name", "task_id", "duplicate", "status"}],
+          "counts"}, an invalid image has status "invalid" and an error
+        - 400: Bad Request if no image is uploaded, too many, or one is over 5MB
+        - 500: Internal Server Error if something goes wrong
+        """
+        images = request.FILES.getlist("images")
+        if not images:
+            return Response(
+                {"error": "No image uploaded."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(images) > settings.RECEIPT_BATCH_MAX_IMAGES:
+            return Response(
+                {
+                    "error": f"At most {settings.RECEIPT_BATCH_MAX_IMAGES} images per batch."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        for image in images:
+            if image.size > MAX_UPLOAD_BYTES:
+                return Response(
+                    {"error": f"Image {image.name} exceeds the allowed limit of 5MB."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
 
+        try:
+            batch = submit_batch(
+                request.user, [(image.name, image.read()) for image in images]
+            )
+            return Response(batch_status(batch), status=status.HTTP_200_OK)
         except Exception as e:
-            logger.error(f"Error processing receipt: {e}")
+            logger.error(f"Error processing receipt batch: {e}")
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=["get"], permission_classes=[IsAuthenticated])
+    def check_batch_status(self, request, pk=None):
+        """
+        Function:
+        Check the status of every image of a receipt batch, the results are read per task.
+
+        Response:
+        - 200: {"batch_id", "items", "counts"} as returned by process_receipts
+        - 404: the batch does not exist or belongs to another user
+        """
+        try:
+            batch = ReceiptBatch.objects.get(id=pk, user=request.user)
+        except (ReceiptBatch.DoesNotExist, ValidationError):
+            return Response(
+                {"error": "Batch not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(batch_status(batch), status=status.HTTP_200_OK)
+
     # check the image process progress, and return result
     @action(detail=True, methods=["get"], permission_classes=[IsAuthenticated])
     def check_task_status(self, request, pk=None):
         """
         Function:
         Check the status and result of a specific task.
+
+        Request:
+        - wait: seconds (optional, long-poll), hold the request while the task
+          is still submitted, up to poll_wait (RECEIPT_LONG_POLL_TIMEOUT)
+        - status: the status the client already has (optional, with wait),
+          a different current status is returned at once
+
+        Response:
+        - 200: {"task_id", "status": submitted/completed/failed, "result", "poll_wait"}
+        - 400: wait is not a number
+        - 404: the task does not exist or belongs to another user
         """
         try:
-            task_id = pk
-            response = table.get_item(Key={"task_id": task_id})
-            if "Item" not in response:
+            task = get_task(pk, request.user)
+            if task is None:
                 return Response(
                     {"error": "Task not found."}, status=status.HTTP_404_NOT_FOUND
                 )
 
-            task_status = response["Item"]["status"]
-            task_result = response["Item"].get("result")
-            if task_result is not None:
-                process_result(task_result)
+            wait = request.query_params.get("wait")
+            known = request.query_params.get("status", "submitted")
+            if wait and task["status"] == "submitted" and known == "submitted":
+                try:
+                    timeout = float(wait)
+                except ValueError:
+                    timeout = math.nan
+                if not math.isfinite(timeout):
+                    return Response(
+                        {"error": "wait must be a number of seconds."},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                timeout = min(max(timeout, 0), poll_wait())
+                # no connection held while waiting, the next read opens one
+                if not connection.in_atomic_block:
+                    connection.close()
+                # woken by the worker or the watcher thread, not a read per client
+                if get_watcher().wait(task["task_id"], "submitted", timeout):
+                    task = get_task(pk, request.user)
 
             return Response(
-                {"task_id": task_id, "status": task_status, "result": task_result},
-                status=status.HTTP_200_OK,
+                {**task, "poll_wait": poll_wait()}, status=status.HTTP_200_OK
             )
 
         except Exception as e:
@@ -281,6 +473,70 @@ class TransactionViewSet(viewsets.ModelViewSet):
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=["post"], permission_classes=[IsAuthenticated])
+    @idempotent
+    def materialize_receipt(self, request, pk=None):
+        """
+        Create the expense transactions of a completed receipt task in one write.
+
+        Request:
+        - Authorization: Bearer <token>
+        - Idempotency-Key: str (optional header, a retry with the same key returns the first response)
+        - split: str (optional, category or product, default category)
+        - occu_date: str (optional, default today)
+        - notes: str (optional, default "Add by receipt")
+        - result: Invoice (optional, the result as edited by the user, a changed product category is remembered for the next receipts)
+
+        Response:
+        - 201: {"transactions": [...], "skipped": [{"category", "amount", "reason"}]}
+        - 400: the validation errors, or no line matches a category (with skipped)
+        - 404: the task does not exist or belongs to another user
+        - 409: the task is not completed, or its transactions were already added
+        """
+        task = get_task(pk, request.user)
+        if task is None:
+            return Response(
+                {"error": "Task not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        if task["status"] != "completed":
+            return Response(
+                {"error": "Task is not completed."}, status=status.HTTP_409_CONFLICT
+            )
+        serializer = ReceiptTransactionsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        options = serializer.validated_data
+
+        try:
+            transactions, skipped = receipt_transactions.materialize_receipt(
+                request.user,
+                task["task_id"],
+                options.get("result") or task["result"],
+                options["occu_date"],
+                split=options["split"],
+                notes=options["notes"],
+                original=task["result"],
+            )
+        except receipt_transactions.AlreadyAdded:
+            return Response(
+                {"error": "The transactions of this receipt were already added."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        if not transactions:
+            return Response(
+                {
+                    "error": "No line of the receipt matches an expense category.",
+                    "skipped": skipped,
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(
+            {
+                "transactions": TransactionSerializer(transactions, many=True).data,
+                "skipped": skipped,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
     # @swagger_auto_schema(
     #    operation_description="Retrieve a specific transaction",
     #    responses={200: TransactionSerializer},
@@ -6,7 +6,7 @@
  */
 
 import React, { useState, useEffect } from 'react';
-import api from '../services/api'; // Import the api module
+import api, { fetchAllPages } from '../services/api'; // Import the api module
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { faPlus, faEdit, faTrash } from '@fortawesome/free-solid-svg-icons';
 import './Budgets.css';
@@ -32,7 +32,7 @@ const Budgets = () => {
     const fetchBudgetsAndCategories = async () => {
         try {
             const [budgetsResponse, categoriesResponse] = await Promise.all([
-                api.get('/budgets/'),
+                fetchAllPages('/budgets/'),
                 api.get('/categories/')
             ]);
 
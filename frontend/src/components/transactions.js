@@ -6,7 +6,7 @@
  */
 
 import React, { useState, useEffect } from 'react';
-import api from '../services/api';
+import api, { fetchAllPages } from '../services/api';
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { RingLoader } from 'react-spinners';
 import { faPlus, faEdit, faTrash, faCamera, faSave, faCancel, faImage } from '@fortawesome/free-solid-svg-icons';
@@ -27,6 +27,7 @@ const Transactions = () => {
     const [taskId, setTaskId] = useState(''); // task_id
     const [taskStatus, setTaskStatus] = useState(''); // task status
     const [polling, setPolling] = useState(false); // check ststus
+    const [pollWait, setPollWait] = useState(8); // longest wait of a status request, set by the server
 
     // init data
     useEffect(() => {
@@ -36,7 +37,7 @@ const Transactions = () => {
     const fetchTransactionsAndCategories = async () => {
         try {
             const [transactionsResponse, categoriesResponse] = await Promise.all([
-                api.get('/transactions/'),
+                fetchAllPages('/transactions/'),
                 api.get('/categories/')
             ]);
 
@@ -78,6 +79,7 @@ const Transactions = () => {
                 },
             });
             setTaskId(response.data.task_id); // task id
+            setPollWait(response.data.poll_wait ?? 8);
             setTaskStatus('submitted');
             setPolling(true); // check
         } catch (err) {
@@ -86,40 +88,56 @@ const Transactions = () => {
         }
     };
 
-    // check task status
+    // check task status, each request is held by the server until the task changes (long-poll)
     useEffect(() => {
-        let pollingInterval;
-        let pollingAttempts = 0;
-        const maxPollingAttempts = 100;
-
-        if (polling) {
-            pollingInterval = setInterval(async () => {
-                pollingAttempts += 1;
+        if (!polling) {
+            return;
+        }
+        let cancelled = false;
+        // give up after 5 minutes, each request waits at most the poll_wait of the server
+        const deadline = Date.now() + 5 * 60 * 1000;
+
+        const pollTaskStatus = async () => {
+            let status = 'submitted';
+            let wait = pollWait;
+            while (Date.now() < deadline && !cancelled) {
                 try {
-                    const response = await api.get(`/transactions/${taskId}/check_task_status/`);
-                    setTaskStatus(response.data.status);
-                    if (response.data.status === 'completed') {
+                    const response = await api.get(`/transactions/${taskId}/check_task_status/`, {
+                        params: { wait, status },
+                    });
+                    if (cancelled) {
+                        return;
+                    }
+                    status = response.data.status;
+                    wait = response.data.poll_wait ?? wait;
+                    setTaskStatus(status);
+                    if (status === 'completed') {
                         setExtractedData(response.data.result);
-                        clearInterval(pollingInterval);
-                        setPolling(false);
-                        setLoading(false);
-                    } else if (pollingAttempts >= maxPollingAttempts) {
-                        alert('Polling attempts exceeded.');
-                        clearInterval(pollingInterval);
-                        setPolling(false);
-                        setLoading(false);
+                        break;
+                    } else if (status === 'failed') {
+                        alert('Failed to process the receipt.');
+                        break;
                     }
                 } catch (err) {
                     console.error('Failed to check task status.', err);
-                    clearInterval(pollingInterval);
-                    setPolling(false);
-                    setLoading(false);
+                    break;
                 }
-            }, 3000); // check task status each 3 seconds
-        }
+            }
+            if (cancelled) {
+                return;
+            }
+            if (status === 'submitted') {
+                alert('Polling attempts exceeded.');
+            }
+            setPolling(false);
+            setLoading(false);
+        };
 
-        return () => clearInterval(pollingInterval); // clear timer
-    }, [polling, taskId]);
+        pollTaskStatus();
+        return () => {
+            cancelled = true; // stop polling
+        };
+    }, [polling, taskId, pollWait]);
 
     // modify price
     const handlePriceChange = (index, newPrice) => {
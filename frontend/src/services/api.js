@@ -26,4 +26,16 @@ api.interceptors.request.use(
     }
 );
 
+// load every page of a keyset paginated list endpoint, following the "next" links
+export const fetchAllPages = async (url) => {
+    const results = [];
+    let next = url;
+    while (next) {
+        const response = await api.get(next);
+        results.push(...response.data.results);
+        next = response.data.next;
+    }
+    return { data: results };
+};
+
 export default api;
\ No newline at end of file